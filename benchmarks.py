@@ -0,0 +1,516 @@
+"""
+Micro-benchmarks for the world storage and generation code.
+
+Usage: python benchmarks.py [benchmark ...]
+Runs every benchmark when none is given.
+"""
+
+# Imports, sorted alphabetically.
+
+# Python packages
+from collections import defaultdict, deque, OrderedDict
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+import globals as G
+import blocks
+from generation import GenerationService
+from pregen import OfflineServer
+from blockstorage import BlockStorage
+from regionlocks import block_regions, region_neighborhood, RegionLocks
+from residency import region_sectors
+import savingsystem
+import sectorcodec
+from sectorview import exposed_bitmap, sector_view
+import terrain
+from terrain import RegenerationWorld
+from utils import FACES, sectorize
+from world import World
+from world_server import WorldServer
+
+
+__all__ = (
+    'BENCHMARKS', 'bench_sector_codec', 'bench_block_storage_memory',
+    'bench_region_removal', 'bench_lock_wait', 'bench_sector_view',
+    'bench_block_lookup', 'bench_block_id', 'bench_terrain_heights',
+    'bench_column_cache', 'bench_generation_pool', 'bench_sector_buffers',
+)
+
+
+def report(name, seconds, number, unit='call'):
+    print '%-40s %10.2f us/%s' % (name, seconds / number * 1e6, unit)
+
+
+def random_sector_blocks(secpos, fill=0.6):
+    """ A dict world holding one sector of random registered blocks """
+    rand = random.Random(0)
+    choices = [block for block in G.BLOCKS_DIR.values() if block.id.main]
+    cx, cy, cz = secpos
+    world = {}
+    for x, y, z in sectorcodec.SECTOR_OFFSETS:
+        if rand.random() < fill:
+            world[(cx * 8 + x, cy * 8 + y, cz * 8 + z)] = rand.choice(choices)
+    return world
+
+
+# The per-block implementations the sector codec replaced
+
+structuchar2 = struct.Struct("BB")
+null2 = struct.pack("xx")
+
+
+def legacy_save_sector_to_string(world, secpos):
+    cx, cy, cz = secpos[0] * 8, secpos[1] * 8, secpos[2] * 8
+    air = blocks.air_block
+    fstr = ""
+    for x in xrange(cx, cx+8):
+        for y in xrange(cy, cy+8):
+            for z in xrange(cz, cz+8):
+                blk = world.get((x,y,z), air).id
+                if blk is not air:
+                    fstr += structuchar2.pack(blk.main, blk.sub)
+                else:
+                    fstr += null2
+    return fstr
+
+
+def legacy_decode_sector(fstr, secpos):
+    cx, cy, cz = secpos[0] * 8, secpos[1] * 8, secpos[2] * 8
+    decoded = []
+    fpos = 0
+    for x in xrange(cx, cx+8):
+        for y in xrange(cy, cy+8):
+            for z in xrange(cz, cz+8):
+                read = fstr[fpos:fpos+2]
+                fpos += 2
+                if read != null2:
+                    decoded.append(((x, y, z), structuchar2.unpack(read)))
+    return decoded
+
+
+def bench_sector_codec(number=2000):
+    secpos = (3, 4, -2)
+    world = random_sector_blocks(secpos)
+    fstr = sectorcodec.encode_sector(world, secpos)
+    assert fstr == legacy_save_sector_to_string(world, secpos)
+    assert [(position, full_id) for _, position, full_id in sectorcodec.iter_sector_blocks(fstr, secpos)] \
+        == legacy_decode_sector(fstr, secpos)
+
+    print 'Sector codec (NumPy %s)' % ('enabled' if sectorcodec.numpy is not None else 'not available')
+    report('legacy save_sector_to_string', timeit.timeit(
+        lambda: legacy_save_sector_to_string(world, secpos), number=number), number, 'sector')
+    report('sectorcodec.encode_sector', timeit.timeit(
+        lambda: sectorcodec.encode_sector(world, secpos), number=number), number, 'sector')
+    report('legacy per-block decode', timeit.timeit(
+        lambda: legacy_decode_sector(fstr, secpos), number=number), number, 'sector')
+    report('sectorcodec.iter_sector_blocks', timeit.timeit(
+        lambda: list(sectorcodec.iter_sector_blocks(fstr, secpos)), number=number), number, 'sector')
+
+
+def dict_world_size(world):
+    """
+    Bytes used by the per-block dict and sector position lists the world
+    used before BlockStorage, holding the same blocks (shared block
+    instances and small ints aren't counted).
+    """
+    positions = world.keys()
+    blocks_by_position = dict.fromkeys(positions)
+    sectors = defaultdict(list)
+    for position in positions:
+        sectors[sectorize(position)].append(position)
+    return (sys.getsizeof(blocks_by_position) + sum(sys.getsizeof(position) for position in positions)
+            + sys.getsizeof(sectors) + sum(sys.getsizeof(secpos) + sys.getsizeof(sector)
+                                           for secpos, sector in sectors.iteritems()))
+
+
+def block_storage_size(world):
+    size = sys.getsizeof(world.sector_arrays) + sys.getsizeof(world.entities)
+    for secpos, ids in world.sector_arrays.iteritems():
+        size += sys.getsizeof(secpos) + sys.getsizeof(ids)
+    for position, entity in world.entities.iteritems():
+        size += sys.getsizeof(position) + sys.getsizeof(entity)
+    return size
+
+
+def bench_block_storage_memory(size=256):
+    """
+    Generates a size x size area (every region from y=0 to y=96) and
+    compares the memory of its blocks in BlockStorage with a per-block dict.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    world = RegenerationWorld(G.SEED)
+    for rx in xrange(size / 32):
+        for rz in xrange(size / 32):
+            for ry in xrange(3):
+                world.generate_region((rx, ry, rz))
+    count = len(world)
+    print 'Block storage memory (%dx%d area, %d blocks)' % (size, size, count)
+    print '%-40s %10.2f bytes/block' % ('dict of positions + sector lists', float(dict_world_size(world)) / count)
+    print '%-40s %10.2f bytes/block' % ('BlockStorage sector arrays', float(block_storage_size(world)) / count)
+
+
+def bench_region_removal(region=(0, 1, 0)):
+    """
+    Removes every block of a generated region through WorldServer.remove_block
+    and the client World._remove_block, with their ordered sets and with the
+    deque and lists they kept spreading and sector membership in before.
+    The surface blocks are queued for spreading, like exposed dirt.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    generated = RegenerationWorld(G.SEED)
+    generated.generate_region(region)
+    sectors = [(secpos, generated.encode_sector(secpos)) for secpos in generated.sector_arrays]
+    positions = generated.keys()
+    random.Random(0).shuffle(positions)
+    surface = [(x, y, z) for x, y, z in positions if (x, y + 1, z) not in generated]
+
+    class LegacyWorldServer(WorldServer):
+        def __delitem__(self, position):
+            BlockStorage.__delitem__(self, position)
+            if position in self.spreading_mutable_blocks:
+                self.spreading_mutable_blocks.remove(position)
+
+    class LegacyWorld(World):
+        def _remove_block(self, position, sync=True):
+            del self[position]
+            self.heightmap.block_removed(position)
+            self.sectors[sectorize(position)].remove(position)
+
+    def server(world_type, spreading):
+        saved = G.game_dir, G.worlds_dir, G.SAVE_FILENAME
+        G.game_dir = tempfile.mkdtemp()
+        G.worlds_dir, G.SAVE_FILENAME = os.path.join(G.game_dir, 'worlds'), 'world'
+        try:
+            os.makedirs(os.path.join(G.game_dir, 'world'))
+            with open(os.path.join(G.game_dir, 'world', 'seed'), 'wb') as f:
+                f.write(G.SEED)
+            world = world_type(OfflineServer())
+            for secpos, fstr in sectors:
+                world.decode_sector(secpos, fstr)
+            world.heightmap.add_sectors([secpos for secpos, fstr in sectors])
+            world.spreading_mutable_blocks = spreading(surface)
+            start = timeit.default_timer()
+            for position in positions:
+                world.remove_block(position, sync=False, check_spread=False)
+            seconds = timeit.default_timer() - start
+            world.journal.file.close()
+            return seconds
+        finally:
+            savingsystem.close_player_stores()
+            shutil.rmtree(G.game_dir)
+            G.game_dir, G.worlds_dir, G.SAVE_FILENAME = saved
+
+    def client(world_type, sector):
+        world = world_type()
+        members = defaultdict(list)
+        for position in positions:
+            world[position] = generated[position]
+            members[sectorize(position)].append(position)
+        for secpos, sector_positions in members.iteritems():
+            world.sectors[secpos] = sector(sector_positions)
+        world.heightmap.add_sectors(members)
+        start = timeit.default_timer()
+        for position in positions:
+            world._remove_block(position, sync=False)
+        return timeit.default_timer() - start
+
+    print 'Region removal (%d blocks, %d spreading)' % (len(positions), len(surface))
+    report('WorldServer, deque', server(LegacyWorldServer, deque), len(positions), 'block')
+    report('WorldServer, ordered set', server(WorldServer, OrderedDict.fromkeys), len(positions), 'block')
+    report('client World, lists', client(LegacyWorld, list), len(positions), 'block')
+    report('client World, ordered sets', client(World, OrderedDict.fromkeys), len(positions), 'block')
+
+
+def bench_lock_wait(regions=3):
+    """
+    Generates regions in one thread while another edits blocks far away,
+    and reports how long the edits waited for their locks, with one lock
+    for the whole world (like the old server lock) and with region locks.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+
+    def run(locks, lock_key):
+        world = RegenerationWorld(G.SEED)
+        edits = [0]
+
+        def generate():
+            for i in xrange(regions):
+                region = (i * 3, 1, 0)
+                with locks.hold(lock_key(r) for r in region_neighborhood(region)):
+                    world.generate_region(region)
+        generator = threading.Thread(target=generate)
+        generator.start()
+        rand = random.Random(0)
+        while generator.is_alive():
+            position = (rand.randint(320, 351), rand.randint(32, 63), rand.randint(320, 351))
+            with locks.hold(lock_key(r) for r in block_regions(position, position)):
+                world[position] = blocks.stone_block
+            edits[0] += 1
+        generator.join()
+        stats = locks.stats()
+        return edits[0], stats['wait_time'], stats['max_wait']
+
+    print 'Lock wait while generating (%d regions)' % regions
+    for name, lock_key in (('single world lock', lambda region: None),
+                           ('region locks', lambda region: region)):
+        locks = RegionLocks()
+        edits, wait_time, max_wait = run(locks, lock_key)
+        print '%-40s %10.2f ms/edit waited, %.1f ms longest, %d edits' % (
+            name, wait_time / max(edits, 1) * 1e3, max_wait * 1e3, edits)
+
+
+def legacy_exposed_bitmap(world, secpos):
+    # WorldServer.get_exposed_sector before sector views: is_exposed per block
+    cx, cy, cz = secpos[0] * 8, secpos[1] * 8, secpos[2] * 8
+    bitmap = bytearray(64)
+    for i, (x, y, z) in enumerate(sectorcodec.SECTOR_OFFSETS):
+        position = (cx + x, cy + y, cz + z)
+        if position in world:
+            for fx, fy, fz in FACES:
+                other = (position[0] + fx, position[1] + fy, position[2] + fz)
+                if other not in world or world[other].transparent:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+                    break
+    return bitmap
+
+
+def bench_sector_view(region=(0, 1, 0), number=20):
+    """
+    Builds the exposure bitmaps of a generated region, per block and from
+    sector views.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    world = RegenerationWorld(G.SEED)
+    world.generate_region(region)
+    sectors = [secpos for secpos, ids in world.sector_arrays.iteritems() if ids is not None]
+    for secpos in sectors:
+        assert legacy_exposed_bitmap(world, secpos) == exposed_bitmap(sector_view(world, secpos))
+
+    print 'Exposure bitmaps (%d sectors)' % len(sectors)
+    report('is_exposed per block', timeit.timeit(
+        lambda: [legacy_exposed_bitmap(world, secpos) for secpos in sectors], number=number),
+        number * len(sectors), 'sector')
+    report('sector_view + exposed_bitmap', timeit.timeit(
+        lambda: [exposed_bitmap(sector_view(world, secpos)) for secpos in sectors], number=number),
+        number * len(sectors), 'sector')
+
+
+def legacy_block_and_metadata(full_id):
+    # blocks.block_and_metadata before the flat lookup table
+    if full_id in G.BLOCKS_DIR:
+        block = G.BLOCKS_DIR[full_id]
+        return block, (full_id[1] if block.sub_id_as_metadata else 0)
+    block = G.BLOCKS_DIR[(full_id[0], 0)]
+    if not block.sub_id_as_metadata:
+        raise KeyError(full_id)
+    return block, full_id[1]
+
+
+def bench_block_lookup(region=(0, 1, 0), number=5):
+    """
+    Loads the sectors of a generated region into a BlockStorage, block by
+    block through G.BLOCKS_DIR like load_region did, and in one go with
+    BlockStorage.decode_sector.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    generated = RegenerationWorld(G.SEED)
+    generated.generate_region(region)
+    sectors = [(secpos, generated.encode_sector(secpos)) for secpos in generated.sector_arrays]
+
+    def per_block():
+        world = BlockStorage()
+        for secpos, fstr in sectors:
+            for _, position, full_id in sectorcodec.iter_sector_blocks(fstr, secpos):
+                try:
+                    block, metadata = legacy_block_and_metadata(full_id)
+                except KeyError:
+                    continue
+                world[position] = block
+                if metadata:
+                    world.set_metadata(position, metadata)
+        return world
+
+    def bulk():
+        world = BlockStorage()
+        for secpos, fstr in sectors:
+            world.decode_sector(secpos, fstr)
+        return world
+
+    assert sorted(per_block().iteritems()) == sorted(bulk().iteritems())
+    full_ids = [full_id for secpos, fstr in sectors for _, _, full_id in sectorcodec.iter_sector_blocks(fstr, secpos)]
+
+    print 'Block lookup (%d sectors, %d blocks)' % (len(sectors), len(full_ids))
+    report('G.BLOCKS_DIR block_and_metadata', timeit.timeit(
+        lambda: [legacy_block_and_metadata(full_id) for full_id in full_ids], number=number),
+        number * len(full_ids), 'block')
+    report('G.BLOCKS_BY_VALUE block_and_metadata', timeit.timeit(
+        lambda: [blocks.block_and_metadata(full_id) for full_id in full_ids], number=number),
+        number * len(full_ids), 'block')
+    report('load per block', timeit.timeit(per_block, number=number), number * len(sectors), 'sector')
+    report('BlockStorage.decode_sector', timeit.timeit(bulk, number=number), number * len(sectors), 'sector')
+
+
+def bench_block_id(number=100000):
+    """
+    Makes BlockIDs from the forms the game uses, and looks blocks up in
+    G.BLOCKS_DIR by id and by (main, sub) tuple.
+    """
+    from items import get_item
+    stone = blocks.BlockID(1)
+    print 'BlockID'
+    for name, make in (('int', lambda: blocks.BlockID(1)),
+                       ('int, sub', lambda: blocks.BlockID(35, 3)),
+                       ('tuple', lambda: blocks.BlockID((35, 3))),
+                       ('string', lambda: blocks.BlockID("35.3"))):
+        report('BlockID(%s)' % name, timeit.timeit(make, number=number), number)
+    report('G.BLOCKS_DIR[id]', timeit.timeit(lambda: G.BLOCKS_DIR[stone], number=number), number)
+    report('G.BLOCKS_DIR[tuple]', timeit.timeit(lambda: G.BLOCKS_DIR[(1, 0)], number=number), number)
+    report('get_item(int)', timeit.timeit(lambda: get_item(1), number=number), number)
+
+
+def bench_terrain_heights(region=(0, 1, 0), number=3):
+    """
+    Generates the sectors of a region holding the surface, with the heights
+    of each sector's columns from get_height one by one (as when NumPy is
+    missing) and from the NumPy get_heights.
+    """
+    numpy = terrain.numpy
+    if numpy is None:
+        print 'Terrain heights: NumPy is not installed'
+        return
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    sectors = region_sectors(region)
+
+    def generate():
+        world = RegenerationWorld(G.SEED)
+        for sector in sectors:
+            world.terraingen.generate_sector(sector)
+        return world
+
+    terrain.numpy = None
+    try:
+        per_column = generate()
+        seconds = timeit.timeit(generate, number=number)
+    finally:
+        terrain.numpy = numpy
+    assert sorted(per_column.iteritems()) == sorted(generate().iteritems())
+
+    vectorized = timeit.timeit(generate, number=number)
+    print 'Terrain heights (%d sectors)' % len(sectors)
+    report('get_height per column', seconds, number * len(sectors), 'sector')
+    report('NumPy get_heights', vectorized, number * len(sectors), 'sector')
+    print '%-40s %10.1f -> %.1f sectors/s' % ('generation', number * len(sectors) / seconds,
+                                              number * len(sectors) / vectorized)
+    generator = RegenerationWorld(G.SEED).terraingen
+    report('get_height x 64', timeit.timeit(
+        lambda: [generator.get_height(x, z) for x in xrange(8) for z in xrange(8)], number=number * 20),
+        number * 20, 'sector')
+    report('get_heights', timeit.timeit(lambda: generator.get_heights(0, 0), number=number * 20),
+        number * 20, 'sector')
+
+
+def bench_column_cache(region=(0, 1, 0), number=3):
+    """
+    Generates a region with the column cache, and with a cache too small to
+    keep anything, so each sector computes its column's biome and heights.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    sectors = region_sectors(region)
+
+    def generate(size):
+        world = RegenerationWorld(G.SEED)
+        world.terraingen.columns.size = size
+        for sector in sectors:
+            world.terraingen.generate_sector(sector)
+        return world
+
+    print 'Column cache (%d sectors)' % len(sectors)
+    for name, size in (('per sector', 0), ('cached', G.COLUMN_CACHE_SIZE)):
+        report(name, timeit.timeit(lambda: generate(size), number=number), number * len(sectors), 'sector')
+    print generate(G.COLUMN_CACHE_SIZE).terraingen.columns.stats()
+
+
+def bench_generation_pool(regions=8):
+    """
+    Generates regions with a GenerationService of one worker, then of one
+    worker per core.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    jobs = [region_sectors((x, 1, z)) for x in xrange(regions) for z in xrange(2)]
+    print 'Generation pool (%d regions, %d cores)' % (len(jobs), multiprocessing.cpu_count())
+    for processes in sorted(set((1, multiprocessing.cpu_count()))):
+        service = GenerationService(G.SEED, processes)
+        service.start()
+        try:
+            start = time.time()
+            for sectors in service.generate_many(jobs):
+                pass
+            seconds = time.time() - start
+        finally:
+            service.stop()
+        report('%d worker(s)' % processes, seconds, len(jobs) * 64, 'sector')
+        print '%-40s %10.1f sectors/s' % ('', len(jobs) * 64 / seconds)
+
+
+def bench_sector_buffers(region=(0, 1, 0), number=3):
+    """
+    Generates a region with generate_sector, then only makes the buffers of
+    its sectors, which is what a thread can do without holding the world.
+    """
+    if G.SEED is None:
+        G.SEED = 'benchmark'
+    sectors = region_sectors(region)
+
+    def generate():
+        world = RegenerationWorld(G.SEED)
+        for sector in sectors:
+            world.terraingen.generate_sector(sector)
+
+    def buffers():
+        generator = RegenerationWorld(G.SEED).terraingen
+        for sector in sectors:
+            generator.generate_sector_buffer(sector)
+
+    print 'Sector buffers (%d sectors)' % len(sectors)
+    report('generate_sector', timeit.timeit(generate, number=number), number * len(sectors), 'sector')
+    report('generate_sector_buffer', timeit.timeit(buffers, number=number), number * len(sectors), 'sector')
+
+
+BENCHMARKS = {
+    'sector_codec': bench_sector_codec,
+    'block_storage_memory': bench_block_storage_memory,
+    'region_removal': bench_region_removal,
+    'lock_wait': bench_lock_wait,
+    'sector_view': bench_sector_view,
+    'block_lookup': bench_block_lookup,
+    'block_id': bench_block_id,
+    'terrain_heights': bench_terrain_heights,
+    'column_cache': bench_column_cache,
+    'generation_pool': bench_generation_pool,
+    'sector_buffers': bench_sector_buffers,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
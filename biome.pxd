@@ -15,5 +15,6 @@ cdef class BiomeGenerator(object):
 
     cpdef double get_temperature(self, double x, double z)
 
-    @cython.locals(temp=double, humidity=double)
     cpdef int get_biome_type(self, double x, double z)
+
+    cpdef int classify(self, double temp, double humidity)
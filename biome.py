@@ -33,8 +33,11 @@ class BiomeGenerator(object):
         return self._clamp((self.temperature_gen.fBm(x, z) + 1.0) / 2.0)
 
     def get_biome_type(self, x, z):
-        temp = self.get_temperature(x, z)
-        humidity = self.get_humidity(x, z) * temp
+        return self.classify(self.get_temperature(x, z), self.get_humidity(x, z))
+
+    def classify(self, temp, humidity):
+        """ The biome of a temperature and a humidity """
+        humidity *= temp
 
         if temp >= 0.5:
             if humidity < 0.3:
@@ -112,41 +112,77 @@ class BlockID(object):
     str(id) : "1.0"        "35.0"        "35.3"           "35.3"
     "35.3"
     Typical uses: id == 1    id == BlockID(35, 3)   id < 255
-    """
-
-    main = 0
-    sub = 0  # A.k.a. DataID, damageID, metadata, etc
-    icon_name = None
 
-    def __init__(self, main, sub=0, icon_name=None):
-        if isinstance(main, tuple):
-            self.main, self.sub = main
+    BlockIDs are immutable and interned: creating the id of a (main, sub)
+    pair again returns the same instance, so ids compare by identity first
+    and hash like the (main, sub) tuple, which is computed once. The
+    icon_name is shared by every use of the id, the last one given wins.
+    """
+    __slots__ = ('main', 'sub', 'icon_name', '_hash')
+
+    _interned = {}  # (main, sub) or a parsed string -> BlockID
+
+    def __new__(cls, main, sub=0, icon_name=None):
+        main_type = main.__class__
+        if main_type is int:
+            block_id = cls._interned.get((main, sub)) or cls._intern(main, sub)
+        elif main_type is cls:
+            block_id = main
+        elif main_type is tuple:
+            block_id = cls._interned.get(main) or cls._intern(*main)
         elif isinstance(main, basestring):
-            # Allow "35", "35.0", or "35,0"
-            spl = main.split(".") if "." in main else main.split(",") if "," in main else (main, 0)
-            if len(spl) == 2:
-                a, b = spl
-            elif len(spl) == 1:
-                a = spl[0]
-                b = 0
-            else:
-                raise ValueError("Expected #.# or #,#. Got %s" % main)
-            self.main = int(a)
-            self.sub = int(b or 0)
-        elif isinstance(main, self.__class__):
-            self.main = main.main
-            self.sub = main.sub
+            block_id = cls._interned.get(main)
+            if block_id is None:
+                block_id = cls._interned[main] = cls._intern(*cls._parse(main))
+        else:
+            block_id = cls._intern(main, sub)
+        if icon_name is not None and block_id.icon_name != icon_name:
+            object.__setattr__(block_id, 'icon_name', icon_name)
+        return block_id
+
+    @classmethod
+    def _intern(cls, main, sub=0):
+        main, sub = int(main), int(sub)
+        block_id = cls._interned.get((main, sub))
+        if block_id is None:
+            block_id = object.__new__(cls)
+            object.__setattr__(block_id, 'main', main)
+            object.__setattr__(block_id, 'sub', sub)  # A.k.a. DataID, damageID, metadata, etc
+            object.__setattr__(block_id, 'icon_name', None)
+            object.__setattr__(block_id, '_hash', hash((main, sub)))
+            block_id = cls._interned.setdefault((main, sub), block_id)
+        return block_id
+
+    @staticmethod
+    def _parse(text):
+        # Allow "35", "35.0", or "35,0"
+        spl = text.split(".") if "." in text else text.split(",") if "," in text else (text, 0)
+        if len(spl) == 2:
+            a, b = spl
+        elif len(spl) == 1:
+            a = spl[0]
+            b = 0
         else:
-            self.main = int(main)
-            self.sub = int(sub)
+            raise ValueError("Expected #.# or #,#. Got %s" % text)
+        return int(a), int(b or 0)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BlockID is immutable")
 
-        self.icon_name = icon_name
+    def __reduce__(self):
+        return BlockID, ((self.main, self.sub),)
 
     def __repr__(self):
         return '%d.%d' % (self.main, self.sub)
 
     def __hash__(self):
-        return hash((self.main, self.sub))
+        return self._hash
+
+    def __eq__(self, other):
+        return other is self or self.__cmp__(other) == 0
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __cmp__(self, other):
         if isinstance(other, tuple):
@@ -171,6 +207,49 @@ class BlockID(object):
         return ["textures", "icons", '%d.%d.png' % (self.main, self.sub)]
 
 
+# Values registered by a block's own id, which sub_id_as_metadata blocks
+# registered later don't take over
+_exact_values = set()
+
+
+def register_block(block):
+    """
+    Adds a block to G.BLOCKS_DIR and to the flat lookup tables: it gets the
+    next dense index in G.BLOCKS_LIST (or the index of the block it
+    replaces), and its main<<8|sub value in G.BLOCKS_BY_VALUE. A
+    sub_id_as_metadata block also takes the values of the other sub ids of
+    its main id, as those are its metadata.
+    """
+    value = block.id.main << 8 | block.id.sub
+    previous = G.BLOCKS_DIR.get(block.id)
+    if previous is not None:
+        block.index = previous.index
+        G.BLOCKS_LIST[block.index] = block
+    else:
+        block.index = len(G.BLOCKS_LIST)
+        G.BLOCKS_LIST.append(block)
+    G.BLOCKS_DIR[block.id] = block
+    G.BLOCKS_BY_VALUE[value] = block
+    _exact_values.add(value)
+    if block.sub_id_as_metadata:
+        main = value & 0xff00
+        for metadata_value in xrange(main, main + 256):
+            if metadata_value not in _exact_values:
+                G.BLOCKS_BY_VALUE[metadata_value] = block
+
+
+def block_and_metadata(full_id):
+    """
+    Returns the registered block of a (main, sub) id and its metadata, which
+    is the sub id of sub_id_as_metadata blocks and 0 otherwise.
+    Raises KeyError for unknown ids.
+    """
+    block = G.BLOCKS_BY_VALUE[full_id[0] << 8 | full_id[1]]
+    if block is None:
+        raise KeyError(full_id)
+    return block, (full_id[1] if block.sub_id_as_metadata else 0)
+
+
 class Block(object):
     id = None  # Original minecraft id (also called data value).
                # Verify on http://www.minecraftwiki.net/wiki/Data_values
@@ -241,10 +320,12 @@ class Block(object):
 
     render_as_normal_block = True
 
-    # if sub_id_as_metadata, we will create an instance for this block when it's being added to the world
-    # and use its sub id as metadata
+    # if sub_id_as_metadata, the sub id of this block in the world is its metadata
+    # (world.get_metadata/set_metadata), the block itself stays the shared registered instance
     sub_id_as_metadata = False
 
+    index = None  # Dense index in G.BLOCKS_LIST, set by register_block
+
     def __init__(self, width=None, height=None):
         self.id = BlockID(self.id or 0, 0, self.icon_name)
         self.drop_id = self.id
@@ -255,7 +336,7 @@ class Block(object):
         if height is not None:
             self.height = height
 
-        G.BLOCKS_DIR[self.id] = self
+        register_block(self)
 
         if not self.render_as_normal_block:
             return
@@ -320,19 +401,17 @@ class Block(object):
             )
         return vertices
 
-    def get_metadata(self):
-        if self.sub_id_as_metadata:
-            return self.id.sub
+    def texture_data_for(self, metadata):
+        return self.texture_data
 
-    def set_metadata(self, metadata):
-        if self.sub_id_as_metadata:
-            self.id.sub = metadata
+    def drop_id_for(self, metadata):
+        return self.drop_id
 
     def play_break_sound(self, player=None, position=None):
         if self.break_sound is not None:
             sounds.play_sound(self.break_sound, player=player, position=position)
 
-    def update_tile_entity(self, value):
+    def update_tile_entity(self, world, position, value):
         pass
 
     def update_texture(self):
@@ -949,81 +1028,7 @@ class FurnaceBlock(HardBlock):
     id = 61
     name = "Furnace"
 
-    entity_type = FurnaceEntity
-    entity = None
-
-    slot_count = 2
-
-    def __del__(self):
-        if self.entity is not None:
-            del self.entity
-
-    # compatible with inventory
-    def set_slot(self, index, value):
-        i = int(index)
-        if i < 0 or i >= 2:
-            return None
-        if i == 0:
-            self.set_smelting_item(value)
-        else:
-            self.set_fuel(value)
-
-    def at(self, index):
-        i = int(index)
-        if i < 0 or i >= 2:
-            return None
-        return self.entity.fuel if i == 1 else self.entity.smelt_stack
-
-    def remove_all_by_index(self, index):
-        i = int(index)
-        if i < 0 or i >= 2:
-            return None
-        if i == 0:
-            self.entity.smelt_stack = None
-        else:
-            self.entity.fuel = None
-
-    def get_items(self):
-        return [self.entity.smelt_stack, self.entity.fuel]
-
-    def remove_unnecessary_stacks(self):
-        if self.entity.fuel is not None:
-            if self.entity.fuel.amount == 0:
-                self.entity.fuel = None
-        if self.entity.smelt_stack is not None:
-            if self.entity.smelt_stack.amount == 0:
-                self.entity.smelt_stack = None
-
-
-    def set_smelting_item(self, item):
-        if item is None:
-            return
-        self.entity.smelt_stack = item
-        self.entity.outcome_item = G.smelting_recipes.smelt(self.entity.smelt_stack.get_object())
-        # no such recipe
-        if self.entity.outcome_item is None:
-            return
-        else:
-            self.entity.smelt()
-
-    def set_fuel(self, fuel):
-        if fuel is None:
-            return
-        self.entity.fuel = fuel
-        # invalid fuel
-        if self.entity.fuel.get_object().burning_time == -1:
-            return
-        else:
-            self.entity.smelt()
-
-    def set_outcome_callback(self, callback):
-        self.entity.outcome_callback = callback
-
-    def set_fuel_callback(self, callback):
-        self.entity.fuel_callback = callback
-
-    def get_smelt_outcome(self):
-        return self.entity.smelt_outcome
+    entity_type = FurnaceEntity  # Holds the slots, in world.entities
 
 class FarmBlock(Block):
     texture_name = "farmland_dry", "dirt", "dirt"
@@ -1346,10 +1351,8 @@ class CropBlock(Block):
     transparent = True
     break_sound = sounds.leaves_break
 
-    sub_id_as_metadata = True
-    growth_stage = 0
+    sub_id_as_metadata = True  # The growth stage
     entity_type = CropEntity
-    entity = None
 
     render_as_normal_block = False
 
@@ -1358,56 +1361,49 @@ class CropBlock(Block):
         self.top_texture = get_texture_coordinates(-1, -1)
         self.bottom_texture = get_texture_coordinates(-1, -1)
 
-    def __del__(self):
-        if self.entity is not None:
-            del self.entity
-
     @property
     def texture_data(self):
-        return self.get_texture_data()
+        return self.texture_data_for(0)
 
     @texture_data.setter
     def texture_data(self, value):
         self._texture_data = value
 
-    @property
-    def drop_id(self):
-        if self.growth_stage == self.max_growth_stage:
+    def texture_data_for(self, growth_stage):
+        return self.get_texture_data()
+
+    def stage_texture_data(self, side_texture):
+        # get_texture_data, with the side and front texture of a growth stage
+        textures = self.top_texture + self.bottom_texture + side_texture + side_texture
+        if self.vertex_mode != G.VERTEX_CROSS:
+            textures += side_texture * 2
+        return list(textures)
+
+    def drop_id_for(self, growth_stage):
+        if growth_stage == self.max_growth_stage:
             return BlockID(296) # wheat
         else:
             return BlockID(295) #seed
 
-    @drop_id.setter
-    def drop_id(self, value):
-        self._drop_id = value
-
-    @property
-    def growth_stage(self):
-        return self.get_metadata()
-
-    @growth_stage.setter
-    def growth_stage(self, value):
-        self.set_metadata(value)
-
     # called on client side
-    def fertilize(self):
-        if self.growth_stage == self.max_growth_stage:
+    def fertilize(self, world, position):
+        if world.get_metadata(position) == self.max_growth_stage:
             return False
-        G.CLIENT.update_tile_entity(self.entity.position, make_nbt_from_dict({'action'.encode(): 'fertilize'.encode()}))
+        G.CLIENT.update_tile_entity(position, make_nbt_from_dict({'action'.encode(): 'fertilize'.encode()}))
         return True
         
-    def update_tile_entity(self, value):
+    def update_tile_entity(self, world, position, value):
         nbt = extract_nbt(value)
         # client side
         if 'growth_stage' in nbt:
-            self.growth_stage = nbt['growth_stage']
+            world.set_metadata(position, nbt['growth_stage'])
             # update the texture
-            self.entity.world.hide_block(self.entity.position)
-            self.entity.world.show_block(self.entity.position)
+            world.hide_block(position)
+            world.show_block(position)
         # server side
         elif 'action' in nbt:
             if nbt['action'] == 'fertilize':
-                self.entity.fertilize()
+                world.entities[position].fertilize()
 
     def on_neighbor_change(self, world, neighbor_pos, self_pos):
         if (self_pos[0], self_pos[1] - 1, self_pos[-1]) not in world:
@@ -1421,20 +1417,12 @@ class PotatoBlock(CropBlock):
 
     max_growth_stage = 3
 
-    @property
-    def texture_data(self):
-        self.side_texture = get_texture_coordinates(self.growth_stage + 4, 9)
-        self.front_texture = self.side_texture
-        return self.get_texture_data()
+    def texture_data_for(self, growth_stage):
+        return self.stage_texture_data(get_texture_coordinates(growth_stage + 4, 9))
 
-    @property
-    def drop_id(self):
+    def drop_id_for(self, growth_stage):
         return BlockID(392)
 
-    @drop_id.setter
-    def drop_id(self, value):
-        self._drop_id = value
-
 class CarrotBlock(CropBlock):
     id = 141
     name = "Carrot"
@@ -1443,20 +1431,12 @@ class CarrotBlock(CropBlock):
 
     max_growth_stage = 3
 
-    @property
-    def texture_data(self):
-        self.side_texture = get_texture_coordinates(self.growth_stage, 9)
-        self.front_texture = self.side_texture
-        return self.get_texture_data()
+    def texture_data_for(self, growth_stage):
+        return self.stage_texture_data(get_texture_coordinates(growth_stage, 9))
 
-    @property
-    def drop_id(self):
+    def drop_id_for(self, growth_stage):
         return BlockID(391)
 
-    @drop_id.setter
-    def drop_id(self, value):
-        self._drop_id = value
-
 
 class WheatCropBlock(CropBlock):
     id = 59
@@ -1466,23 +1446,9 @@ class WheatCropBlock(CropBlock):
 
     max_growth_stage = 7
 
-    # special hack to return different texture, which depends on the growth stage
-    @property
-    def texture_data(self):
-        self.side_texture = get_texture_coordinates(14, self.growth_stage)
-        self.front_texture = self.side_texture
-        return self.get_texture_data()
-
-    @property
-    def drop_id(self):
-        if self.growth_stage == self.max_growth_stage:
-            return BlockID(296) # wheat
-        else:
-            return BlockID(295) #seed
-
-    @drop_id.setter
-    def drop_id(self, value):
-        self._drop_id = value
+    # the texture depends on the growth stage
+    def texture_data_for(self, growth_stage):
+        return self.stage_texture_data(get_texture_coordinates(14, growth_stage))
 
 class TallGrassBlock(Block):
     width = 0.9
@@ -1716,11 +1682,6 @@ class BedBlock(Block):
     def can_place_on(self, block_id):
         return (block_id != 0)
 
-    def set_metadata(self, metadata):
-        print 'metadata: ', metadata
-        if self.sub_id_as_metadata:
-            self.id.sub = metadata
-
 CRACK_LEVELS = 10
 
 
@@ -0,0 +1,34 @@
+import cython
+
+#cython: boundscheck=False
+#cython: wraparound=False
+#cython: cdivision=True
+
+
+cdef class SectorIndex(object):
+    cdef public dict arrays
+
+
+cdef class BlockStorage(object):
+    cdef public:
+        dict sector_arrays
+        dict entities
+        sectors
+
+    @cython.locals(x=int, y=int, z=int, value=int)
+    cpdef int get_metadata(self, tuple position)
+
+    @cython.locals(x=int, y=int, z=int, index=int)
+    cpdef object set_metadata(self, tuple position, int metadata)
+
+    cpdef object drop_sectors(self, sectors)
+
+    cpdef object get(self, tuple position, object default=?)
+
+    @cython.locals(i=int, value=int)
+    cpdef object decode_sector(self, tuple secpos, fstr, bint overwrite=?)
+
+    @cython.locals(column=int, i=int)
+    cpdef object merge_columns(self, tuple secpos, ids, int start, int stop)
+
+    cpdef str encode_sector(self, tuple secpos)
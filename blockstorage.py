@@ -0,0 +1,243 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+from array import array
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+import globals as G
+from sectorcodec import SECTOR_OFFSETS, _swap
+
+
+__all__ = (
+    'BlockStorage', 'SectorIndex',
+)
+
+# Each sector is an array of 512 16-bit block values (main<<8|sub, 0 for
+# air) in SECTOR_OFFSETS order, which is the on-disk sector layout. Sectors
+# are 8x8x8 blocks, so the sector of a position and its place in the array
+# are plain shifts and masks. Values are turned back into the shared
+# registered blocks with G.BLOCKS_BY_VALUE.
+
+AIR_IDS = array('H', [0]) * 512
+
+
+class SectorIndex(object):
+    """
+    The world's `sectors`: which sectors are known, and the positions of the
+    blocks in each. The position lists are built from the sector arrays, so
+    changing them has no effect; assigning a sector only marks it as known.
+    """
+    def __init__(self, storage):
+        self.arrays = storage.sector_arrays
+
+    def __contains__(self, secpos):
+        return secpos in self.arrays
+
+    def __getitem__(self, secpos):
+        ids = self.arrays.setdefault(secpos, None)
+        if ids is None:
+            return []
+        cx, cy, cz = secpos
+        cx, cy, cz = cx * 8, cy * 8, cz * 8
+        offsets = SECTOR_OFFSETS
+        return [(cx + offsets[i][0], cy + offsets[i][1], cz + offsets[i][2])
+                for i, value in enumerate(ids) if value]
+
+    def __setitem__(self, secpos, positions):
+        self.arrays.setdefault(secpos, None)
+
+    def get(self, secpos, default=None):
+        return self[secpos] if secpos in self.arrays else default
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __iter__(self):
+        return iter(self.arrays)
+
+    def keys(self):
+        return self.arrays.keys()
+
+
+class BlockStorage(object):
+    """
+    A mapping of (x, y, z) positions to blocks, storing each sector as an
+    array of block values instead of a dict entry per block. Lookups return
+    the shared registered blocks; the metadata of sub_id_as_metadata blocks
+    is their sub id in the array, and tile entities are kept in the sparse
+    `entities` table. Setting a position to air removes it.
+    """
+    def __init__(self):
+        self.sector_arrays = {}  # Sector position -> array('H'), or None while empty
+        self.entities = {}  # Position -> TileEntity
+        self.sectors = SectorIndex(self)
+
+    def __getitem__(self, position):
+        x, y, z = position
+        ids = self.sector_arrays.get((x >> 3, y >> 3, z >> 3))
+        if ids is not None:
+            value = ids[((x & 7) << 6) | ((y & 7) << 3) | (z & 7)]
+            if value:
+                return G.BLOCKS_BY_VALUE[value]
+        raise KeyError(position)
+
+    def __setitem__(self, position, block):
+        value = block.id.main << 8 | block.id.sub
+        if not value:
+            if position in self:
+                del self[position]
+            return
+        x, y, z = position
+        secpos = (x >> 3, y >> 3, z >> 3)
+        ids = self.sector_arrays.get(secpos)
+        if ids is None:
+            ids = self.sector_arrays[secpos] = array('H', AIR_IDS)
+        ids[((x & 7) << 6) | ((y & 7) << 3) | (z & 7)] = value
+
+    def __delitem__(self, position):
+        x, y, z = position
+        ids = self.sector_arrays.get((x >> 3, y >> 3, z >> 3))
+        index = ((x & 7) << 6) | ((y & 7) << 3) | (z & 7)
+        if ids is None or not ids[index]:
+            raise KeyError(position)
+        ids[index] = 0
+        if self.entities:
+            self.entities.pop(position, None)
+
+    def __contains__(self, position):
+        x, y, z = position
+        ids = self.sector_arrays.get((x >> 3, y >> 3, z >> 3))
+        return ids is not None and ids[((x & 7) << 6) | ((y & 7) << 3) | (z & 7)] != 0
+
+    def get_metadata(self, position):
+        """
+        Returns the metadata of a sub_id_as_metadata block, 0 for other blocks.
+        """
+        x, y, z = position
+        ids = self.sector_arrays.get((x >> 3, y >> 3, z >> 3))
+        if ids is not None:
+            value = ids[((x & 7) << 6) | ((y & 7) << 3) | (z & 7)]
+            if value and G.BLOCKS_BY_VALUE[value].sub_id_as_metadata:
+                return value & 255
+        return 0
+
+    def set_metadata(self, position, metadata):
+        if self[position].sub_id_as_metadata:
+            x, y, z = position
+            ids = self.sector_arrays[(x >> 3, y >> 3, z >> 3)]
+            index = ((x & 7) << 6) | ((y & 7) << 3) | (z & 7)
+            ids[index] = (ids[index] & 0xff00) | metadata
+
+    def drop_sectors(self, sectors):
+        """
+        Forgets sectors and everything in them, without deleting their
+        blocks one by one.
+        """
+        sectors = set(sectors)
+        for secpos in sectors:
+            self.sector_arrays.pop(secpos, None)
+        if self.entities:
+            for position in [position for position in self.entities.keys()
+                             if (position[0] >> 3, position[1] >> 3, position[2] >> 3) in sectors]:
+                del self.entities[position]
+
+    def get(self, position, default=None):
+        try:
+            return self[position]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        # Counted when asked rather than kept up to date, as threads holding
+        # different region locks change the world at the same time
+        return sum(len(ids) - ids.count(0) for ids in self.sector_arrays.values() if ids is not None)
+
+    def iterkeys(self):
+        offsets = SECTOR_OFFSETS
+        for (cx, cy, cz), ids in self.sector_arrays.iteritems():
+            if ids is None:
+                continue
+            cx, cy, cz = cx * 8, cy * 8, cz * 8
+            for i, value in enumerate(ids):
+                if value:
+                    x, y, z = offsets[i]
+                    yield cx + x, cy + y, cz + z
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        for position in self.iterkeys():
+            yield position, self[position]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for position in self.iterkeys():
+            yield self[position]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def decode_sector(self, secpos, fstr, overwrite=True):
+        """
+        Sets a sector from its 1024 byte on-disk string, in one go. Blocks
+        that aren't registered are left out. The blocks already in the
+        sector stay where the string has air, and everywhere unless
+        overwrite is set.
+        """
+        ids = array('H')
+        ids.fromstring(fstr)
+        if _swap:
+            ids.byteswap()
+        blocks_by_value = G.BLOCKS_BY_VALUE
+        for value in set(ids):
+            if value and blocks_by_value[value] is None:
+                print "decode_sector: Invalid Block", (value >> 8, value & 255)
+                for i, other in enumerate(ids):
+                    if other == value:
+                        ids[i] = 0
+        existing = self.sector_arrays.get(secpos)
+        if existing is not None:
+            for i, value in enumerate(existing):
+                if value and (not overwrite or not ids[i]):
+                    ids[i] = value
+        self.sector_arrays[secpos] = ids if ids != AIR_IDS else None
+
+    def merge_columns(self, secpos, ids, start, stop):
+        """
+        Copies the blocks of the columns start to stop - 1 ((x & 7) << 3 |
+        (z & 7)) of a sector's array of block values where the sector has
+        none, like init_block.
+        """
+        existing = self.sector_arrays.get(secpos)
+        if existing is None:
+            if ids.count(0) == len(ids):
+                self.sector_arrays.setdefault(secpos, None)
+                return
+            existing = self.sector_arrays[secpos] = array('H', AIR_IDS)
+        for column in xrange(start, stop):
+            i = (column & 0x38) << 3 | (column & 7)
+            for i in xrange(i, i + 64, 8):
+                if ids[i] and not existing[i]:
+                    existing[i] = ids[i]
+
+    def encode_sector(self, secpos):
+        """
+        Returns the 1024 byte on-disk string of a sector, straight from its
+        array.
+        """
+        ids = self.sector_arrays.get(secpos)
+        if ids is None:
+            ids = AIR_IDS
+        if _swap:
+            ids = array('H', ids)
+            ids.byteswap()
+        return ids.tostring()
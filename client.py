@@ -1,4 +1,5 @@
 # Python packages
+from collections import OrderedDict
 from _socket import SHUT_RDWR
 import socket
 from threading import Thread, Event, Lock
@@ -8,12 +9,11 @@ from warnings import warn
 
 # Modules from this project
 import pyglet
-from blocks import BlockID
+from blocks import BlockID, block_and_metadata
 import globals as G
-from globals import BLOCKS_DIR, SECTOR_SIZE
 from items import ItemStack
 from player import Player
-from savingsystem import null2, structuchar2, sector_to_blockpos
+from sectorcodec import iter_sector_blocks
 from utils import extract_string_packet
 from biome import BiomeGenerator
 
@@ -78,38 +78,28 @@ class PacketReceiver(Thread):
             blocks, sectors = self.world, self.world.sectors
             secpos = struct.unpack("iii", packet[:12])
             sector = sectors[secpos]
-            cx, cy, cz = sector_to_blockpos(secpos)
-            fpos = 12
-            exposed_pos = fpos + 1024
-            for x in xrange(cx, cx+8):
-                for y in xrange(cy, cy+8):
-                    for z in xrange(cz, cz+8):
-                        read = packet[fpos:fpos+2]
-                        fpos += 2
-                        unpacked = structuchar2.unpack(read)
-                        if read != null2 and unpacked in BLOCKS_DIR:
-                            position = x,y,z
-                            try:
-                                blocks[position] = BLOCKS_DIR[unpacked]
-                                if blocks[position].sub_id_as_metadata:
-                                    blocks[position] = type(BLOCKS_DIR[unpacked])()
-                                    blocks[position].set_metadata(0)
-                            except KeyError:
-                                main_blk = BLOCKS_DIR[(unpacked[0], 0)]
-                                if main_blk.sub_id_as_metadata: # sub id is metadata
-                                    blocks[position] = type(main_blk)()
-                                    blocks[position].set_metadata(unpacked[-1])
-                            sector.append(position)
-                            if packet[exposed_pos] is "1":
-                                blocks.show_block(position)
-                        exposed_pos += 1
+            exposed = packet[12+1024:]
+            for index, position, unpacked in iter_sector_blocks(buffer(packet, 12, 1024), secpos):
+                try:
+                    block, metadata = block_and_metadata(unpacked)
+                except KeyError:
+                    continue
+                blocks[position] = block
+                if metadata:
+                    blocks.metadata[position] = metadata
+                sector[position] = None
+                if ord(exposed[index >> 3]) >> (index & 7) & 1:
+                    blocks.show_block(position)
+            self.world.heightmap.add_sectors((secpos,))
             if secpos in self.world.sector_queue:
                 del self.world.sector_queue[secpos] #Delete any hide sector orders
         elif packetid == 2:  # Blank Sector
-            self.world.sectors[struct.unpack("iii", packet)] = []
+            secpos = struct.unpack("iii", packet)
+            self.world.sectors[secpos] = OrderedDict()
+            self.world.heightmap.add_sectors((secpos,))
         elif packetid == 3:  # Add Block
             self.world._add_block(struct.unpack("iii", packet[:12]),
-                BLOCKS_DIR[struct.unpack("BB", packet[12:])])
+                *block_and_metadata(struct.unpack("BB", packet[12:])))
         elif packetid == 4:  # Remove Block
             self.world._remove_block(struct.unpack("iii", packet))
         elif packetid == 5:  # Chat Print
@@ -147,7 +137,8 @@ class PacketReceiver(Thread):
         elif packetid == 9:  # Player Jump
             self.controller.player_ids[struct.unpack("H", packet)[0]].dy = 0.016
         elif packetid == 10: # Update Tile Entity
-            self.world[struct.unpack("iii", packet[:12])].update_tile_entity(packet[12:])
+            position = struct.unpack("iii", packet[:12])
+            self.world[position].update_tile_entity(self.world, position, packet[12:])
         elif packetid == 255:  # Spawn Position
             self.controller.player.position = struct.unpack("iii", packet[:12])
             packet = packet[12:]
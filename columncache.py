@@ -0,0 +1,110 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+from collections import OrderedDict
+import threading
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+# Nothing for now...
+
+
+__all__ = (
+    'Column', 'ColumnCache',
+)
+
+
+class Column(object):
+    """
+    The generation inputs of a sector column (the 8x8 block columns of a
+    stack of sectors): its climate, its biome and the heights of its block
+    columns, computed by the first sector that needs them.
+    """
+    __slots__ = ('temperature', 'humidity', 'biome', 'heights')
+
+    def __init__(self, temperature, humidity, biome):
+        self.temperature = temperature
+        self.humidity = humidity
+        self.biome = biome
+        self.heights = None  # (BiomeParameters, their get_heights of the column), see ColumnCache.heights
+
+
+class ColumnCache(object):
+    """
+    An LRU of the Columns of a terrain generator, shared by its
+    generate_sector calls, so the sectors of a column don't each evaluate
+    the same noise again.
+
+    Heights depend on the BiomeParameters they are computed for. Those of
+    the column's biome are the same for every sector of the column, unless
+    generate_sector is given other biomes: a Column keeps the heights of
+    the last BiomeParameters asked for.
+
+    Counts hits and misses of columns and of their heights, see stats().
+    """
+    def __init__(self, generator, size):
+        self.generator = generator
+        self.size = size
+        self.columns = OrderedDict()  # (cx, cz) -> Column, least recently used first
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.height_hits = 0
+            self.height_misses = 0
+
+    def stats(self):
+        """
+        Returns the hits and misses of columns and of their heights, and
+        how many columns are cached.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'height_hits': self.height_hits,
+                'height_misses': self.height_misses,
+                'columns': len(self.columns),
+            }
+
+    def column(self, cx, cz):
+        """ Returns the Column of sector column cx, cz """
+        key = (cx, cz)
+        with self.lock:
+            column = self.columns.pop(key, None)
+            if column is not None:
+                self.hits += 1
+                self.columns[key] = column
+                return column
+            self.misses += 1
+        biomes = self.generator.biome_generator
+        temperature = biomes.get_temperature(cx, cz)
+        humidity = biomes.get_humidity(cx, cz)
+        column = Column(temperature, humidity, biomes.classify(temperature, humidity))
+        with self.lock:
+            # Another thread may have made it meanwhile
+            column = self.columns.setdefault(key, column)
+            while len(self.columns) > self.size:
+                self.columns.popitem(last=False)
+        return column
+
+    def heights(self, column, cx, cz, parameters):
+        """
+        Returns the heights of a Column (of sector column cx, cz) for the
+        BiomeParameters of its biome, in get_heights order.
+        """
+        cached = column.heights
+        if cached is not None and cached[0] is parameters:
+            with self.lock:
+                self.height_hits += 1
+            return cached[1]
+        with self.lock:
+            self.height_misses += 1
+        heights = self.generator.get_heights(cx * 8, cz * 8, parameters=parameters)
+        column.heights = parameters, heights
+        return heights
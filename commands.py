@@ -206,4 +206,4 @@ class SaveCommand(Command):
     help_text = "$$ysave: Save the game."
 
     def execute(self):
-        save_world(G.SERVER, "world")
\ No newline at end of file
+        save_world(G.SERVER, "world", wait=False)
\ No newline at end of file
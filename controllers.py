@@ -184,6 +184,7 @@ class GameController(Controller):
 
     def update_block_remove(self, dt, hit_block):
         if self.block_damage >= hit_block.hardness:
+            drop_id = hit_block.drop_id_for(self.world.get_metadata(self.highlighted_block))
             self.world.remove_block(self.player,
                                     self.highlighted_block)
             self.set_highlighted_block(None)
@@ -192,13 +193,13 @@ class GameController(Controller):
                 if self.item_list.get_current_block_item().durability <= 0:
                     self.item_list.remove_current_block()
                     self.item_list.update_items()
-            if hit_block.drop_id is None:
+            if drop_id is None:
                 return
-            if type(hit_block.drop_id) == list:
-                for index, item in enumerate(hit_block.drop_id):
+            if type(drop_id) == list:
+                for index, item in enumerate(drop_id):
                     if not self.player.add_item(item, quantity=hit_block.drop_quantity[index]):
                         return
-            elif not self.player.add_item(hit_block.drop_id, quantity=hit_block.drop_quantity):
+            elif not self.player.add_item(drop_id, quantity=hit_block.drop_quantity):
                     return
             self.item_list.update_items()
             self.inventory_list.update_items()
@@ -422,7 +423,7 @@ class GameController(Controller):
                 self.inventory_list.toggle(False)
             elif hit_block.id == furnace_block.id:
                 self.inventory_list.switch_mode(2)
-                self.inventory_list.set_furnace(hit_block)
+                self.inventory_list.set_furnace(self.world.entities[block])
                 self.inventory_list.toggle(False)
             elif hit_block.density >= 1:
                self.put_block(previous)
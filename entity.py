@@ -11,7 +11,7 @@ import struct
 # Nothing for now...
 import globals as G
 from physics import physics_manager
-from utils import make_nbt_from_dict
+from utils import make_nbt_from_dict, sectorize
 
 
 __all__ = (
@@ -81,12 +81,15 @@ class TileEntity(Entity):
     """
     A Tile entity is extra data associated with a block
     """
+    server_only = False  # The client keeps a bare TileEntity for the blocks instead
+
     def __init__(self, world, position):
         super(TileEntity, self).__init__(position, rotation=(0,0))
         self.world = world
 
 # server-side only
 class CropEntity(TileEntity):
+    server_only = True
     # seconds per stage
     grow_time = 10
     grow_task = None
@@ -104,13 +107,15 @@ class CropEntity(TileEntity):
             G.SERVER.hide_block(self.position)
 
     def grow_callback(self):
-        if self.position in self.world:
-            self.world[self.position].growth_stage = self.world[self.position].growth_stage + 1
-            G.SERVER.update_tile_entity(self.position, make_nbt_from_dict({'growth_stage': self.world[self.position].growth_stage}))
+        if self.world.entities.get(self.position) is self:
+            growth_stage = self.world.get_metadata(self.position) + 1
+            self.world.set_metadata(self.position, growth_stage)
+            self.world.dirty_sectors.add(sectorize(self.position))
+            G.SERVER.update_tile_entity(self.position, make_nbt_from_dict({'growth_stage': growth_stage}))
         else:
             # the block ceased to exist
             return
-        if self.world[self.position].growth_stage < self.world[self.position].max_growth_stage:
+        if growth_stage < self.world[self.position].max_growth_stage:
             self.grow_task = G.main_timer.add_task(self.grow_time, self.grow_callback)
         else:
             self.grow_task = None
@@ -119,9 +124,11 @@ class CropEntity(TileEntity):
     def fertilize(self):
         if self.grow_task is not None:
             G.main_timer.remove_task(self.grow_task)
-        if self.position in self.world:
-            self.world[self.position].growth_stage = self.world[self.position].max_growth_stage
-            G.SERVER.update_tile_entity(self.position, make_nbt_from_dict({'growth_stage': self.world[self.position].growth_stage}))
+        if self.world.entities.get(self.position) is self:
+            growth_stage = self.world[self.position].max_growth_stage
+            self.world.set_metadata(self.position, growth_stage)
+            self.world.dirty_sectors.add(sectorize(self.position))
+            G.SERVER.update_tile_entity(self.position, make_nbt_from_dict({'growth_stage': growth_stage}))
         else:
             # the block ceased to exist
             return
@@ -138,6 +145,8 @@ class FurnaceEntity(TileEntity):
     outcome_callback = None
     fuel_callback = None
 
+    slot_count = 2
+
     def __del__(self):
         if self.fuel_task is not None:
             G.main_timer.remove_task(self.fuel_task)
@@ -156,6 +165,72 @@ class FurnaceEntity(TileEntity):
 
         return self.smelt_outcome.get_object().max_stack_size < self.smelt_outcome.amount + reserve
 
+    # compatible with inventory
+    def set_slot(self, index, value):
+        i = int(index)
+        if i < 0 or i >= 2:
+            return None
+        if i == 0:
+            self.set_smelting_item(value)
+        else:
+            self.set_fuel(value)
+
+    def at(self, index):
+        i = int(index)
+        if i < 0 or i >= 2:
+            return None
+        return self.fuel if i == 1 else self.smelt_stack
+
+    def remove_all_by_index(self, index):
+        i = int(index)
+        if i < 0 or i >= 2:
+            return None
+        if i == 0:
+            self.smelt_stack = None
+        else:
+            self.fuel = None
+
+    def get_items(self):
+        return [self.smelt_stack, self.fuel]
+
+    def remove_unnecessary_stacks(self):
+        if self.fuel is not None:
+            if self.fuel.amount == 0:
+                self.fuel = None
+        if self.smelt_stack is not None:
+            if self.smelt_stack.amount == 0:
+                self.smelt_stack = None
+
+    def set_smelting_item(self, item):
+        if item is None:
+            return
+        self.smelt_stack = item
+        self.outcome_item = G.smelting_recipes.smelt(self.smelt_stack.get_object())
+        # no such recipe
+        if self.outcome_item is None:
+            return
+        else:
+            self.smelt()
+
+    def set_fuel(self, fuel):
+        if fuel is None:
+            return
+        self.fuel = fuel
+        # invalid fuel
+        if self.fuel.get_object().burning_time == -1:
+            return
+        else:
+            self.smelt()
+
+    def set_outcome_callback(self, callback):
+        self.outcome_callback = callback
+
+    def set_fuel_callback(self, callback):
+        self.fuel_callback = callback
+
+    def get_smelt_outcome(self):
+        return self.smelt_outcome
+
 
     def smelt_done(self):
         self.smelt_task = None
@@ -0,0 +1,106 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+import multiprocessing
+import signal
+import threading
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+from debug import log_warning
+import globals as G
+from terrain import RegenerationWorld
+
+
+__all__ = (
+    'GenerationService', 'generate_sectors',
+)
+
+_worker_world = None  # The RegenerationWorld of a worker process
+
+
+def _init_worker(seed):
+    global _worker_world
+    # Ctrl+C is for the server, which stops the pool; a worker dying of it
+    # would lose its job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    G.SEED = seed
+    _worker_world = RegenerationWorld(seed)
+
+
+def generate_sectors(sectors, world=None):
+    """
+    Generates sectors from scratch in a RegenerationWorld (the worker
+    process's by default) and returns [(secpos, on-disk string, requested)]
+    for each of them, then for the sectors around them that their
+    vegetation grew into.
+    """
+    if world is None:
+        world = _worker_world
+    world.sector_arrays.clear()
+    world.entities.clear()
+    for sector in sectors:
+        world.terraingen.generate_sector(sector)
+    requested = set(sectors)
+    return [(secpos, world.encode_sector(secpos), True) for secpos in sectors] + \
+           [(secpos, world.encode_sector(secpos), False) for secpos, ids in world.sector_arrays.iteritems()
+            if secpos not in requested and ids is not None]
+
+
+class GenerationService(object):
+    """
+    Generates terrain in a pool of worker processes, so it runs on every
+    core instead of holding the GIL of the server. Workers return encoded
+    sectors, which WorldServer.merge_generated adds to the world in bulk.
+
+    The pool is started by start(), before the server's threads, with as
+    many workers as G.GENERATION_PROCESSES asks for. While `pool` is None
+    the server generates in its own threads, as it always did.
+    """
+    def __init__(self, seed, processes):
+        self.seed = seed
+        self.processes = processes  # 0 for no pool, -1 for one worker per core
+        self.workers = 0  # In the pool
+        self.pool = None
+        self.lock = threading.Lock()  # So jobs aren't sent to a pool that stop() terminated
+
+    def start(self):
+        processes = self.processes
+        if processes < 0:
+            processes = multiprocessing.cpu_count()
+        if processes and self.pool is None:
+            self.pool = multiprocessing.Pool(processes, _init_worker, (self.seed,))
+            self.workers = processes
+
+    def stop(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+                self.workers = 0
+
+    def generate(self, sectors):
+        """
+        Returns generate_sectors(sectors), made by a worker, or None if the
+        pool is stopped or the worker takes more than G.GENERATION_TIMEOUT:
+        a worker that dies never returns, and neither do the jobs of a
+        stopped pool.
+        """
+        with self.lock:
+            if self.pool is None:
+                return None
+            result = self.pool.apply_async(generate_sectors, (list(sectors),))
+        try:
+            return result.get(G.GENERATION_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            log_warning('Generation: no answer from the pool after %d s' % G.GENERATION_TIMEOUT)
+            return None
+
+    def generate_many(self, jobs):
+        """
+        Yields generate_sectors of each list of sectors in jobs, as the
+        workers finish them, in any order.
+        """
+        return self.pool.imap_unordered(generate_sectors, [list(sectors) for sectors in jobs])
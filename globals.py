@@ -87,6 +87,17 @@ KEY_BINDINGS = dict(
 DISABLE_SAVE = True
 SAVE_FILENAME = None
 DB_NAME = 'world.db'
+AUTOSAVE_INTERVAL = 300  # in seconds; a negative value disables the autosave
+REGION_COMPRESSION_LEVEL = 6  # zlib level for region file sectors, 0 stores them uncompressed
+REGION_MAP_CACHE_SIZE = 16  # How many region files are kept memory-mapped for reading
+REGION_HANDLE_CACHE_SIZE = 16  # How many region files are kept open for writing
+# Store saved sectors as diffs against what terrain generation produces there, so
+# unmodified sectors take a few bytes. Generation must then stay exactly the same
+# for the world's seed: changing the terrain generator corrupts such worlds.
+SECTOR_DIFFS = False
+JOURNAL_COMMIT_INTERVAL = 0.2  # in seconds; block edits are made durable together at this interval
+RESIDENT_MEMORY_BUDGET = 512  # in MB; the server evicts the regions nobody uses above this, 0 disables it
+EVICTION_INTERVAL = 10  # in seconds; how often the server checks its memory budget
 
 # Game engine
 SECTOR_SIZE = 8
@@ -94,6 +105,8 @@ TILESET_SIZE = 16  # The tileset therefore contains TILESET_SIZE ** 2 tiles.
 
 # Game logic
 BLOCKS_DIR = {}  # Block ID => block object
+BLOCKS_BY_VALUE = [None] * 65536  # main<<8|sub => block object, see blocks.register_block
+BLOCKS_LIST = []  # Dense block index => block object
 ITEMS_DIR = {}  # Item ID => item object
 
 VERTEX_CUBE = 'cube'
@@ -146,6 +159,9 @@ SEED = None
 TREE_CHANCE = 0.006
 WILDFOOD_CHANCE = 0.0005
 GRASS_CHANCE = 0.05
+COLUMN_CACHE_SIZE = 1024  # How many sector columns keep their heights and biome for generation
+GENERATION_PROCESSES = -1  # Worker processes generating terrain for the server; -1 for one per core, 0 for none
+GENERATION_TIMEOUT = 30  # in seconds; after this a region is generated by the server itself, in case its worker died
 
 # Biome
 DESERT, PLAINS, MOUNTAINS, SNOW, FOREST, ISLAND, NETHER = range(7)
@@ -287,7 +303,7 @@ def initialize_config():
     #
     # General
     #
-    global DEBUG, FULLSCREEN, WINDOW_WIDTH, WINDOW_HEIGHT, DRAW_DISTANCE_CHOICE, DRAW_DISTANCE_CHOICES, DRAW_DISTANCE, MOTION_BLUR, FOG_ENABLED, TEXTURE_PACK, USERNAME, IP_ADDRESS, LANGUAGE
+    global DEBUG, FULLSCREEN, WINDOW_WIDTH, WINDOW_HEIGHT, DRAW_DISTANCE_CHOICE, DRAW_DISTANCE_CHOICES, DRAW_DISTANCE, MOTION_BLUR, FOG_ENABLED, TEXTURE_PACK, USERNAME, IP_ADDRESS, LANGUAGE, AUTOSAVE_INTERVAL, SECTOR_DIFFS, RESIDENT_MEMORY_BUDGET
 
     general = 'General'
 
@@ -332,6 +348,14 @@ def initialize_config():
     # TODO: This setting must be removed when terrain generation will improve.
     get_or_update_config(world, 'size', 64, conv=int)
 
+    AUTOSAVE_INTERVAL = get_or_update_config(
+        world, 'autosave_interval', AUTOSAVE_INTERVAL, conv=int)
+    SECTOR_DIFFS = get_or_update_config(
+        world, 'sector_diffs', SECTOR_DIFFS, conv=bool)
+    # Read as a string, since every falsy value takes the default and 0 disables eviction
+    RESIDENT_MEMORY_BUDGET = int(get_or_update_config(
+        world, 'resident_memory_budget', str(RESIDENT_MEMORY_BUDGET)))
+
     #
     # Controls
     #
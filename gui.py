@@ -467,7 +467,7 @@ class InventorySelector(AbstractInventory):
         self.crafting_panel = Inventory(4)
         self.crafting_outcome = None  # should be an item stack
         self.crafting_table_panel = Inventory(9)
-        self.furnace_panel = None   # should be a FurnaceBlock
+        self.furnace_panel = None   # should be a FurnaceEntity
         self.visible = False
         self.slots = None
         # slots for inventory and crafting table
@@ -0,0 +1,263 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+from array import array
+import os
+import sys
+import threading
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+# Nothing for now...
+
+
+__all__ = (
+    'HeightMap', 'NO_BLOCK',
+)
+
+# The columns are kept in chunks of 8x8, the columns of a stack of sectors.
+# A chunk is an array of 128 heights: the top block of column i (x & 7) << 3
+# | (z & 7), then the top opaque block of that column at 64 + i.
+#
+# Saved chunks are grouped by region column (4x4 chunks, 32x32 blocks), one
+# file each, holding the 16 chunks in (cx & 3) << 2 | (cz & 3) order as
+# big-endian 32-bit heights; chunks that were never saved are all NO_BLOCK.
+
+NO_BLOCK = -(1 << 31)  # No block in the column, as far as is known
+EMPTY_CHUNK = array('i', [NO_BLOCK]) * 128
+CHUNK_BYTES = EMPTY_CHUNK.itemsize * 128
+
+_swap = sys.byteorder == 'little'  # array('i') is native endian
+
+
+def encode_chunk(chunk):
+    chunk = array('i', chunk)
+    if _swap:
+        chunk.byteswap()
+    return chunk.tostring()
+
+
+class HeightMap(object):
+    """
+    The highest block and the highest opaque block of each (x, z) column of
+    a world, kept up to date by the world as blocks are added and removed.
+
+    Sectors the world doesn't have (yet) are skipped when a column's top
+    block is removed: the column's height is then the top of the highest
+    missing sector, an upper bound, until add_sectors() is told it arrived.
+    """
+    def __init__(self, world, directory=None):
+        self.world = world
+        self.directory = directory  # Where the chunks are saved, None to keep them in memory
+        self.chunks = {}  # (cx, cz) -> array('i') of 128 heights
+        self.files_read = set()  # The region columns read from disk
+        self.dirty = set()  # Chunks changed since the last snapshot
+        self.saving = {}  # Chunk -> how many snapshots of it aren't written yet
+        self.lock = threading.Lock()
+
+    def get(self, x, z, opaque=False):
+        """
+        Returns the y of the highest (opaque) block of the column, or None.
+        """
+        chunk = self.chunks.get((x >> 3, z >> 3))
+        if chunk is None:
+            with self.lock:
+                chunk = self._chunk(x >> 3, z >> 3)
+            if chunk is None:
+                return None
+        y = chunk[(64 if opaque else 0) + (((x & 7) << 3) | (z & 7))]
+        return None if y == NO_BLOCK else y
+
+    def block_added(self, position, block):
+        x, y, z = position
+        key = (x >> 3, z >> 3)
+        i = ((x & 7) << 3) | (z & 7)
+        with self.lock:
+            chunk = self._chunk(x >> 3, z >> 3, create=True)
+            if y > chunk[i]:
+                chunk[i] = y
+                self.dirty.add(key)
+            if y > chunk[64 + i] and not block.transparent:
+                chunk[64 + i] = y
+                self.dirty.add(key)
+
+    def block_removed(self, position):
+        # Called once the block is gone from the world
+        x, y, z = position
+        key = (x >> 3, z >> 3)
+        i = ((x & 7) << 3) | (z & 7)
+        with self.lock:
+            chunk = self._chunk(x >> 3, z >> 3)
+            if chunk is None:
+                return
+            if chunk[i] == y:
+                chunk[i] = self._scan(x, y - 1, z, False)
+                self.dirty.add(key)
+            if chunk[64 + i] == y:
+                chunk[64 + i] = self._scan(x, y - 1, z, True)
+                self.dirty.add(key)
+
+    def add_sectors(self, sectors):
+        """
+        Takes in sectors the world just loaded or received without adding
+        their blocks one by one.
+        """
+        known = self.world.sectors
+        with self.lock:
+            for cx, cy, cz in sectors:
+                if (cx, cy, cz) not in known:
+                    continue
+                low, high = cy * 8, cy * 8 + 7
+                chunk = self._chunk(cx, cz, create=True)
+                changed = False
+                for i in xrange(128):
+                    top = chunk[i]
+                    if top > high:
+                        continue
+                    x, z, opaque = cx * 8 + ((i >> 3) & 7), cz * 8 + (i & 7), i >= 64
+                    if top >= low:
+                        # The top was in the sector, or below the sectors missing until now
+                        y = self._scan(x, high, z, opaque)
+                    else:
+                        y = self._highest(x, z, high, low, opaque)
+                        if y < top:
+                            continue
+                    if y != top:
+                        chunk[i] = y
+                        changed = True
+                if changed:
+                    self.dirty.add((cx, cz))
+
+    def _highest(self, x, z, high, low, opaque):
+        # The highest (opaque) block of the column between high and low,
+        # both in the same sector
+        get = self.world.get
+        for y in xrange(high, low - 1, -1):
+            block = get((x, y, z))
+            if block is not None and not (opaque and block.transparent):
+                return y
+        return NO_BLOCK
+
+    def _scan(self, x, y, z, opaque):
+        # The highest (opaque) block of the column at or below y, or the top
+        # of the highest missing sector on the way
+        sectors = self.world.sectors
+        while 1:
+            if (x >> 3, y >> 3, z >> 3) not in sectors:
+                return y
+            low = y & ~7
+            found = self._highest(x, z, y, low, opaque)
+            if found != NO_BLOCK:
+                return found
+            y = low - 1
+
+    def _chunk(self, cx, cz, create=False):
+        # Must be called with the lock held
+        chunk = self.chunks.get((cx, cz))
+        if chunk is None and self.directory is not None and (cx >> 2, cz >> 2) not in self.files_read:
+            self._read_file(cx >> 2, cz >> 2)
+            chunk = self.chunks.get((cx, cz))
+        if chunk is None and create:
+            chunk = self.chunks[(cx, cz)] = array('i', EMPTY_CHUNK)
+        return chunk
+
+    def file_path(self, column):
+        return os.path.join(self.directory, "%i.%i.hm" % column)
+
+    def _read_file(self, rx, rz):
+        self.files_read.add((rx, rz))
+        path = self.file_path((rx, rz))
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        for slot in xrange(16):
+            chunk = array('i', data[slot * CHUNK_BYTES:(slot + 1) * CHUNK_BYTES])
+            if _swap:
+                chunk.byteswap()
+            if chunk != EMPTY_CHUNK:
+                self.chunks.setdefault((rx * 4 + (slot >> 2), rz * 4 + (slot & 3)), chunk)
+
+    def snapshot(self):
+        """
+        Returns {(cx, cz): encoded chunk} for the chunks changed since the
+        last snapshot, for save_chunks(). saved() must be called once it is
+        written, or failed to be.
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            saving = self.saving
+            for key in dirty:
+                saving[key] = saving.get(key, 0) + 1
+            return dict((key, encode_chunk(self.chunks[key])) for key in dirty)
+
+    def saved(self, chunks, written=True):
+        """
+        Called with a snapshot() once save_chunks() wrote it, or with
+        written False if it didn't, so its chunks are saved next time.
+        """
+        with self.lock:
+            if not written:
+                self.dirty.update(chunks)
+            saving = self.saving
+            for key in chunks:
+                if saving[key] == 1:
+                    del saving[key]
+                else:
+                    saving[key] -= 1
+
+    def drop_columns(self, columns):
+        """
+        Forgets the chunks of region columns (rx, rz) the world no longer
+        has; they are read again from their file when needed. Columns with
+        chunks that aren't saved yet are kept. Returns how many columns
+        were dropped.
+        """
+        if self.directory is None:
+            return 0  # There would be nothing to read them back from
+        dropped = 0
+        with self.lock:
+            unsaved = set((cx >> 2, cz >> 2) for cx, cz in self.dirty)
+            unsaved.update((cx >> 2, cz >> 2) for cx, cz in self.saving)
+            for column in columns:
+                if column in unsaved:
+                    continue
+                rx, rz = column
+                for slot in xrange(16):
+                    self.chunks.pop((rx * 4 + (slot >> 2), rz * 4 + (slot & 3)), None)
+                self.files_read.discard(column)
+                dropped += 1
+        return dropped
+
+    def save_chunks(self, chunks):
+        """
+        Writes a snapshot() to the files of its region columns. Returns how
+        many bytes were written.
+        """
+        columns = {}
+        for (cx, cz), fstr in chunks.iteritems():
+            columns.setdefault((cx >> 2, cz >> 2), {})[(cx & 3) << 2 | (cz & 3)] = fstr
+        if columns and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        written = 0
+        for column, slots in columns.iteritems():
+            path = self.file_path(column)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    data = f.read()
+            else:
+                data = encode_chunk(EMPTY_CHUNK) * 16
+            data = "".join(slots.get(slot) or data[slot * CHUNK_BYTES:(slot + 1) * CHUNK_BYTES]
+                           for slot in xrange(16))
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)  # Windows won't rename over an existing file, POSIX replaces it atomically
+            os.rename(tmp, path)
+            written += len(data)
+        return written
@@ -180,7 +180,7 @@ class BoneMeal(Item):
     def on_right_click(self, world, player):
         block, previous = world.hit_test(player.position, player.get_sight_vector(), player.attack_range)
         if hasattr(world[block], 'fertilize'):
-            return world[block].fertilize()
+            return world[block].fertilize(world, block)
         else:
             return False
 
@@ -513,7 +513,7 @@ class BedItem(Item):
             return False
 
         world.add_block(feet, bed_block)
-        world[feet].set_metadata(world[feet].get_metadata() | (1 << 7))
+        world.set_metadata(feet, world.get_metadata(feet) | (1 << 7))
         world.add_block(head, bed_block)
 
         return False
@@ -0,0 +1,115 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+import os
+import struct
+import threading
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+import globals as G
+
+
+__all__ = (
+    'JOURNAL_ADD', 'JOURNAL_REMOVE', 'BlockJournal',
+)
+
+# The journal is a directory of numbered segment files, each a sequence of
+# records: B operation, i x, i y, i z, B main id, B sub id (0, 0 for removals).
+# A save rotates to a new segment and deletes the older ones once the regions
+# holding their edits are on disk, so replaying every segment left on startup
+# brings the regions up to date.
+
+JOURNAL_ADD = 1
+JOURNAL_REMOVE = 2
+
+structrecord = struct.Struct("<BiiiBB")
+
+
+class BlockJournal(object):
+    """
+    An append-only log of the block edits of a world.
+    Edits are buffered in memory and written to the current segment by
+    commit(), which the commit thread calls every JOURNAL_COMMIT_INTERVAL
+    seconds: a crash loses at most that much, at the cost of one sequential
+    append and fsync per interval.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.pending = []
+        segments = self.segments()
+        self.number = int(segments[-1][:-4]) + 1 if segments else 0
+        self.file = open(self.segment_path(self.number), "ab")
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, "%08d.log" % number)
+
+    def segments(self):
+        # The segment filenames, oldest first
+        return sorted(filename for filename in os.listdir(self.directory) if filename.endswith(".log"))
+
+    def add(self, position, block_id):
+        record = structrecord.pack(JOURNAL_ADD, position[0], position[1], position[2], block_id.main, block_id.sub)
+        with self.lock:
+            self.pending.append(record)
+
+    def remove(self, position):
+        record = structrecord.pack(JOURNAL_REMOVE, position[0], position[1], position[2], 0, 0)
+        with self.lock:
+            self.pending.append(record)
+
+    def commit(self):
+        """ Writes and fsyncs the buffered edits, as one group """
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        if not self.pending:
+            return
+        self.file.write("".join(self.pending))
+        self.pending = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def rotate(self):
+        """
+        Commits the buffered edits and starts a new segment.
+        Returns the paths of the older segments, to discard() once every
+        edit in them is saved in the region files.
+        """
+        with self.lock:
+            self._commit()
+            self.file.close()
+            self.number += 1
+            self.file = open(self.segment_path(self.number), "ab")
+            return [os.path.join(self.directory, filename) for filename in self.segments()
+                    if filename != os.path.basename(self.file.name)]
+
+    def discard(self, paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def replay(self):
+        """ Yields (operation, position, (main, sub)) for every edit left in the journal, oldest first """
+        with self.lock:
+            self._commit()
+            paths = [os.path.join(self.directory, filename) for filename in self.segments()]
+        for path in paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            # A crash may have cut the last record short
+            for offset in xrange(0, len(data) - structrecord.size + 1, structrecord.size):
+                operation, x, y, z, main, sub = structrecord.unpack_from(data, offset)
+                yield operation, (x, y, z), (main, sub)
+
+    def run(self, stop):
+        # The commit thread, until the stop event is set
+        while not stop.wait(G.JOURNAL_COMMIT_INTERVAL):
+            self.commit()
+        self.commit()
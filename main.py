@@ -24,7 +24,7 @@ import globals as G
 from timer import Timer
 from debug import log_info
 from mod import load_modules
-from savingsystem import save_world
+from savingsystem import save_world, save_writer
 
 
 class Window(pyglet.window.Window):
@@ -140,9 +140,11 @@ def main(options):
     if G.SERVER:
         print 'Saving...'
         save_world(G.SERVER, "world")
+        save_writer.stop()
         print 'Shutting down internal server...'
         G.main_timer.stop()
         G.SERVER._stop.set()
+        G.SERVER.world.generation.stop()
         G.SERVER.shutdown()
 
 if __name__ == '__main__':
@@ -20,7 +20,7 @@ class SmallPlant(object):
     grows_on = grass_block, dirt_block
 
     @classmethod
-    def add_to_world(cls, world, position, sync=False):
+    def add_to_world(cls, world, position, sync=False, rand=random):
         world.add_block(position, cls.block, sync=sync)
 
 
@@ -29,7 +29,7 @@ class Trunk(object):
     height_range = 4, 8
     grows_on = ()
 
-    def __init__(self, position, block=None, height_range=None):
+    def __init__(self, position, block=None, height_range=None, rand=random):
         if block is not None:
             self.block = block
         if height_range is not None:
@@ -37,14 +37,14 @@ class Trunk(object):
 
         x, y, z = position
 
-        self.height = random.randint(*self.height_range)
+        self.height = rand.randint(*self.height_range)
         self.blocks = {}
         for dy in range(self.height):
             self.blocks[(x, y + dy, z)] = self.block
 
     @classmethod
-    def add_to_world(cls, world, position, sync=False):
-        trunk = cls(position)
+    def add_to_world(cls, world, position, sync=False, rand=random):
+        trunk = cls(position, rand=rand)
         for item in trunk.blocks.items():
             world.add_block(*item, sync=sync)
 
@@ -56,9 +56,9 @@ class Tree(object):
     grows_on = grass_block, dirt_block, snowgrass_block
 
     @classmethod
-    def add_to_world(cls, world, position, sync=False):
+    def add_to_world(cls, world, position, sync=False, rand=random):
         trunk = Trunk(position, block=cls.trunk_block,
-                      height_range=cls.trunk_height_range)
+                      height_range=cls.trunk_height_range, rand=rand)
 
         for item in trunk.blocks.items():
             world.add_block(*item, force=False, sync=sync)
@@ -84,7 +84,7 @@ class Tree(object):
                     dz = abs(zl - z)
                     # The farther we are (horizontally) from the trunk,
                     # the least leaves we can find.
-                    if random.uniform(0, dx + dz) > 0.6:
+                    if rand.uniform(0, dx + dz) > 0.6:
                         continue
                     world.add_block((xl, yl, zl), cls.leaf_block, force=False,
                                     sync=sync)
@@ -260,3 +260,22 @@ LEAF_BLOCKS = set(tree.leaf_block for tree in TREES)
 PLANT_BLOCKS = set(plant.block for plant in PLANTS)
 
 VEGETATION_BLOCKS = PLANT_BLOCKS | TREE_BLOCKS | LEAF_BLOCKS
+
+
+def grow_vegetation(world, position, vegetation_class, rand=random):
+    # Adds vegetation_class to the world at position, if it can grow there.
+    # world needs has_neighbors; rand makes the vegetation reproducible.
+    if position in world:
+        return
+
+    # Avoids a tree from touching another.
+    if vegetation_class in TREES and world.has_neighbors(position, is_in=TREE_BLOCKS, diagonals=True):
+        return
+
+    x, y, z = position
+
+    # Vegetation can't grow on anything.
+    if world[(x, y - 1, z)] not in vegetation_class.grows_on:
+        return
+
+    vegetation_class.add_to_world(world, position, rand=rand)
@@ -9,6 +9,11 @@ __version__ = '$Id: perlin.py 521 2008-12-15 03:03:52Z casey.duncan $'
 from math import floor, fmod, sqrt
 from random import randint
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 __all__ = (
     'BaseNoise', 'SimplexNoise', 'TileableNoise',
@@ -23,6 +28,8 @@ _GRAD3 = (
     (1, 1, 0), (0, -1, 1), (-1, 1, 0), (0, -1, -1),
 )
 
+_GRAD3_ARRAY = numpy.array(_GRAD3, dtype=numpy.float64) if numpy is not None else None
+
 # 4D Gradient vectors
 _GRAD4 = (
     (0,  1, 1, 1), (0,  1,  1, -1), (0,  1, -1, 1), (0,  1,  -1, -1),
@@ -222,6 +229,46 @@ class SimplexNoise(BaseNoise):
 
         return noise * 70.0  # scale noise to [-1, 1]
 
+    def noise2_array(self, x, y):
+        """2D Perlin simplex noise of NumPy arrays of coordinates.
+
+        Returns an array of the noise2 values of the x, y pairs, bit for bit:
+        every step is the same floating point operation as in noise2, done
+        element-wise. Needs NumPy.
+        """
+        s = (x + y) * _F2
+        i = numpy.floor(x + s)
+        j = numpy.floor(y + s)
+        t = (i + j) * _G2
+        x0 = x - (i - t)
+        y0 = y - (j - t)
+
+        i1 = (x0 > y0).astype(numpy.int64)
+        j1 = 1 - i1
+
+        x1 = x0 - i1 + _G2
+        y1 = y0 - j1 + _G2
+        x2 = x0 + _G2 * 2.0 - 1.0
+        y2 = y0 + _G2 * 2.0 - 1.0
+
+        perm = numpy.array(self.permutation, dtype=numpy.int64)
+        ii = i.astype(numpy.int64) % self.period
+        jj = j.astype(numpy.int64) % self.period
+        gi0 = perm[ii + perm[jj]] % 12
+        gi1 = perm[ii + i1 + perm[jj + j1]] % 12
+        gi2 = perm[ii + 1 + perm[jj + 1]] % 12
+
+        grad = _GRAD3_ARRAY
+        noise = numpy.zeros(x.shape)
+        # pow, like ** on floats, so the results match noise2 exactly
+        for xn, yn, gi in ((x0, y0, gi0), (x1, y1, gi1), (x2, y2, gi2)):
+            tt = 0.5 - numpy.power(xn, 2.0) - numpy.power(yn, 2.0)
+            g = grad[gi]
+            corner = numpy.power(tt, 4.0) * (g[..., 0] * xn + g[..., 1] * yn)
+            noise = numpy.where(tt > 0, noise + corner, noise)
+
+        return noise * 70.0
+
     def noise3(self, x, y, z):
         """3D Perlin simplex noise.
         
@@ -0,0 +1,135 @@
+"""
+Generates the terrain around a point ahead of time and saves it, so players
+don't wait for open_sector the first time they get there.
+
+Usage: python pregen.py [--x X] [--z Z] [--radius R] [--processes N] [--seed SEED]
+The server console runs it too, as "pregen X Z R". It can be interrupted:
+the regions saved so far are skipped when it runs again.
+"""
+
+# Imports, sorted alphabetically.
+
+# Python packages
+import argparse
+import threading
+import time
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+from debug import log_info
+import globals as G
+from residency import region_sectors
+
+
+__all__ = (
+    'pregen_regions', 'pregenerate', 'OfflineServer',
+)
+
+# How many regions are generated between two saves, per worker
+BATCH_PER_WORKER = 4
+
+
+def pregen_regions(center, radius, height=64):
+    """
+    The regions holding the terrain within radius sectors of the center
+    (x, z) sector, nearest first, from y 0 up to height.
+    """
+    cx, cz = center
+    regions = set()
+    for x in xrange((cx - radius) // 4, (cx + radius) // 4 + 1):
+        for z in xrange((cz - radius) // 4, (cz + radius) // 4 + 1):
+            for y in xrange(0, (height - 1) // 32 + 1):
+                regions.add((x, y, z))
+    return sorted(regions, key=lambda (x, y, z): ((x * 4 + 2 - cx) ** 2 + (z * 4 + 2 - cz) ** 2, y))
+
+
+def pregenerate(world, regions, stop=None, report=log_info):
+    """
+    Generates the regions of world that aren't saved yet, with its
+    GenerationService when it has a pool, and saves them batch by batch,
+    dropping them from memory unless players can see them. Stops after the
+    current batch once the stop event is set. Returns how many regions were
+    generated.
+    """
+    savingsystem = world.savingsystem
+    pending = [region for region in regions if world.missing_sectors(region)]
+    report('Pregen: %d regions to generate, %d already saved' % (len(pending), len(regions) - len(pending)))
+    pool = world.generation.pool
+    batch_size = BATCH_PER_WORKER * max(world.generation.workers, 1)
+    start = time.time()
+    done = sectors = 0
+    while pending and not (stop is not None and stop.is_set()):
+        batch, pending = pending[:batch_size], pending[batch_size:]
+        if pool is not None:
+            jobs = [world.missing_sectors(region) for region in batch]
+            for generated in world.generation.generate_many([job for job in jobs if job]):
+                world.add_generated_region(savingsystem.sector_to_region(generated[0][0]), generated)
+        else:
+            for region in batch:
+                world.open_sector(region_sectors(region)[0])
+        savingsystem.save_blocks(world, G.SAVE_FILENAME)
+        with world.locks.hold(batch):
+            # Like evict_cold_regions, keep what players see or changed meanwhile
+            pinned = world.player_regions()
+            pinned.update(savingsystem.sector_to_region(secpos) for secpos in list(world.dirty_sectors))
+            world.evict_regions([region for region in batch if region not in pinned])
+
+        done += len(batch)
+        sectors += 64 * len(batch)
+        elapsed = time.time() - start
+        remaining = elapsed / done * len(pending)
+        report('Pregen: %d/%d regions, %.1f sectors/s, %d s left'
+               % (done, done + len(pending), sectors / elapsed, remaining))
+    return done
+
+
+class OfflineServer(object):
+    """ What a WorldServer needs of its server, for pregen without a server """
+    def __init__(self):
+        self.players = {}
+        self._stop = threading.Event()
+
+    def show_block(self, position, block, metadata=0):
+        pass
+
+    def hide_block(self, position):
+        pass
+
+
+def main(options):
+    from mod import load_modules
+    from savingsystem import save_writer
+    from world_server import WorldServer
+
+    G.LAUNCH_OPTIONS.seed = options.seed
+    G.SAVE_FILENAME = "world"
+    if options.processes is not None:
+        G.GENERATION_PROCESSES = options.processes
+    load_modules(server=True)
+
+    world = WorldServer(OfflineServer())
+    world.generation.start()
+    try:
+        replayed = world.replay_journal()
+        if replayed:
+            log_info("Replayed %d block edits from the journal" % replayed)
+        pregenerate(world, pregen_regions((options.x, options.z), options.radius))
+    except KeyboardInterrupt:
+        log_info('Pregen: interrupted, saving')
+        world.savingsystem.save_blocks(world, G.SAVE_FILENAME)
+    finally:
+        world.generation.stop()
+        save_writer.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate and save the terrain around a point ahead of time.')
+    parser.add_argument("--x", type=int, default=0, help="The x of the center sector.")
+    parser.add_argument("--z", type=int, default=0, help="The z of the center sector.")
+    parser.add_argument("--radius", type=int, default=16, help="In sectors.")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Worker processes, -1 for one per core (the default), 0 for none.")
+    parser.add_argument("--seed", default=None, help="For a new world.")
+    main(parser.parse_args())
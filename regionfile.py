@@ -0,0 +1,570 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+import argparse
+from array import array
+from collections import OrderedDict
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+import globals as G
+
+
+__all__ = (
+    'REGION_MAGIC', 'REGION_VERSION', 'SECTORS_PER_REGION',
+    'encode_sector', 'is_diff', 'decode_sector', 'RegionHeader', 'RegionMapCache',
+    'RegionFileManager', 'region_files', 'convert_region', 'convert_world',
+)
+
+# Region file layouts
+#
+# Version 1 (no header): 64 raw sectors of 1024 bytes, two bytes (main, sub)
+# per block, in the order of sector_to_offset.
+#
+# Version 2:
+#   header        "PYR2", B version, B flags, 2 pad bytes            8 bytes
+#   offset table  64 x (I offset, I length), length 0 = empty       512 bytes
+#   payloads      one per non-empty sector, anywhere after the table
+#
+# Version 3 (the same magic, told apart by the version byte) adds, between
+# the header and the offset table:
+#   bitmaps       Q presence, Q all air, bit i for sector index i     16 bytes
+#   versions      64 x I content version, bumped by each write       256 bytes
+# A sector is present once it was fully generated; partly generated ones
+# (blocks spilled over from a neighbouring region) are stored but not present.
+# Version 1 and 2 files have every sector present.
+#
+# A payload is a B encoding flag (PAYLOAD_ZLIB, PAYLOAD_DIFF) followed by
+# the body, zlib-compressed if flagged. The body is an H palette size, the
+# palette as (main, sub) byte pairs and the 512 palette indices packed at
+# 0, 1, 2, 4, 8 or 16 bits each.
+# Diff bodies are instead an H change count and that many (H block index,
+# main, sub) changes to the sector generation produces at the same place:
+# an unmodified sector is just three bytes.
+
+REGION_MAGIC = "PYR2"
+REGION_VERSION = 3
+SECTORS_PER_REGION = 64
+SECTOR_BYTES = 1024
+V1_REGION_BYTES = SECTORS_PER_REGION * SECTOR_BYTES
+ALL_SECTORS = (1 << SECTORS_PER_REGION) - 1
+
+PAYLOAD_ZLIB = 1
+PAYLOAD_DIFF = 2
+
+structheader = struct.Struct("4sBBxx")
+structbitmaps = struct.Struct("QQ")
+structversions = struct.Struct("I" * SECTORS_PER_REGION)
+structtable = struct.Struct("II" * SECTORS_PER_REGION)
+structushort = struct.Struct("H")
+structdiff = struct.Struct("H2s")
+BITMAPS_OFFSET = structheader.size
+VERSIONS_OFFSET = BITMAPS_OFFSET + structbitmaps.size
+TABLE_OFFSET = VERSIONS_OFFSET + structversions.size
+HEADER_SIZE = TABLE_OFFSET + structtable.size
+
+null1024 = "\0" * SECTOR_BYTES
+null1024_buffer = buffer(null1024)
+
+# Rewrite a region once less than this fraction of it is live payloads
+COMPACT_RATIO = 0.5
+
+
+def _index_bits(palette_size):
+    for bits in (0, 1, 2, 4, 8):
+        if palette_size <= 1 << bits:
+            return bits
+    return 16
+
+
+def _palette_body(fstr):
+    palette = {}
+    indices = [palette.setdefault(fstr[i:i+2], len(palette)) for i in xrange(0, SECTOR_BYTES, 2)]
+    bits = _index_bits(len(palette))
+    if bits == 16:
+        packed = struct.pack("<512H", *indices)
+    elif bits == 8:
+        packed = "".join(map(chr, indices))
+    elif bits:
+        per_byte = 8 / bits
+        packed = []
+        for i in xrange(0, 512, per_byte):
+            byte = 0
+            for j, index in enumerate(indices[i:i+per_byte]):
+                byte |= index << (j * bits)
+            packed.append(chr(byte))
+        packed = "".join(packed)
+    else:
+        packed = ""
+    return structushort.pack(len(palette)) + "".join(sorted(palette, key=palette.get)) + packed
+
+
+def _diff_body(fstr, baseline):
+    changes = [structdiff.pack(i / 2, fstr[i:i+2]) for i in xrange(0, SECTOR_BYTES, 2)
+               if fstr[i:i+2] != baseline[i:i+2]]
+    return structushort.pack(len(changes)) + "".join(changes)
+
+
+def encode_sector(fstr, compression_level=None, baseline=None):
+    """
+    Encodes a raw 1024 byte sector as a payload, '' if it is all air.
+    Given the raw sector generation produces at the same place, the payload is
+    a diff against it whenever that is smaller.
+    """
+    if fstr == null1024:
+        return ""
+    if compression_level is None: compression_level = G.REGION_COMPRESSION_LEVEL
+    flags, body = 0, _palette_body(fstr)
+    if baseline is not None:
+        diff = _diff_body(fstr, baseline)
+        if len(diff) <= len(body):
+            flags, body = PAYLOAD_DIFF, diff
+    if compression_level:
+        compressed = zlib.compress(body, compression_level)
+        if len(compressed) < len(body):
+            return chr(flags | PAYLOAD_ZLIB) + compressed
+    return chr(flags) + body
+
+
+def is_diff(payload):
+    """ Whether a payload needs the regenerated sector to be decoded """
+    return bool(payload) and bool(ord(payload[0]) & PAYLOAD_DIFF)
+
+
+def decode_sector(payload, baseline=None):
+    """
+    Decodes a payload back into a raw 1024 byte sector.
+    payload may be a str or a buffer over a region mapping; diffs need the
+    baseline they were encoded against.
+    """
+    if not payload:
+        return null1024
+    flags = ord(payload[0])
+    body = buffer(payload, 1)
+    if flags & PAYLOAD_ZLIB:
+        body = zlib.decompress(body)
+    if flags & PAYLOAD_DIFF:
+        if baseline is None:
+            raise ValueError("A sector diff can't be decoded without the regenerated sector")
+        sector = bytearray(baseline)
+        for offset in xrange(2, 2 + structushort.unpack_from(body)[0] * structdiff.size, structdiff.size):
+            index, value = structdiff.unpack_from(body, offset)
+            sector[index*2:index*2+2] = value
+        return str(sector)
+    palette_size = structushort.unpack_from(body)[0]
+    palette_end = 2 + palette_size * 2
+    palette = [body[i:i+2] for i in xrange(2, palette_end, 2)]
+    packed = body[palette_end:]
+    bits = _index_bits(palette_size)
+    if bits == 16:
+        indices = struct.unpack("<512H", packed)
+    elif bits == 8:
+        indices = map(ord, packed)
+    elif bits:
+        mask = (1 << bits) - 1
+        shifts = range(0, 8, bits)
+        indices = [(ord(byte) >> shift) & mask for byte in packed for shift in shifts]
+    else:
+        return palette[0] * 512
+    return "".join([palette[index] for index in indices])
+
+
+def _is_v2(head):
+    # Whether a file has a header, that is whether it is version 2 or later
+    return head[:4] == REGION_MAGIC
+
+
+class RegionHeader(object):
+    """
+    The presence and all air bitmaps, content versions and offset table
+    of a region file.
+    """
+    def __init__(self, present, air, versions, table):
+        self.present = present
+        self.air = air
+        self.versions = versions
+        self.table = table
+
+    @classmethod
+    def parse(cls, data):
+        """ Reads the header at the start of data (a str or a map) of a version 2 or 3 file """
+        if structheader.unpack_from(data)[1] == 2:
+            table = structtable.unpack_from(data, structheader.size)
+            table = [(table[i], table[i+1]) for i in xrange(0, len(table), 2)]
+            air = sum(1 << i for i, (offset, length) in enumerate(table) if not length)
+            return cls(ALL_SECTORS, air, [0] * SECTORS_PER_REGION, table)
+        present, air = structbitmaps.unpack_from(data, BITMAPS_OFFSET)
+        table = structtable.unpack_from(data, TABLE_OFFSET)
+        return cls(present, air, list(structversions.unpack_from(data, VERSIONS_OFFSET)),
+                   [(table[i], table[i+1]) for i in xrange(0, len(table), 2)])
+
+    def pack(self):
+        return structheader.pack(REGION_MAGIC, REGION_VERSION, 0) \
+            + structbitmaps.pack(self.present, self.air) \
+            + structversions.pack(*self.versions) \
+            + structtable.pack(*[value for entry in self.table for value in entry])
+
+    def is_present(self, index):
+        return bool(self.present >> index & 1)
+
+    def is_air(self, index):
+        return bool(self.air >> index & 1)
+
+    def set_sector(self, index, offset, payload, present):
+        # Records a new payload for a sector and bumps its content version
+        bit = 1 << index
+        self.table[index] = (offset if payload else 0, len(payload))
+        self.versions[index] += 1
+        self.present = self.present | bit if present else self.present & ~bit
+        self.air = self.air | bit if present and not payload else self.air & ~bit
+
+
+def _merge_partial(stored, fstr):
+    # Adds the blocks of a partly generated raw sector where the stored raw
+    # sector has air, like init_block
+    merged = array('H')
+    merged.fromstring(str(stored))
+    spilled = array('H')
+    spilled.fromstring(fstr)
+    for i, value in enumerate(spilled):
+        if value and not merged[i]:
+            merged[i] = value
+    return merged.tostring()
+
+
+def _read_header(f):
+    f.seek(0)
+    return RegionHeader.parse(f.read(HEADER_SIZE))
+
+
+class RegionMapCache(object):
+    """
+    A small LRU of read-only memory maps of region files.
+    Evicted maps are only dropped, not closed: buffers handed out by
+    read_region keep their map alive until they are released.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.maps = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            mapping = self.maps.pop(path, None)
+            if mapping is None:
+                with open(path, "rb") as f:
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[path] = mapping
+            while len(self.maps) > self.size:
+                self.maps.popitem(last=False)
+            return mapping
+
+    def invalidate(self, path):
+        """ Forgets the map of a region file about to be written """
+        with self.lock:
+            self.maps.pop(path, None)
+
+
+def _read_payloads(path):
+    # Returns the header and the 64 encoded payloads of a region file,
+    # converting version 1 on the fly
+    with open(path, "rb") as f:
+        head = f.read(structheader.size)
+        if not _is_v2(head):
+            f.seek(0)
+            data = f.read(V1_REGION_BYTES).ljust(V1_REGION_BYTES, "\0")
+            payloads = [encode_sector(data[offset:offset+SECTOR_BYTES])
+                        for offset in xrange(0, V1_REGION_BYTES, SECTOR_BYTES)]
+            air = sum(1 << i for i, payload in enumerate(payloads) if not payload)
+            table = [(0, 0)] * SECTORS_PER_REGION  # Recomputed by _write_payloads
+            return RegionHeader(ALL_SECTORS, air, [0] * SECTORS_PER_REGION, table), payloads
+        header = _read_header(f)
+        payloads = []
+        for offset, length in header.table:
+            f.seek(offset)
+            payloads.append(f.read(length) if length else "")
+        return header, payloads
+
+
+def _write_payloads(path, header, payloads):
+    # Writes a compact region file, replacing any existing one
+    header.table = []
+    offset = HEADER_SIZE
+    for payload in payloads:
+        header.table.append((offset if payload else 0, len(payload)))
+        offset += len(payload)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(header.pack())
+        f.write("".join(payloads))
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)  # Windows won't rename over an existing file, POSIX replaces it atomically
+    os.rename(tmp, path)
+    return offset
+
+
+class RegionFileManager(object):
+    """
+    Keeps the server's region files open between operations: a bounded LRU
+    of read/write handles, the read-only maps used by read_region and which
+    files exist. Payloads are fsync'ed as each region is written, its header
+    only by sync(), once per save.
+    """
+    def __init__(self, handle_count, map_count):
+        self.handle_count = handle_count
+        self.handles = OrderedDict()
+        self.unsynced = set()
+        self.maps = RegionMapCache(map_count)
+        self.existing = {}
+        self.lock = threading.RLock()
+
+    def exists(self, path):
+        with self.lock:
+            exists = self.existing.get(path)
+            if exists is None:
+                exists = self.existing[path] = os.path.lexists(path)
+            return exists
+
+    def header(self, path):
+        """ Returns the RegionHeader of a region file, None if it doesn't exist or has no header """
+        with self.lock:
+            if not self.exists(path):
+                return None
+            mapping = self.maps.get(path)
+            return RegionHeader.parse(mapping) if _is_v2(mapping[:4]) else None
+
+    def sector_flags(self, path, index):
+        """
+        Returns (present, all air) for the sector at index in a region file,
+        from the header bitmaps, without reading the sector.
+        """
+        with self.lock:
+            if not self.exists(path):
+                return False, False
+            mapping = self.maps.get(path)
+            if not _is_v2(mapping[:4]):
+                return True, buffer(mapping, index * SECTOR_BYTES, SECTOR_BYTES) == null1024_buffer
+            if structheader.unpack_from(mapping)[1] == 2:
+                header = RegionHeader.parse(mapping)
+                present, air = header.present, header.air
+            else:
+                present, air = structbitmaps.unpack_from(mapping, BITMAPS_OFFSET)
+            return bool(present >> index & 1), bool(air >> index & 1)
+
+    def read_region(self, path, baseline=None):
+        """
+        Returns a list of the 64 raw 1024 byte sectors stored in a region file,
+        in sector_to_offset order, with None for the empty ones.
+        Reads every version through the maps; version 1 sectors are returned
+        as zero-copy buffers over the map.
+        baseline(index) returns the raw sector generation produces at index,
+        only called for sectors stored as diffs.
+        """
+        with self.lock:  # Not while the save writer is changing the file
+            return self._read_region(path, baseline)
+
+    def _read_region(self, path, baseline):
+        mapping = self.maps.get(path)
+        sectors = []
+        if not _is_v2(mapping[:4]):
+            for offset in xrange(0, min(len(mapping), V1_REGION_BYTES), SECTOR_BYTES):
+                fstr = buffer(mapping, offset, SECTOR_BYTES)
+                sectors.append(fstr if fstr != null1024_buffer else None)
+            sectors += [None] * (SECTORS_PER_REGION - len(sectors))
+            return sectors
+        for index, (offset, length) in enumerate(RegionHeader.parse(mapping).table):
+            if not length:
+                sectors.append(None)
+                continue
+            payload = buffer(mapping, offset, length)
+            if is_diff(payload):
+                if baseline is None:
+                    raise ValueError("%s stores sector diffs, their regenerated sectors are needed" % path)
+                sectors.append(decode_sector(payload, baseline(index)))
+            else:
+                sectors.append(decode_sector(payload))
+        return sectors
+
+    def _handle(self, path):
+        f = self.handles.pop(path, None)
+        if f is None:
+            f = open(path, "rb+")
+        self.handles[path] = f
+        while len(self.handles) > self.handle_count:
+            self._close(*self.handles.popitem(last=False))
+        return f
+
+    def _close(self, path, f):
+        if path in self.unsynced:
+            self.unsynced.discard(path)
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+
+    def _replace(self, path, header, payloads):
+        self.maps.invalidate(path)
+        f = self.handles.pop(path, None)
+        if f is not None:
+            self._close(path, f)
+        written = _write_payloads(path, header, payloads)
+        self.existing[path] = True
+        return written
+
+    def write_region_sectors(self, path, sectors, partial=(), baselines=None, baseline=None):
+        """
+        Stores raw 1024 byte sectors in a region file.
+        sectors maps the sector index within the region (sector_to_offset/1024)
+        to its raw string. The indices in partial are sectors that were only
+        partly generated: they never replace a stored sector, their blocks are
+        added to it where it has air, and they are stored without their
+        presence bit unless the stored sector had it. The sectors baselines
+        maps to the raw sector generation produces there are stored as diffs
+        against it; baseline(index) returns that raw sector too, and is only
+        called for the stored diffs partial sectors are merged into.
+        New payloads are appended and made durable before the header that
+        points at them is written, so a crash leaves either the old or the
+        new header, both pointing at intact payloads. The file is compacted
+        once it is mostly stale data. Files in older versions are upgraded
+        first.
+        Returns the number of bytes written.
+        """
+        if baselines is None: baselines = {}
+        payloads = dict((index, encode_sector(fstr, baseline=baselines.get(index)))
+                        for index, fstr in sectors.iteritems())
+
+        def merge(index, stored):
+            # The payload of partial sector index merged into the stored
+            # payload, None if that changes nothing
+            base = None
+            if is_diff(stored):
+                if baseline is None:
+                    raise ValueError("%s stores sector diffs, their regenerated sectors are needed" % path)
+                base = baseline(index)
+            stored = decode_sector(stored, base)
+            merged = _merge_partial(stored, sectors[index])
+            return encode_sector(merged, baseline=base) if merged != stored else None
+
+        with self.lock:
+            in_place = False
+            if self.exists(path):
+                self.maps.invalidate(path)
+                f = self._handle(path)
+                f.seek(0)
+                head = f.read(structheader.size)
+                in_place = _is_v2(head) and structheader.unpack(head)[1] == REGION_VERSION
+                if not in_place:
+                    header, region = _read_payloads(path)
+            elif any(payloads.itervalues()) or set(payloads).difference(partial):
+                header = RegionHeader(0, 0, [0] * SECTORS_PER_REGION, [(0, 0)] * SECTORS_PER_REGION)
+                region = [""] * SECTORS_PER_REGION
+            else:
+                return 0  # Don't create region files for nothing but partial air
+
+            if not in_place:
+                for index, payload in payloads.iteritems():
+                    present = index not in partial or header.is_present(index)
+                    if index in partial and region[index]:
+                        payload = merge(index, region[index])
+                        if payload is None:
+                            continue
+                    region[index] = payload
+                    header.set_sector(index, 0, payload, present)
+                return self._replace(path, header, region)
+
+            header = _read_header(f)
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            writes = []
+            for index in sorted(payloads):
+                payload = payloads[index]
+                present = index not in partial or header.is_present(index)
+                offset, length = header.table[index]
+                if index in partial and length:
+                    f.seek(offset)
+                    payload = merge(index, f.read(length))
+                    if payload is None:
+                        continue
+                # Never over a live payload: until the new header is on disk,
+                # the old one must still point at intact data
+                offset = end
+                end += len(payload)
+                if payload:
+                    writes.append((offset, payload))
+                header.set_sector(index, offset, payload, present)
+
+            written = 0
+            if writes:
+                f.seek(writes[0][0])
+                for offset, payload in writes:
+                    f.write(payload)
+                    written += len(payload)
+                f.flush()
+                os.fsync(f.fileno())  # The payloads are durable before the header points at them
+            f.seek(0)
+            f.write(header.pack())
+            written += HEADER_SIZE
+            f.flush()  # So the maps see the new data; sync() makes it durable
+            self.unsynced.add(path)
+
+            live = sum(length for offset, length in header.table)
+            if HEADER_SIZE + live < end * COMPACT_RATIO:
+                written += self._replace(path, *_read_payloads(path))
+            return written
+
+    def sync(self):
+        """ Makes every write since the last sync durable """
+        with self.lock:
+            for path in self.unsynced:
+                f = self.handles[path]
+                f.flush()
+                os.fsync(f.fileno())
+            self.unsynced.clear()
+
+    def close(self):
+        """ Closes every handle and forgets every map and existence check """
+        with self.lock:
+            while self.handles:
+                self._close(*self.handles.popitem(last=False))
+            self.maps = RegionMapCache(self.maps.size)
+            self.existing.clear()
+
+
+region_files = RegionFileManager(G.REGION_HANDLE_CACHE_SIZE, G.REGION_MAP_CACHE_SIZE)
+
+
+def convert_region(path):
+    """ Rewrites a region file compactly in the current format """
+    with region_files.lock:
+        return region_files._replace(path, *_read_payloads(path))
+
+
+def convert_world(world_dir):
+    """ Converts every region file of a world, returns (files, bytes before, bytes after) """
+    count = before = after = 0
+    for filename in sorted(os.listdir(world_dir)):
+        if not filename.endswith(".pyr"):
+            continue
+        path = os.path.join(world_dir, filename)
+        before += os.path.getsize(path)
+        after += convert_region(path)
+        count += 1
+    return count, before, after
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert pyCraft region files to the current region format.')
+    parser.add_argument("worlds", nargs="*", default=[os.path.join(G.game_dir, "world")],
+                        help="World directories to convert (default: the server's world).")
+    options = parser.parse_args()
+    for world_dir in options.worlds:
+        count, before, after = convert_world(world_dir)
+        print "%s: converted %d regions, %d bytes -> %d bytes" % (world_dir, count, before, after)
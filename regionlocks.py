@@ -0,0 +1,127 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+from contextlib import contextmanager
+import threading
+import time
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+# Nothing for now...
+
+
+__all__ = (
+    'RegionLocks', 'block_regions', 'region_neighborhood',
+)
+
+
+def block_regions(low, high):
+    """
+    The regions (32x32x32 blocks) holding the blocks between the low and
+    high corners, both included.
+    """
+    xs = xrange(low[0] >> 5, (high[0] >> 5) + 1)
+    ys = xrange(low[1] >> 5, (high[1] >> 5) + 1)
+    zs = xrange(low[2] >> 5, (high[2] >> 5) + 1)
+    return [(x, y, z) for x in xs for y in ys for z in zs]
+
+
+def region_neighborhood(region):
+    """ A region and the 26 regions around it """
+    rx, ry, rz = region
+    return [(x, y, z) for x in xrange(rx - 1, rx + 2)
+            for y in xrange(ry - 1, ry + 2) for z in xrange(rz - 1, rz + 2)]
+
+
+class RegionLocks(object):
+    """
+    One lock per region of a world, so threads working in different parts of
+    the world don't wait for each other. A region's lock only exists while
+    threads hold it or wait for it, so the table stays as small as the
+    regions in use however many are visited. Regions are always locked in sorted
+    order, which is what keeps threads locking several of them (like a tree
+    growing across a region border) from deadlocking. A thread holding
+    regions may lock more of them, as long as they sort after the ones it
+    holds.
+
+    Counts how often and how long threads waited for a region, see stats().
+    """
+    def __init__(self):
+        self.locks = {}  # Region -> [lock, threads holding or waiting for it]
+        self.lock = threading.Lock()  # Guards the lock table and the counters
+        self.held = threading.local()  # The regions locked by the current thread
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.acquisitions = 0
+            self.contended = 0
+            self.wait_time = 0.0
+            self.max_wait = 0.0
+
+    def stats(self):
+        """
+        Returns how many regions were locked, how many of those had to wait
+        for another thread, and the total and longest wait, in seconds.
+        """
+        with self.lock:
+            return {
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+            }
+
+    def acquire(self, region):
+        with self.lock:
+            entry = self.locks.get(region)
+            if entry is None:
+                entry = self.locks[region] = [threading.Lock(), 0]
+            entry[1] += 1
+        lock = entry[0]
+        waited = 0.0
+        if not lock.acquire(False):
+            start = time.time()
+            lock.acquire()
+            waited = time.time() - start
+        with self.lock:
+            self.acquisitions += 1
+            if waited:
+                self.contended += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def release(self, region):
+        with self.lock:
+            entry = self.locks[region]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[region]
+            entry[0].release()
+
+    @contextmanager
+    def hold(self, regions):
+        """
+        Locks regions for the duration of the with block. The ones the
+        thread already holds are skipped.
+        """
+        held = getattr(self.held, 'regions', None)
+        if held is None:
+            held = self.held.regions = set()
+        regions = sorted(set(regions) - held)
+        if regions and held and regions[0] < max(held):
+            raise RuntimeError('Locking region %s while holding %s could deadlock'
+                               % (regions[0], max(held)))
+        acquired = []
+        try:
+            for region in regions:
+                self.acquire(region)
+                held.add(region)
+                acquired.append(region)
+            yield
+        finally:
+            for region in reversed(acquired):
+                held.discard(region)
+                self.release(region)
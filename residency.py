@@ -0,0 +1,88 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+from blockstorage import AIR_IDS
+from heightmap import EMPTY_CHUNK
+
+
+__all__ = (
+    'ResidentSet', 'region_sectors', 'SECTOR_BYTES',
+)
+
+# Memory taken by a sector in BlockStorage: its array, plus its key and slot
+# in the sector dict
+SECTOR_BYTES = sys.getsizeof(AIR_IDS) + 100
+# Memory taken by a chunk of the world's heightmap, the same way
+HEIGHT_CHUNK_BYTES = sys.getsizeof(EMPTY_CHUNK) + 100
+
+# Evict down to this share of the budget, so eviction doesn't run again
+# as soon as a region is loaded
+EVICTION_HEADROOM = 0.9
+
+
+def region_sectors(region):
+    """ The 64 sectors of a region (4x4x4 sectors) """
+    rx, ry, rz = region
+    return [(x, y, z) for x in xrange(rx*4, rx*4+4) for y in xrange(ry*4, ry*4+4) for z in xrange(rz*4, rz*4+4)]
+
+
+class ResidentSet(object):
+    """
+    The regions of a world that are in memory, least recently used first,
+    with the time each was last used. Picks the coldest regions to evict
+    when the world's sectors take more memory than its budget.
+    """
+    def __init__(self, budget):
+        self.budget = budget  # In bytes, 0 for no limit
+        self.last_access = OrderedDict()  # Region -> time it was last used
+        self.lock = threading.Lock()
+
+    def touch(self, region):
+        with self.lock:
+            self.last_access.pop(region, None)
+            self.last_access[region] = time.time()
+
+    def forget(self, region):
+        with self.lock:
+            self.last_access.pop(region, None)
+
+    def used_since(self, region, since):
+        return self.last_access.get(region, 0) > since
+
+    def size(self, world):
+        heightmap = getattr(world, 'heightmap', None)
+        chunks = len(heightmap.chunks) if heightmap is not None else 0
+        return SECTOR_BYTES * sum(1 for ids in world.sector_arrays.values() if ids is not None) \
+            + HEIGHT_CHUNK_BYTES * chunks
+
+    def over_budget(self, world):
+        return bool(self.budget) and self.size(world) > self.budget
+
+    def victims(self, world, pinned):
+        """
+        Returns the least recently used regions, skipping the pinned ones,
+        whose eviction brings the world back under its budget.
+        """
+        arrays = world.sector_arrays
+        excess = self.size(world) - int(self.budget * EVICTION_HEADROOM)
+        victims = []
+        with self.lock:
+            regions = list(self.last_access)
+        for region in regions:
+            if excess <= 0:
+                break
+            if region in pinned:
+                continue
+            victims.append(region)
+            excess -= SECTOR_BYTES * sum(1 for secpos in region_sectors(region)
+                                         if arrays.get(secpos) is not None)
+        return victims
@@ -14,24 +14,34 @@ cpdef int sector_to_offset(tuple secpos)
 @cython.locals(x=int, y=int, z=int)
 cpdef tuple sector_to_blockpos(tuple secpos)
 
-@cython.locals(cx=int, cy=int, cz=int, fstr=str, x=int, y=int, z=int, blk=object)
 cpdef str save_sector_to_string(object blocks, tuple secpos)
 
-cpdef object save_world(object server, str world)
+cpdef object save_world(object server, str world, bint wait=?)
 
-@cython.locals(secpos=tuple, f=object)
-cpdef object save_blocks(object blocks, str world)
+cpdef tuple snapshot_blocks(object blocks)
+
+cpdef object save_blocks_async(object blocks, str world)
+
+cpdef tuple save_blocks(object blocks, str world)
 
 cpdef object save_player(object player, str world)
 
+cpdef object player_store(world=?)
+
+cpdef object close_player_stores()
+
 cpdef bint world_exists(str game_dir, world=?)
 
 cpdef object remove_world(str game_dir, world=?)
 
+cpdef tuple sector_flags(tuple sector, world=?)
+
+cpdef bint region_exists(tuple sector, world=?)
+
 cpdef bint sector_exists(tuple sector, world=?)
 
-@cython.locals(rx=int, ry=int, rz=int, cx=int, cy=int, cz=int, x=int, y=int, z=int, fstr=str,
-				fpos=int, read=str, position=tuple)
+@cython.locals(rx=int, ry=int, rz=int, cx=int, cy=int, cz=int, fstr=object,
+				secpos=tuple, sector=object, full_id=tuple, position=tuple)
 cpdef object load_region(object world, world_name=?, region=?, sector=?)
 
 @cython.locals(version=int)
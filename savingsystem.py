@@ -3,8 +3,10 @@
 # Python packages
 import cPickle as pickle
 import os
+import Queue
 import random
 import struct
+import threading
 import time
 import sqlite3
 
@@ -12,16 +14,22 @@ import sqlite3
 # Nothing for now...
 
 # Modules from this project
-from blocks import BlockID
-from debug import performance_info
+from blocks import BlockID, block_and_metadata
+from blockstorage import BlockStorage
+from debug import performance_info, log_info
 import globals as G
 from player import Player
+import regionfile
+from sectorcodec import encode_sector, iter_sector_blocks
+from terrain import RegenerationWorld
 
 
 __all__ = (
     'sector_to_filename', 'region_to_filename', 'sector_to_region',
     'sector_to_offset', 'save_world', 'world_exists', 'remove_world',
-    'sector_exists', 'load_region', 'open_world',
+    'PlayerStore', 'player_store', 'close_player_stores',
+    'SaveJob', 'SaveWriter', 'save_writer', 'save_blocks', 'save_blocks_async',
+    'sector_flags', 'region_exists', 'sector_exists', 'load_region', 'open_world',
 )
 
 
@@ -34,6 +42,8 @@ null2 = struct.pack("xx") #Two \0's
 null1024 = null2*512      #1024 \0's
 air = G.BLOCKS_DIR[(0,0)]
 
+save_lock = threading.Lock() #Keeps the save writer's queue in snapshot order
+
 def sector_to_filename(secpos):
     x,y,z = secpos
     return "%i.%i.%i.pyr" % (x/4, y/4, z/4)
@@ -54,65 +64,239 @@ def connect_db(world=None):
     world_dir = os.path.join(G.worlds_dir, world)
     if not os.path.exists(world_dir):
         os.makedirs(world_dir)
-    if not os.path.exists(os.path.join(world_dir, G.DB_NAME)):
-        db = sqlite3.connect(os.path.join(world_dir, G.DB_NAME))
+    path = os.path.join(world_dir, G.DB_NAME)
+    create = not os.path.exists(path)
+    #The connection is shared by the server threads, PlayerStore serializes its use
+    db = sqlite3.connect(path, check_same_thread=False)
+    if create:
         db.execute('create table players (id integer primary key autoincrement, version integer, ' + \
             'pos_x real, pos_y real, pos_z real, mom_x real, mom_y real, mom_z real, ' + \
             'inventory varchar(160), name varchar(30) UNIQUE)');
         db.commit()
-        return db
-    return sqlite3.connect(os.path.join(world_dir, G.DB_NAME)) 
+    return db
+
+class PlayerStore(object):
+    """
+    One long-lived connection to a world's player database, in WAL mode.
+    sqlite3 keeps the statements below prepared for the life of the
+    connection; a batch of players is saved with one executemany, in one
+    transaction.
+    """
+    SAVE_PLAYER = 'insert or replace into players(version, pos_x, pos_y, pos_z, mom_x, mom_y, mom_z, inventory, name) ' + \
+        'values (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    LOAD_PLAYER = 'select * from players where name=?'
+
+    def __init__(self, world):
+        self.db = connect_db(world)
+        self.db.execute('pragma journal_mode=WAL')
+        self.db.execute('pragma synchronous=NORMAL')
+        self.lock = threading.Lock()
+
+    def save_players(self, players):
+        #Players that never finished logging in have nothing to save
+        rows = [(1, player.position[0], player.position[1], player.position[2],
+                 player.momentum[0], player.momentum[1], player.momentum[2],
+                 sqlite3.Binary(player.inventory), player.username)
+                for player in players if getattr(player, 'position', None) is not None]
+        with self.lock:
+            with self.db:  # Commits, or rolls back on error
+                self.db.executemany(self.SAVE_PLAYER, rows)
+        return len(rows)
+
+    def load_player(self, player):
+        with self.lock:
+            data = self.db.execute(self.LOAD_PLAYER, (player.username,)).fetchone()
+        if data is None:    # no such entry, set initial value
+            player.position = None
+            player.momentum = (0, 0, 0)
+            player.inventory = ''.join((struct.pack("HBB", 0, 0, 0)) * 40)
+        else:
+            player.position = list(data[i] for i in range(2, 5))
+            player.momentum = list(data[i] for i in range(5, 8))
+            player.inventory = str(data[8])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+player_stores = {}
+player_stores_lock = threading.Lock()
+
+def player_store(world=None):
+    #Returns the shared PlayerStore of a world, opening it on first use
+    if world is None: world = 'world'
+    with player_stores_lock:
+        store = player_stores.get(world)
+        if store is None:
+            store = player_stores[world] = PlayerStore(world)
+        return store
+
+def close_player_stores():
+    with player_stores_lock:
+        for store in player_stores.itervalues():
+            store.close()
+        player_stores.clear()
 
 def save_sector_to_string(blocks, secpos):
-    cx, cy, cz = sector_to_blockpos(secpos)
-    fstr = ""
-    for x in xrange(cx, cx+8):
-        for y in xrange(cy, cy+8):
-            for z in xrange(cz, cz+8):
-                blk = blocks.get((x,y,z), air).id
-                if blk is not air:
-                    #if isinstance(blk, int): # When does this occur? Its expensive and I don't see it triggering
-                    #    blk = BlockID(blk)
-                    fstr += structuchar2.pack(blk.main, blk.sub)
-                else:
-                    fstr += null2
-    return fstr
-
-def save_world(server, world):
+    if isinstance(blocks, BlockStorage):
+        return blocks.encode_sector(secpos)
+    return encode_sector(blocks, secpos)
+
+def save_world(server, world, wait=True):
     #Non block related data
     #save = (4,window.player, window.time_of_day, G.SEED)
     #pickle.dump(save, open(os.path.join(game_dir, world, "save.pkl"), "wb"))
-    for player in server.players:
-        save_player(player, world)
+    player_store(world).save_players(server.players.values())
 
-    save_blocks(server.world, world)
+    if wait:
+        return save_blocks(server.world, world)
+    return save_blocks_async(server.world, world)
 
-def save_blocks(blocks, world):
+class SaveJob(object):
+    """
+    A snapshot of the encoded dirty sectors of a world, and of its changed
+    heightmap chunks, waiting to be written by the SaveWriter. wait() returns
+    how many sectors and bytes were written.
+    """
+    def __init__(self, blocks, world, snapshot, partial, journal_segments, heights):
+        self.blocks = blocks
+        self.world = world
+        self.snapshot = snapshot
+        self.partial = partial
+        self.journal_segments = journal_segments
+        self.heights = heights
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.write()
+        except Exception as e:
+            self.error = e
+            #Nothing of the snapshot is known to be on disk, so save it again next time
+            self.blocks.dirty_sectors.update(self.snapshot)
+        finally:
+            if self.heights:
+                self.blocks.heightmap.saved(self.heights, written=self.error is None)
+            self.done.set()
+
+    def write(self):
+        start = time.time()
+        #Group the sectors by region file, so each region is written once
+        regions = {}
+        partial = {}
+        for secpos, fstr in self.snapshot.iteritems():
+            region, index = sector_to_region(secpos), sector_to_offset(secpos) / 1024
+            regions.setdefault(region, {})[index] = fstr
+            if secpos in self.partial:
+                partial.setdefault(region, set()).add(index)
+
+        sector_count = byte_count = 0
+        region_files = regionfile.region_files
+        for region in sorted(regions):
+            sectors = regions[region]
+            region_partial = partial.get(region, ())
+            baselines = regenerated = None
+            if G.SECTOR_DIFFS:
+                #Fully generated sectors are stored as diffs against their regeneration
+                regenerated = RegeneratedRegion(region)
+                baselines = dict((index, regenerated(index)) for index in sectors if index not in region_partial)
+            written = region_files.write_region_sectors(os.path.join(G.game_dir, self.world, region_to_filename(region)),
+                                                        sectors, region_partial, baselines, regenerated)
+            if written:
+                sector_count += len(sectors)
+                byte_count += written
+        region_files.sync()
+        if self.heights:
+            self.blocks.heightmap.save_chunks(self.heights)
+        #The edits journaled before the snapshot are in the region files now
+        self.blocks.journal.discard(self.journal_segments)
+
+        log_info('Saved %d sectors (%d bytes) in %f seconds.'
+                 % (sector_count, byte_count, time.time() - start))
+        return sector_count, byte_count
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SaveWriter(object):
+    """
+    Writes SaveJobs on a dedicated thread, in the order they were submitted.
+    The thread is started by the first submit and ended by stop().
+    """
+    def __init__(self):
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        with self.lock:
+            if self.thread is None:
+                self.queue = Queue.Queue()
+                self.thread = threading.Thread(target=self.run, args=(self.queue,),
+                                               name="savingsystem.save_writer")
+                self.thread.daemon = True  # stop() is what waits for the pending saves
+                self.thread.start()
+            self.queue.put(job)
+        return job
+
+    def run(self, queue):
+        while 1:
+            job = queue.get()
+            if job is None: return
+            job.run()
+
+    def stop(self):
+        # Writes the pending jobs, then ends the thread
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None: return
+            self.queue.put(None)
+        thread.join()
+
+save_writer = SaveWriter()
+
+def snapshot_blocks(blocks):
+    #Returns {secpos: encoded sector} for the sectors changed since the last save,
+    #the set of those that were only partly generated (blocks spilled into a
+    #region that was never opened), the journal segments holding their edits
+    #and the changed heightmap chunks.
+    #No lock is taken: each sector is copied from its array in one step, and
+    #the journal is rotated before the dirty sectors are taken, so an edit is
+    #either in the snapshot or in a journal segment that is kept.
+    journal_segments = blocks.journal.rotate()
+    #Anything changed after this point is marked dirty again for the next save
+    dirty = set()
+    take = blocks.dirty_sectors.pop
+    try:
+        while 1:
+            dirty.add(take())
+    except KeyError:
+        pass
+    complete = blocks.complete_regions
+    partial = set(secpos for secpos in dirty if sector_to_region(secpos) not in complete)
+    heights = blocks.heightmap.snapshot()
+    return dict((secpos, save_sector_to_string(blocks, secpos)) for secpos in dirty), partial, journal_segments, heights
+
+def save_blocks_async(blocks, world):
     #blocks and sectors (window.world and window.world.sectors)
-    #Saves individual sectors in region files (4x4x4 sectors)
-
-    for secpos in blocks.sectors: #TODO: only save dirty sectors
-        if not blocks.sectors[secpos]:
-            continue #Skip writing empty sectors
-        file = os.path.join(G.game_dir, world, sector_to_filename(secpos))
-        if not os.path.exists(file):
-            with open(file, "w") as f:
-                f.truncate(64*1024) #Preallocate the file to be 64kb
-        with open(file, "rb+") as f: #Load up the region file
-            f.seek(sector_to_offset(secpos)) #Seek to the sector offset
-            f.write(save_sector_to_string(blocks, secpos))
+    #Snapshots the sectors changed since the last save and hands them to the
+    #save writer, which saves them in region files (4x4x4 sectors)
+    #Returns the SaveJob
+    with save_lock:  # Jobs are written in the order their snapshots were taken
+        return save_writer.submit(SaveJob(blocks, world, *snapshot_blocks(blocks)))
+
+def save_blocks(blocks, world):
+    #Saves the sectors changed since the last save and waits for them to be written
+    #Returns how many sectors and bytes were written
+    return save_blocks_async(blocks, world).wait()
 
 def save_player(player, world):
-    db = connect_db(world)
-    cur = db.cursor()
-    cur.execute('insert or replace into players(version, pos_x, pos_y, pos_z, mom_x, mom_y, mom_z, inventory, name) ' + \
-        "values (?, ?, ?, ?, ?, ?, ?, ?, ?)", (1, 
-            player.position[0], player.position[1], player.position[2],
-            player.momentum[0], player.momentum[1], player.momentum[2], 
-            player.inventory, player.username))
-    db.commit()
-    cur.close()
-    db.close()
+    player_store(world).save_players((player,))
 
 
 def world_exists(game_dir, world=None):
@@ -124,68 +308,73 @@ def remove_world(game_dir, world=None):
     if world is None: world = "world"
     if world_exists(game_dir, world):
         import shutil
+        regionfile.region_files.close()
+        close_player_stores()
         shutil.rmtree(os.path.join(game_dir, world))
 
-def sector_exists(sector, world=None):
+def sector_flags(sector, world=None):
+    #Returns (present, all air) for a sector on disk, from its region header
+    #A sector is present once it was fully generated and saved
+    if world is None: world = "world"
+    return regionfile.region_files.sector_flags(os.path.join(G.game_dir, world, sector_to_filename(sector)),
+                                                sector_to_offset(sector) / 1024)
+
+def region_exists(sector, world=None):
     if world is None: world = "world"
-    return os.path.lexists(os.path.join(G.game_dir, world, sector_to_filename(sector)))
+    return regionfile.region_files.exists(os.path.join(G.game_dir, world, sector_to_filename(sector)))
+
+def sector_exists(sector, world=None):
+    return sector_flags(sector, world)[0]
+
+class RegeneratedRegion(object):
+    """
+    The raw sectors generation produces for a region, by sector index,
+    generated on first use. Baseline of the sectors stored as diffs.
+    """
+    def __init__(self, region):
+        self.region = region
+        self.sectors = None
+
+    def __call__(self, index):
+        if self.sectors is None:
+            self.sectors = RegenerationWorld(G.SEED).generate_region(self.region)
+        return self.sectors[index]
 
 def load_region(world, world_name=None, region=None, sector=None):
     if world_name is None: world_name = "world"
     sectors = world.sectors
     blocks = world
     SECTOR_SIZE = G.SECTOR_SIZE
-    BLOCKS_DIR = G.BLOCKS_DIR
     if sector: region = sector_to_region(sector)
     rx,ry,rz = region
     rx,ry,rz = rx*32, ry*32, rz*32
-    with open(os.path.join(G.game_dir, world_name, region_to_filename(region)), "rb") as f:
-        #Load every chunk in this region (4x4x4)
-        for cx in xrange(rx, rx+32, 8):
-            for cy in xrange(ry, ry+32, 8):
-                for cz in xrange(rz, rz+32, 8):
-                    #Now load every block in this chunk (8x8x8)
-                    fstr = f.read(1024)
-                    if fstr != null1024:
-                        fpos = 0
-                        for x in xrange(cx, cx+8):
-                            for y in xrange(cy, cy+8):
-                                for z in xrange(cz, cz+8):
-                                    read = fstr[fpos:fpos+2]
-                                    fpos += 2
-                                    if read != null2:
-                                        position = x,y,z
-                                        try: 
-                                            full_id = structuchar2.unpack(read)
-                                            blocks[position] = BLOCKS_DIR[full_id]
-                                            if blocks[position].sub_id_as_metadata:
-                                                blocks[position] = type(BLOCKS_DIR[full_id])()
-                                                blocks[position].set_metadata(full_id[-1])
-                                        except KeyError:
-                                            try:
-                                                main_blk = BLOCKS_DIR[(full_id[0], 0)]
-                                                if main_blk.sub_id_as_metadata: # sub id is metadata
-                                                    blocks[position] = type(main_blk)()
-                                                    blocks[position].set_metadata(full_id[-1])
-                                            except KeyError as e:
-                                                print "load_region: Invalid Block", e
-                                        sectors[(x/SECTOR_SIZE, y/SECTOR_SIZE, z/SECTOR_SIZE)].append(position)
+    region_sectors = iter(regionfile.region_files.read_region(os.path.join(G.game_dir, world_name, region_to_filename(region)),
+                                                              RegeneratedRegion(region)))
+    #Load every chunk in this region (4x4x4)
+    for cx in xrange(rx, rx+32, 8):
+        for cy in xrange(ry, ry+32, 8):
+            for cz in xrange(rz, rz+32, 8):
+                #Now load every block in this chunk (8x8x8)
+                fstr = next(region_sectors)
+                if fstr is None:
+                    continue
+                secpos = (cx/SECTOR_SIZE, cy/SECTOR_SIZE, cz/SECTOR_SIZE)
+                sectors[secpos] = []  # Known, even if it is all air
+                if isinstance(blocks, BlockStorage):
+                    blocks.decode_sector(secpos, fstr)
+                    continue
+                for _, position, full_id in iter_sector_blocks(fstr, secpos):
+                    try:
+                        block, metadata = block_and_metadata(full_id)
+                    except KeyError as e:
+                        print "load_region: Invalid Block", e
+                        continue
+                    blocks[position] = block
+                    if metadata:
+                        blocks.set_metadata(position, metadata)
 
 def load_player(player, world):
-    db = connect_db(world)
-    cur = db.cursor()
-    cur.execute("select * from players where name='%s'" % player.username)
-    data = cur.fetchone()
-    if data is None:    # no such entry, set initial value
-        player.position = None
-        player.momentum = (0, 0, 0)
-        player.inventory = ''.join((struct.pack("HBB", 0, 0, 0)) * 40)
-    else:
-        player.position = list(data[i] for i in range(2, 5))
-        player.momentum = list(data[i] for i in range(5, 8))
-        player.inventory = str(data[8])
-    cur.close()
-    db.close()
+    player_store(world).load_player(player)
 
 @performance_info
 def open_world(gamecontroller, game_dir, world=None):
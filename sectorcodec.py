@@ -0,0 +1,78 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+from array import array
+import sys
+
+# Third-party packages
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Modules from this project
+# Nothing for now...
+
+
+__all__ = (
+    'SECTOR_OFFSETS', 'AIR_SECTOR', 'encode_sector', 'decode_sector',
+    'iter_sector_blocks',
+)
+
+# A sector is 8x8x8 blocks, stored x-major then y then z (the order of the
+# nested loops the old per-block code used). Each block is two bytes, main
+# then sub, which is the big-endian encoding of the 16-bit value main<<8|sub.
+
+SECTOR_OFFSETS = tuple((x, y, z) for x in xrange(8) for y in xrange(8) for z in xrange(8))
+AIR_SECTOR = "\0" * 1024
+
+_swap = sys.byteorder == 'little'  # array('H') is native endian
+
+
+def encode_sector(blocks, secpos):
+    """
+    Returns the 1024 byte string of a sector of blocks (any mapping of
+    position to block), in one bulk array conversion.
+    """
+    cx, cy, cz = secpos
+    cx, cy, cz = cx * 8, cy * 8, cz * 8
+    get = blocks.get
+    ids = array('H', [(blk.id.main << 8 | blk.id.sub) if blk is not None else 0
+                      for blk in [get((cx + x, cy + y, cz + z)) for x, y, z in SECTOR_OFFSETS]])
+    if _swap:
+        ids.byteswap()
+    return ids.tostring()
+
+
+def decode_sector(fstr):
+    """
+    Returns the 512 main<<8|sub block values of a 1024 byte sector
+    (a str or buffer), as a numpy array if NumPy is available.
+    """
+    if numpy is not None:
+        return numpy.frombuffer(fstr, dtype='>u2')
+    ids = array('H')
+    ids.fromstring(fstr)
+    if _swap:
+        ids.byteswap()
+    return ids
+
+
+def iter_sector_blocks(fstr, secpos):
+    """
+    Yields (index, position, (main, sub)) for every non-air block of a
+    1024 byte sector, index being the block's place in SECTOR_OFFSETS.
+    """
+    cx, cy, cz = secpos
+    cx, cy, cz = cx * 8, cy * 8, cz * 8
+    ids = decode_sector(fstr)
+    if numpy is not None:
+        indices = numpy.flatnonzero(ids).tolist()
+        ids = ids.tolist()
+    else:
+        indices = [i for i, full_id in enumerate(ids) if full_id]
+    offsets = SECTOR_OFFSETS
+    for i in indices:
+        x, y, z = offsets[i]
+        full_id = ids[i]
+        yield i, (cx + x, cy + y, cz + z), (full_id >> 8, full_id & 255)
@@ -0,0 +1,17 @@
+import cython
+
+#cython: boundscheck=False
+#cython: wraparound=False
+#cython: cdivision=True
+
+
+cpdef int view_index(int x, int y, int z)
+
+cpdef bytearray see_through()
+
+@cython.locals(cx=int, cy=int, cz=int, bx=int, by=int, bz=int, x=int, y=int, z=int,
+               i=int, px=int, py=int, sx=int, sy=int, lx=int, ly=int, base=int, row=int)
+cpdef object sector_view(object world, tuple secpos)
+
+@cython.locals(table=bytearray, bitmap=bytearray, i=int, index=int, offset=int)
+cpdef bytearray exposed_bitmap(object view)
@@ -0,0 +1,115 @@
+# Imports, sorted alphabetically.
+
+# Python packages
+from array import array
+
+# Third-party packages
+# Nothing for now...
+
+# Modules from this project
+import globals as G
+from sectorcodec import SECTOR_OFFSETS
+from utils import FACES, FACES_WITH_DIAGONALS
+
+
+__all__ = (
+    'VIEW_SIZE', 'SECTOR_INDICES', 'FACE_OFFSETS', 'DIAGONAL_OFFSETS',
+    'view_index', 'sector_view', 'see_through', 'exposed_bitmap',
+)
+
+# A sector view is an array of the 10x10x10 block values (main<<8|sub, 0 for
+# air) of a sector and of the one block thick border around it, taken from
+# its neighbours. Views are x-major, then y, then z, like sectors: padded
+# coordinates (px, py, pz) from 0 to 9 are at px*100 + py*10 + pz, and block
+# (x, y, z) of the sector is at padded (x+1, y+1, z+1). A neighbour is then a
+# fixed offset away, whatever the block.
+
+VIEW_SIZE = 10
+EMPTY_VIEW = array('H', [0]) * 1000
+
+
+def view_index(x, y, z):
+    """ The index in a view of the padded coordinates x, y, z """
+    return x * 100 + y * 10 + z
+
+
+# The view index of each block of the sector, in SECTOR_OFFSETS order
+SECTOR_INDICES = tuple(view_index(x + 1, y + 1, z + 1) for x, y, z in SECTOR_OFFSETS)
+
+# The index offsets of FACES and FACES_WITH_DIAGONALS, in the same order
+FACE_OFFSETS = tuple(view_index(dx, dy, dz) for dx, dy, dz in FACES)
+DIAGONAL_OFFSETS = tuple(view_index(dx, dy, dz) for dx, dy, dz in FACES_WITH_DIAGONALS)
+
+_see_through = None
+
+
+def see_through():
+    """
+    A 65536 byte table telling, for each block value, whether the blocks
+    behind it can be seen: 1 for air and transparent blocks.
+    """
+    global _see_through
+    if _see_through is None:
+        table = bytearray(block is not None and block.transparent for block in G.BLOCKS_BY_VALUE)
+        table[0] = 1
+        _see_through = table
+    return _see_through
+
+
+def sector_view(world, secpos):
+    """
+    Returns the view of a sector of world, either a BlockStorage (read
+    straight from its sector arrays) or a mapping of positions to blocks.
+    Blocks the world doesn't have are air.
+    """
+    cx, cy, cz = secpos
+    arrays = getattr(world, 'sector_arrays', None)
+    if arrays is None:
+        view = array('H', EMPTY_VIEW)
+        get = world.get
+        bx, by, bz = cx * 8 - 1, cy * 8 - 1, cz * 8 - 1
+        i = 0
+        for x in xrange(bx, bx + 10):
+            for y in xrange(by, by + 10):
+                for z in xrange(bz, bz + 10):
+                    block = get((x, y, z))
+                    if block is not None:
+                        view[i] = block.id.main << 8 | block.id.sub
+                    i += 1
+        return view
+
+    view = array('H', EMPTY_VIEW)
+    for px in xrange(10):
+        sx, lx = (cx * 8 + px - 1) >> 3, (px - 1) & 7
+        for py in xrange(10):
+            sy, ly = (cy * 8 + py - 1) >> 3, (py - 1) & 7
+            base, row = lx << 6 | ly << 3, px * 100 + py * 10
+            # A row along z: the last block of the sector before, the 8 of
+            # this one, the first block of the sector after
+            ids = arrays.get((sx, sy, cz - 1))
+            if ids is not None:
+                view[row] = ids[base + 7]
+            ids = arrays.get((sx, sy, cz))
+            if ids is not None:
+                view[row + 1:row + 9] = ids[base:base + 8]
+            ids = arrays.get((sx, sy, cz + 1))
+            if ids is not None:
+                view[row + 9] = ids[base]
+    return view
+
+
+def exposed_bitmap(view):
+    """
+    Returns the 64 byte bitmap of the blocks of a sector view that have a
+    see-through neighbour: block i (in SECTOR_OFFSETS order) is bit i & 7
+    of byte i >> 3.
+    """
+    table = see_through()
+    bitmap = bytearray(64)
+    for i, index in enumerate(SECTOR_INDICES):
+        if view[index]:
+            for offset in FACE_OFFSETS:
+                if table[view[index + offset]]:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+                    break
+    return bitmap
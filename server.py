@@ -14,12 +14,14 @@ import threading
 
 # Modules from this project
 import globals as G
-from savingsystem import save_sector_to_string, save_blocks, save_world, load_player, save_player
+from savingsystem import sector_flags, save_world, load_player, save_player, close_player_stores, save_writer
+from sectorcodec import AIR_SECTOR
 from world_server import WorldServer
 import blocks
 from commands import CommandParser, COMMAND_HANDLED, CommandException, COMMAND_ERROR_COLOR
 from utils import sectorize, make_string_packet
 from mod import load_modules
+from pregen import pregen_regions, pregenerate
 
 #This class is effectively a serverside "Player" object
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
@@ -76,23 +78,27 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 sector = struct.unpack("iii", self.request.recv(4*3))
 
                 if sector not in world.sectors:
-                    with world.server_lock:
-                        world.open_sector(sector)
-
-                if not world.sectors[sector]:
+                    present, air = sector_flags(sector)
+                    if air:
+                        #Saved as all air, no need to load or generate anything
+                        self.sendpacket(12, "\2" + struct.pack("iii",*sector))
+                        continue
+
+                snapshot = world.read_sector(sector)
+                if snapshot is None:
                     #Empty sector, send packet 2
                     self.sendpacket(12, "\2" + struct.pack("iii",*sector))
                 else:
-                    msg = struct.pack("iii",*sector) + save_sector_to_string(world, sector) + world.get_exposed_sector(sector)
+                    msg = struct.pack("iii",*sector) + snapshot[0] + snapshot[1]
                     self.sendpacket(len(msg), "\1" + msg)
             elif packettype == 3:  # Add block
                 positionbytes = self.request.recv(4*3)
                 blockbytes = self.request.recv(2)
 
                 position = struct.unpack("iii", positionbytes)
-                blockid = G.BLOCKS_DIR[struct.unpack("BB", blockbytes)]
-                with world.server_lock:
-                    world.add_block(position, blockid, sync=False)
+                block, metadata = blocks.block_and_metadata(struct.unpack("BB", blockbytes))
+                with world.editing(position):
+                    world.add_block(position, block, sync=False, metadata=metadata)
 
                 for address in players:
                     if address is self.client_address: continue  # He told us, we don't need to tell him
@@ -100,8 +106,9 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
             elif packettype == 4:  # Remove block
                 positionbytes = self.request.recv(4*3)
 
-                with world.server_lock:
-                    world.remove_block(struct.unpack("iii", positionbytes), sync=False)
+                position = struct.unpack("iii", positionbytes)
+                with world.editing(position):
+                    world.remove_block(position, sync=False)
 
                 for address in players:
                     if address is self.client_address: continue  # He told us, we don't need to tell him
@@ -123,8 +130,7 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 except CommandException, e:
                     self.sendchat(str(e), COMMAND_ERROR_COLOR)
             elif packettype == 6:  # Player Inventory Update
-                self.inventory = self.request.recv(4*40)
-                #TODO: All player's inventories should be autosaved at a regular interval.
+                self.inventory = self.request.recv(4*40)  # Written to the database by the next autosave
             elif packettype == 8:  # Player Movement
                 mom_bytes, pos_bytes = self.request.recv(4*3), self.request.recv(8*3)
                 self.momentum = struct.unpack("fff", mom_bytes)
@@ -141,7 +147,7 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
             elif packettype == 10: # Update Tile Entity
                 block_pos = struct.unpack("iii", self.request.recv(4*3))
                 ent_size = struct.unpack("i", self.request.recv(4))[0]
-                world[block_pos].update_tile_entity(self.request.recv(ent_size))
+                world[block_pos].update_tile_entity(world, block_pos, self.request.recv(ent_size))
             elif packettype == 255:  # Initial Login
                 txtlen = struct.unpack("i", self.request.recv(4))[0]
                 self.username = self.request.recv(txtlen).decode('utf-8')
@@ -152,7 +158,11 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                     player.sendchat("$$y%s has connected." % self.username)
                 print "%s's username is %s" % (self.client_address, self.username)
 
-                position = (0,self.server.world.terraingen.get_height(0,0)+2,0)
+                #Spawn on top of the highest block at 0, 0, trees included
+                y = world.terraingen.get_height(0,0)
+                world.open_sector(sectorize((0,y,0)))
+                top = world.highest_block(0,0)
+                position = (0,(y if top is None else max(y, top))+2,0)
                 if self.position is None: self.position = position  # New player, set initial position
 
                 # Send list of current players to the newcomer
@@ -168,10 +178,8 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
 
                 #Send them the sector under their feet first so they don't fall
                 sector = sectorize(position)
-                if sector not in world.sectors:
-                    with world.server_lock:
-                        world.open_sector(sector)
-                msg = struct.pack("iii",*sector) + save_sector_to_string(world, sector) + world.get_exposed_sector(sector)
+                encoded, exposed = world.read_sector(sector) or (AIR_SECTOR, "\0" * 64)
+                msg = struct.pack("iii",*sector) + encoded + exposed
                 self.sendpacket(len(msg), "\1" + msg)
 
                 #Send them their spawn position and world seed(for client side biome generator)
@@ -205,11 +213,11 @@ class Server(socketserver.ThreadingTCPServer):
 
         self.command_parser = CommandParser()
 
-    def show_block(self, position, block):
+    def show_block(self, position, block, metadata=0):
         blockid = block.id
         for player in self.players.itervalues():
             #TODO: Only if they're in range
-            player.sendpacket(14, "\3" + struct.pack("iiiBB", *(position+(blockid.main, blockid.sub))))
+            player.sendpacket(14, "\3" + struct.pack("iiiBB", *(position+(blockid.main, metadata or blockid.sub))))
 
     def hide_block(self, position):
         for player in self.players.itervalues():
@@ -220,6 +228,15 @@ class Server(socketserver.ThreadingTCPServer):
         for player in self.players.itervalues():
             player.sendpacket(12 + len(value), "\x0A" + struct.pack("iii", *position) + value)
 
+    #autosave is run in its own thread
+    def autosave(self):
+        # Periodically saves every player (position and inventory, in one
+        # transaction) and the sectors that changed since the last save
+        if G.AUTOSAVE_INTERVAL <= 0:
+            return
+        while not self._stop.wait(G.AUTOSAVE_INTERVAL):
+            save_world(self, "world")
+
 
 def start_server(internal=False):
     if internal:
@@ -228,10 +245,18 @@ def start_server(internal=False):
         localip = [ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")][0]
         server = Server((localip, 1486), ThreadedTCPRequestHandler)
     G.SERVER = server
+    server.world.generation.start()  # Forks the workers before any thread runs
+    # Before serving, so no player edit can be overwritten by an older one
+    replayed = server.world.replay_journal()
+    if replayed:
+        print "Replayed %d block edits from the journal" % replayed
     server_thread = threading.Thread(target=server.serve_forever)
     server_thread.start()
 
+    threading.Thread(target=server.world.journal.run, args=(server._stop,), name="world_server.journal").start()
     threading.Thread(target=server.world.content_update, name="world_server.content_update").start()
+    threading.Thread(target=server.autosave, name="server.autosave").start()
+    threading.Thread(target=server.world.evict_cold_regions_loop, args=(server._stop,), name="world_server.eviction").start()
 
     # start server timer
     G.main_timer = timer.Timer(G.TIMER_INTERVAL, name="G.main_timer")
@@ -254,7 +279,8 @@ if __name__ == '__main__':
     ip, port = server.server_address
     print "Listening on",ip,port
 
-    helptext = "Available commands: " + ", ".join(["say", "stop", "save"])
+    pregen_thread, pregen_stop = None, threading.Event()
+    helptext = "Available commands: " + ", ".join(["say", "stop", "save", "locks", "columns", "pregen"])
     while 1:
         args = raw_input().replace(chr(13), "").split(" ")  # On some systems CR is appended, gotta remove that
         cmd = args.pop(0)
@@ -266,11 +292,41 @@ if __name__ == '__main__':
         elif cmd == "help":
             print helptext
         elif cmd == "save":
-            print "Saving..."
-            save_world(server, "world")
-            print "Done saving"
+            save_world(server, "world", wait=False)
+            print "Saving in the background..."  # The save writer logs when it is done
+        elif cmd == "locks":
+            stats = server.world.locks.stats()
+            print "Region locks: %d acquired, %d waited (%.1f ms total, %.1f ms longest)" % (
+                stats['acquisitions'], stats['contended'], stats['wait_time'] * 1000, stats['max_wait'] * 1000)
+            if args and args[0] == "reset":
+                server.world.locks.reset_stats()
+        elif cmd == "columns":
+            columns = server.world.terraingen.columns
+            stats = columns.stats()
+            print "Generation columns: %d cached, %d hits, %d misses; heights %d hits, %d misses" % (
+                stats['columns'], stats['hits'], stats['misses'], stats['height_hits'], stats['height_misses'])
+            if args and args[0] == "reset":
+                columns.reset_stats()
+        elif cmd == "pregen":
+            if args and args[0] == "stop":
+                pregen_stop.set()
+            elif len(args) != 3:
+                print "Usage: pregen <x> <z> <radius>, in sectors, or pregen stop"
+            elif pregen_thread is not None and pregen_thread.is_alive():
+                print "Pregen is already running"
+            else:
+                pregen_stop = threading.Event()
+                regions = pregen_regions((int(args[0]), int(args[1])), int(args[2]))
+                pregen_thread = threading.Thread(target=pregenerate, args=(server.world, regions, pregen_stop),
+                                                 name="server.pregen")
+                pregen_thread.start()
         elif cmd == "stop":
             server._stop.set()
+            pregen_stop.set()
+            if pregen_thread is not None:
+                print "Waiting for pregen to finish its batch..."
+                pregen_thread.join()
+            server.world.generation.stop()
             G.main_timer.stop()
             print "Disconnecting clients..."
             for address in server.players:
@@ -283,6 +339,8 @@ if __name__ == '__main__':
             server.shutdown()
             print "Saving..."
             save_world(server, "world")
+            save_writer.stop()
+            close_player_stores()
             print "Goodbye"
             break
         else:
@@ -91,6 +91,7 @@ cdef class TerrainGeneratorSimple(TerrainGeneratorBase):
         object world
         object rand
         object weights
+        object simplex
         object noise
         bint skip_over
         double PERSISTENCE
@@ -113,13 +114,23 @@ cdef class TerrainGeneratorSimple(TerrainGeneratorBase):
         set autogenerated_blocks
         int negative_biome_trigger
         object biome_generator
+        object columns
         tuple nether
 
     cpdef double _clamp(self, double a)
 
     @cython.locals(y=double, weight=double)
-    cpdef int get_height(self, double x, double z)
+    cpdef int get_height(self, double x, double z, object parameters=?)
 
-    @cython.locals(world=object, islandheight=int, skip=bint, bx=int,
-                   by=int, bz=int, bytop=int, x=int, z=int, y=int, yy=int)
+    cpdef list get_heights(self, int x, int z, int size=?, object parameters=?)
+
+    @cython.locals(world=object, x=int, y=int, z=int)
     cpdef object generate_sector(self, object sector)
+
+    @cython.locals(world=object, start=int, column=int)
+    cpdef object commit_sector(self, object sector, object ids, list deferred, dict spill)
+
+    @cython.locals(parameters=object, bx=int, by=int, bz=int, bytop=int, x=int, z=int, y=int, yy=int,
+                   index=int, k=int, height_base=int, island_shore=int, water_level=int,
+                   heights=list, column=object, deferred=list, placed=list, spill=dict)
+    cpdef tuple generate_sector_buffer(self, object sector, dict biomes=?)
@@ -6,24 +6,32 @@ Terrain generating algorithm
 # Imports, sorted alphabetically.
 
 # Python packages
+from array import array
 from math import sqrt, floor
 import random
 
 # Third-party packages
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from perlin import SimplexNoise
 from noise import *
 
 # Modules from this project
 from blocks import *
-from utils import FastRandom
+from blockstorage import AIR_IDS, BlockStorage
+from utils import FACES, FACES_WITH_DIAGONALS, FastRandom
 from biome import BiomeGenerator
+from columncache import ColumnCache
 from nature import *
 import globals as G
 
 
 __all__ = (
     'Chunk' 'TerrainGeneratorBase',
-    'TerrainGenerator', 'TerrainGeneratorSimple',
+    'TerrainGenerator', 'TerrainGeneratorSimple', 'RegenerationWorld',
+    'BiomeParameters', 'BIOME_PARAMETERS',
 )
 
 CHUNK_X_SIZE = 16
@@ -261,6 +269,42 @@ class TerrainGenerator(TerrainGeneratorBase):
         return self.cave_gen.fBm(x * 0.02, y * 0.02, z * 0.02)
 
 
+class BiomeParameters(object):
+    """
+    How TerrainGeneratorSimple shapes the terrain of a biome. Shared by
+    every sector of the biome, and never changed while generating; the
+    values left to None are the generator's own (or G's for tree_chance).
+    """
+    __slots__ = ('main_block', 'height_range', 'height_base', 'island_shore', 'water_level',
+                 'zoom_level', 'tree_chance', 'grass', 'ores')
+
+    def __init__(self, main_block, island_shore, water_level, zoom_level=0.002, height_range=32, height_base=32,
+                 tree_chance=None, grass=None, ores=None):
+        self.main_block = main_block
+        self.height_range = height_range
+        self.height_base = height_base  # The lowest point the perlin terrain will generate
+        self.island_shore = island_shore  # Below this is sand, above is grass .. island only
+        self.water_level = water_level
+        self.zoom_level = zoom_level  # Smaller will create gentler, softer transitions
+        self.tree_chance = tree_chance
+        self.grass = grass  # Vegetation classes, instead of world_type_grass
+        self.ores = ores  # The blocks under the surface at every level, instead of the ores
+
+
+BIOME_PARAMETERS = {
+    G.FOREST: BiomeParameters(grass_block, 0, 0, tree_chance=0.012),
+    G.PLAINS: BiomeParameters(grass_block, 0, 0, tree_chance=0.004),
+    G.SNOW: BiomeParameters(snowgrass_block, 34, 33),
+    G.DESERT: BiomeParameters(sand_block, 32, 0, tree_chance=0),
+    # Does not naturally occur. Some grass that cant be on sand, for a clean beach
+    G.ISLAND: BiomeParameters(grass_block, 38, 36, grass=(YFlowers, Rose, TallGrass)),
+    G.MOUNTAINS: BiomeParameters(stone_block, 18, 20, zoom_level=0.001),
+    # Does not naturally occur. No water in the nether
+    G.NETHER: BiomeParameters(nether_block, -1, -2, zoom_level=0.01,
+                              ores=(nether_block,) * 60 + (soulsand_block,) * 35 + (netherore_block,) * 5 + (air_block,) * 10),
+}
+
+
 class TerrainGeneratorSimple(TerrainGeneratorBase):
     """
     A simple and fast use of (Simplex) Perlin Noise to generate a heightmap
@@ -274,12 +318,14 @@ class TerrainGeneratorSimple(TerrainGeneratorBase):
         self.rand = random.Random(seed)
         perm = range(255)
         self.rand.shuffle(perm)
-        self.noise = SimplexNoise(permutation_table=perm).noise2
+        self.simplex = SimplexNoise(permutation_table=perm)
+        self.noise = self.simplex.noise2
         #self.noise = PerlinNoise(seed).noise
         self.PERSISTENCE = 2.1379201 #AKA lacunarity
         self.H = 0.836281
 
         self.biome_generator = BiomeGenerator(seed)
+        self.columns = ColumnCache(self, G.COLUMN_CACHE_SIZE)
 
         #Fun things to adjust
         self.OCTAVES = 9        #Higher linearly increases calc time; increases apparent 'randomness'
@@ -316,10 +362,15 @@ class TerrainGeneratorSimple(TerrainGeneratorBase):
             return 0
         else:
             return a
-    def get_height(self,x,z):
-        """ Given block coordinates, returns a block coordinate height """
-        x *= self.zoom_level
-        z *= self.zoom_level
+    def get_height(self, x, z, parameters=None):
+        """
+        Given block coordinates, returns a block coordinate height, for the
+        BiomeParameters given or the generator's own.
+        """
+        if parameters is None:
+            parameters = self
+        x *= parameters.zoom_level
+        z *= parameters.zoom_level
         y = 0
         for weight in self.weights:
             y += self.noise(x, z) * weight
@@ -327,7 +378,38 @@ class TerrainGeneratorSimple(TerrainGeneratorBase):
             x *= self.PERSISTENCE
             z *= self.PERSISTENCE
 
-        return int(self.height_base + self._clamp((y+1.0)/2.0)*self.height_range)
+        return int(parameters.height_base + self._clamp((y+1.0)/2.0)*parameters.height_range)
+
+    def get_heights(self, x, z, size=8, parameters=None):
+        """
+        Returns the get_height of each column of the size x size square from
+        x, z, in one go: the height of (x + dx, z + dz) is at dx * size + dz.
+        The heights are exactly those of get_height, computed with NumPy
+        when it is available.
+        """
+        if parameters is None:
+            parameters = self
+        if numpy is None:
+            get_height = self.get_height
+            return [get_height(x + dx, z + dz, parameters) for dx in xrange(size) for dz in xrange(size)]
+        xs, zs = numpy.mgrid[x:x + size, z:z + size]
+        xs = xs.ravel().astype(numpy.float64) * parameters.zoom_level
+        zs = zs.ravel().astype(numpy.float64) * parameters.zoom_level
+        # All the octaves in a single noise call, as NumPy's cost is per call
+        octaves_x, octaves_z = [], []
+        for weight in self.weights:
+            octaves_x.append(xs)
+            octaves_z.append(zs)
+            xs = xs * self.PERSISTENCE
+            zs = zs * self.PERSISTENCE
+        noise = self.simplex.noise2_array(numpy.concatenate(octaves_x), numpy.concatenate(octaves_z))
+        y = numpy.zeros(size * size)
+        for octave, weight in enumerate(self.weights):
+            y += noise[octave * size * size:(octave + 1) * size * size] * weight
+
+        y = (y + 1.0) / 2.0
+        y = numpy.where(y > 1, 0.9999, numpy.where(y < 0, 0, y))
+        return (parameters.height_base + y * parameters.height_range).astype(numpy.int64).tolist()
 
     def generate_sector(self, sector):
         world = self.world
@@ -337,183 +419,240 @@ class TerrainGeneratorSimple(TerrainGeneratorBase):
                 if world[pos] not in self.autogenerated_blocks:
                     return
 
-        #if G.TERRAIN_CHOICE != 'nether':
-        TERRAIN_CHOICE = self.biome_generator.get_biome_type(sector[0], sector[2])
-
-        TREE_CHANCE = G.TREE_CHANCE
+        world.sectors[sector] = []  # Precache it incase it ends up being solid air, so it doesn't get regenerated indefinitely
+        self.commit_sector(sector, *self.generate_sector_buffer(sector))
+
+    def commit_sector(self, sector, ids, deferred, spill):
+        """
+        Adds what generate_sector_buffer made to the world: the columns of
+        the buffer in bulk, with the deferred blocks and vegetation in
+        between, in the order they were generated, then the spill. The world
+        ends up as if every block had been added with init_block as it was
+        generated.
+        """
+        if ids is None:
+            return
+        world = self.world
+        start = 0
+        for column, position, block, seed in deferred:
+            if column >= start:
+                world.merge_columns(sector, ids, start, column + 1)
+                start = column + 1
+            if seed is None:
+                world.init_block(position, block)
+            else:
+                # Seeded by position, so regenerating a sector grows the same vegetation
+                world.generate_vegetation(position, block, random.Random(seed))
+        world.merge_columns(sector, ids, start, 64)
+        for secpos, spilled in spill.iteritems():
+            world.merge_columns(secpos, spilled, 0, 64)
+
+    def generate_sector_buffer(self, sector, biomes=None):
+        """
+        Generates the terrain of a sector without touching the world or the
+        generator, so any thread can call it. Returns (ids, deferred, spill):
+        - ids, the array of the sector's 512 block values (main<<8|sub) in
+          SECTOR_OFFSETS order, or None if the sector is left empty;
+        - deferred, [(column, position, block, None)] for the surface blocks
+          the sector puts in the sectors around it and [(column, position,
+          vegetation class, seed)] for its vegetation, in the order of
+          the columns ((x & 7) << 3 | (z & 7)) they come from;
+        - spill, {sector position: array} for the filler of the sectors
+          above it, when the sector is below the terrain's surface.
+        biomes maps the biomes to their BiomeParameters, BIOME_PARAMETERS by
+        default; none of it is changed.
+        """
+        if biomes is None:
+            biomes = BIOME_PARAMETERS
+        column = self.columns.column(sector[0], sector[2])
+        TERRAIN_CHOICE = column.biome
+        parameters = biomes[TERRAIN_CHOICE]
+
+        TREE_CHANCE = parameters.tree_chance if parameters.tree_chance is not None else G.TREE_CHANCE
         WILDFOOD_CHANCE = G.WILDFOOD_CHANCE
         GRASS_CHANCE = G.GRASS_CHANCE
 
-        #TODO: This is very untidy, should be converted to a dict or something clever
-        if TERRAIN_CHOICE == G.FOREST:
-            main_block = grass_block
-            self.height_range = 32
-            self.height_base = 32
-            self.island_shore = 0
-            self.water_level = 0
-            self.zoom_level = 0.002
-            TREE_CHANCE = 0.012
-        elif TERRAIN_CHOICE == G.PLAINS:
-            main_block = grass_block
-            self.height_range = 32
-            self.height_base = 32
-            self.island_shore = 0
-            self.water_level = 0
-            self.zoom_level = 0.002
-            TREE_CHANCE = 0.004
-        elif TERRAIN_CHOICE == G.SNOW:
-            main_block = snowgrass_block
-            self.height_range = 32
-            self.height_base = 32
-            self.island_shore = 34
-            self.water_level = 33
-            self.zoom_level = 0.002
-        elif TERRAIN_CHOICE == G.DESERT:
-            main_block = sand_block
-            self.height_range = 32
-            self.height_base = 32
-            self.island_shore = 32
-            self.water_level = 0
-            self.zoom_level = 0.002
-            TREE_CHANCE = 0
-        elif TERRAIN_CHOICE == G.ISLAND:  #Does not naturally occur
-            # Some grass that cant be on sand, for a clean beach
-            self.world_type_grass = (YFlowers, Rose, TallGrass)
-            main_block = grass_block
-            self.height_range = 32
-            self.height_base = 32
-            self.island_shore = 38
-            self.water_level = 36
-            self.zoom_level = 0.002
-        elif TERRAIN_CHOICE == G.MOUNTAINS:
-            main_block = stone_block
-            self.height_range = 32
-            self.height_base = 32
-            self.island_shore = 18
-            self.water_level = 20
-            self.zoom_level = 0.001
-        elif TERRAIN_CHOICE == G.NETHER:  #Does not naturally occur
-            main_block = nether_block
-            self.height_range = 32
-            self.height_base = 32
-            #no water in the nether
-            self.island_shore = -1
-            self.water_level = -2
-            self.zoom_level = 0.01
-
-        world.sectors[sector] = []  # Precache it incase it ends up being solid air, so it doesn't get regenerated indefinitely
-        bx, by, bz = world.savingsystem.sector_to_blockpos(sector)
-
-        if 0 <= by < (self.height_base + self.height_range):
-            self.rand.seed(self.seed + "(%d,%d,%d)" % (bx, by, bz))
+        bx, by, bz = sector[0] * 8, sector[1] * 8, sector[2] * 8
+        height_base = parameters.height_base
+        if not 0 <= by < (height_base + parameters.height_range):
+            return None, [], {}
+
+        rand = random.Random(self.seed + "(%d,%d,%d)" % (bx, by, bz))
+        bytop = by + 8
+        ids = array('H', AIR_IDS)
+        deferred = []
+        spill = {}
+
+        # We pass these as local variables for performance and readability.
+        # Functions:
+        choose = rand.choice
+        rand_random = rand.random
+        # Variables (that are static during what follows)
+        main_block = parameters.main_block
+        island_shore = parameters.island_shore
+        water_level = parameters.water_level
+        underwater_blocks = self.underwater_blocks
+        world_type_trees = self.world_type_trees
+        world_type_plants = self.world_type_plants
+        world_type_grass = parameters.grass or self.world_type_grass
+        highlevel_ores = parameters.ores or self.highlevel_ores
+        midlevel_ores = parameters.ores or self.midlevel_ores
+        lowlevel_ores = parameters.ores or self.lowlevel_ores
+        bedrock = (bedrock_block,)
+        # The heightmap of the sector's columns, if it falls within it
+        heights = self.columns.heights(column, sector[0], sector[2], parameters) if by >= height_base else None
+
+        for x in xrange(bx, bx + 8):
+            for z in xrange(bz, bz + 8):
+                index = (x & 7) << 6 | (z & 7)
+                k = (x & 7) << 3 | (z & 7)
+                # Blocks go in the buffer unless it already has one there, like
+                # init_block, or are deferred when they're outside the sector
+                placed = []
+                if by < height_base:
+                    # For sectors outside of the height_range, no point checking the heightmap
+                    y = height_base
+                else:
+                    # The heightmap falls within our sector, generate surface stuff
+                    y = heights[(x - bx) * 8 + z - bz]
+                    if y > bytop:
+                        y = bytop
+
+                    if TERRAIN_CHOICE == G.MOUNTAINS:
+                        if 0 <= y <= 35:  # bottom level = grass
+                            main_block = grass_block
+                        if 36 <= y <= 54:  # mid level = rock
+                            main_block = stone_block
+                        if y >= 55:  # top level = snow
+                            main_block = snow_block
+
+                    if y <= water_level:
+                        if TERRAIN_CHOICE != G.DESERT:  # was y == self.height_base -- you can have water!
+                            if TERRAIN_CHOICE == G.SNOW:  # top block is ice
+                                placed.append((water_level, ice_block))
+                            else:
+                                placed.append((water_level, water_block))
+                            placed.append((water_level - 2, choose(underwater_blocks)))
+                            placed.append((water_level - 3, dirt_block))
+                        else:  # no water for you!
+                            placed.append((y + 1, sand_block))
+                            placed.append((y, sand_block))
+                            placed.append((y - 1, sand_block))
+                            placed.append((y - 2, sandstone_block))
+                            placed.append((y - 3, sandstone_block))
+                        y -= 3
+                    elif y < bytop:
+                        if TERRAIN_CHOICE == G.ISLAND:  # always sand by the water, grass above
+                            if y > island_shore:
+                                main_block = grass_block
+                            else:
+                                main_block = sand_block
+                        placed.append((y, main_block))
+
+                        veget_choice = rand_random()
+                        veget_blocks = None
+                        if veget_choice < TREE_CHANCE:
+                            veget_blocks = world_type_trees
+                        elif veget_choice < WILDFOOD_CHANCE:
+                            veget_blocks = world_type_plants
+                        elif veget_choice < GRASS_CHANCE:
+                            veget_blocks = world_type_grass
+                        if veget_blocks is not None:
+                            placed.append((y + 1, choose(veget_blocks)))
+
+                        if main_block == sand_block:
+                            underground_blocks = (
+                                sand_block, sand_block, sandstone_block)
+                        elif main_block == stone_block:
+                            underground_blocks = (stone_block,) * 3
+                        elif main_block == nether_block:
+                            underground_blocks = self.nether
+                        else:
+                            underground_blocks = (dirt_block,) * 3
+
+                        for d, block in enumerate(underground_blocks,
+                                                  start=1):
+                            placed.append((y - d, block))
+
+                        y -= 3
+
+                for yy, block in placed:
+                    if isinstance(block, type):
+                        # Vegetation, grown once the columns up to this one are in the world
+                        deferred.append((k, (x, yy, z), block, self.seed + "(%d,%d,%d)v" % (x, yy, z)))
+                    elif by <= yy < bytop:
+                        i = index | (yy & 7) << 3
+                        if not ids[i]:
+                            ids[i] = block.id.main << 8 | block.id.sub
+                    else:
+                        deferred.append((k, (x, yy, z), block, None))
+
+                for yy in xrange(by, y):
+                    # ores and filler...
+                    if yy >= 32:
+                        blockset = highlevel_ores
+                    elif yy > 9:
+                        blockset = midlevel_ores
+                    elif yy > 2:
+                        blockset = lowlevel_ores
+                    elif yy <= 1:
+                        blockset = bedrock
+
+                    i = index | (yy & 7) << 3
+                    block = choose(blockset)
+                    if yy < bytop:
+                        if not ids[i]:
+                            ids[i] = block.id.main << 8 | block.id.sub
+                    else:
+                        # The filler goes up to height_base, whatever the sector
+                        spilled = spill.get((sector[0], yy >> 3, sector[2]))
+                        if spilled is None:
+                            spilled = spill[(sector[0], yy >> 3, sector[2])] = array('H', AIR_IDS)
+                        spilled[i] = block.id.main << 8 | block.id.sub
+                    #if yy == 0:
+                     #   init_block((x, 0, z), bedrock_block)
 
-            bytop = by + 8
+        return ids, deferred, spill
 
-            # We pass these as local variables for performance and readability.
-            # Functions:
-            init_block = world.init_block
-            get_height = self.get_height
-            choose = self.rand.choice
-            rand_random = self.rand.random
-            # Variables (that are static during what follows)
-            height_base = self.height_base
-            island_shore = self.island_shore
-            water_level = self.water_level
-            underwater_blocks = self.underwater_blocks
-            world_type_trees = self.world_type_trees
-            world_type_plants = self.world_type_plants
-            world_type_grass = self.world_type_grass
-            if TERRAIN_CHOICE == G.NETHER:
-                highlevel_ores = ((nether_block,) * 60 + (soulsand_block,) * 35 + (netherore_block,) * 5 + (air_block,) * 10)
-                midlevel_ores = highlevel_ores
-                lowlevel_ores = highlevel_ores
-            else:
-                highlevel_ores = self.highlevel_ores
-                midlevel_ores = self.midlevel_ores
-                lowlevel_ores = self.lowlevel_ores
-
-            for x in xrange(bx, bx + 8):
-                for z in xrange(bz, bz + 8):
-                    if by < height_base:
-                        # For sectors outside of the height_range, no point checking the heightmap
-                        y = height_base
-                    else:
-                        # The heightmap falls within our sector, generate surface stuff
-                        y = get_height(x, z)
-                        if y > bytop:
-                            y = bytop
 
-                        if TERRAIN_CHOICE == G.MOUNTAINS:
-                            if 0 <= y <= 35:  # bottom level = grass
-                                main_block = grass_block
-                            if 36 <= y <= 54:  # mid level = rock
-                                main_block = stone_block
-                            if y >= 55:  # top level = snow
-                                main_block = snow_block
-
-                        if y <= water_level:
-                            if TERRAIN_CHOICE != G.DESERT:  # was y == self.height_base -- you can have water!
-                                if TERRAIN_CHOICE == G.SNOW:  # top block is ice
-                                    init_block((x, water_level, z), ice_block)
-                                else:
-                                    init_block((x, water_level, z), water_block)
-                                # init_block((x, y -1, z), water_block)
-                                init_block((x, water_level - 2, z), choose(underwater_blocks))
-                                init_block((x, water_level - 3, z), dirt_block)
-                            else:  # no water for you!
-                                init_block((x, y + 1, z), sand_block)
-                                init_block((x, y, z), sand_block)
-                                init_block((x, y - 1, z), sand_block)
-                                init_block((x, y - 2, z), sandstone_block)
-                                init_block((x, y - 3, z), sandstone_block)
-                            y -= 3
-                        elif y < bytop:
-                            if TERRAIN_CHOICE == G.ISLAND:  # always sand by the water, grass above
-                                if y > island_shore:
-                                    main_block = grass_block
-                                else:
-                                    main_block = sand_block
-                            init_block((x, y, z), main_block)
-
-                            veget_choice = rand_random()
-                            veget_blocks = None
-                            if veget_choice < TREE_CHANCE:
-                                veget_blocks = world_type_trees
-                            elif veget_choice < WILDFOOD_CHANCE:
-                                veget_blocks = world_type_plants
-                            elif veget_choice < GRASS_CHANCE:
-                                veget_blocks = world_type_grass
-                            if veget_blocks is not None:
-                                world.generate_vegetation((x, y + 1, z),
-                                                    choose(veget_blocks))
-
-                            if main_block == sand_block:
-                                underground_blocks = (
-                                    sand_block, sand_block, sandstone_block)
-                            elif main_block == stone_block:
-                                underground_blocks = (stone_block,) * 3
-                            elif main_block == nether_block:
-                                underground_blocks = self.nether
-                            else:
-                                underground_blocks = (dirt_block,) * 3
-
-                            for d, block in enumerate(underground_blocks,
-                                                      start=1):
-                                init_block((x, y - d, z), block)
-
-                            y -= 3
-
-                    for yy in xrange(by, y):
-                        # ores and filler...
-                        if yy >= 32:
-                            blockset = highlevel_ores
-                        elif yy > 9:
-                            blockset = midlevel_ores
-                        elif yy > 2:
-                            blockset = lowlevel_ores
-                        elif yy <= 1:
-                            blockset = (bedrock_block, )
-
-                        init_block((x, yy, z), choose(blockset))
-                        #if yy == 0:
-                         #   init_block((x, 0, z), bedrock_block)
+class RegenerationWorld(BlockStorage):
+    """
+    A bare world holding nothing but freshly generated terrain, to find out
+    what generate_sector produces for a region without touching the real
+    world. Saved sectors can then be stored as diffs against it.
+    """
+    def __init__(self, seed):
+        super(RegenerationWorld, self).__init__()
+        import savingsystem #This module doesn't like being imported at modulescope
+        self.savingsystem = savingsystem
+        self.terraingen = TerrainGeneratorSimple(self, seed)
+
+    def add_block(self, position, block, sync=False, force=True, check_spread=False):
+        if not force and position in self:
+            return
+        self[position] = block
+
+    def init_block(self, position, block):
+        self.add_block(position, block, force=False)
+
+    def has_neighbors(self, position, is_in=None, diagonals=False):
+        x, y, z = position
+        for dx, dy, dz in FACES_WITH_DIAGONALS if diagonals else FACES:
+            other = self.get((x + dx, y + dy, z + dz))
+            if other is not None and (is_in is None or other in is_in):
+                return True
+        return False
+
+    def generate_vegetation(self, position, vegetation_class, rand=random):
+        grow_vegetation(self, position, vegetation_class, rand)
+
+    def generate_region(self, region):
+        """
+        Generates a region (4x4x4 sectors) the way WorldServer.open_sector does
+        and returns its 64 raw 1024 byte sectors, in sector_to_offset order.
+        """
+        rx, ry, rz = region
+        sectors = [(x, y, z) for x in xrange(rx*4, rx*4+4) for y in xrange(ry*4, ry*4+4) for z in xrange(rz*4, rz*4+4)]
+        for sector in sectors:
+            self.terraingen.generate_sector(sector)
+        return [self.encode_sector(sector) for sector in sectors]
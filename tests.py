@@ -1,21 +1,47 @@
 # Imports, sorted alphabetically.
 
 # Python packages
+import os
+import pickle
 import random
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
 
 # Third-party packages
 # Nothing for now...
 
 # Modules from this project
+from blocks import block_and_metadata, BlockID
+from blockstorage import BlockStorage
 from crafting import Recipes
+from entity import FurnaceEntity, TileEntity
+from generation import generate_sectors, GenerationService
 import globals as G
+from heightmap import HeightMap
 from inventory import Inventory
 from items import ItemStack
+from journal import BlockJournal, JOURNAL_ADD, JOURNAL_REMOVE
+from pregen import OfflineServer, pregen_regions
+import regionfile
+from regionlocks import block_regions, RegionLocks
+from residency import region_sectors, ResidentSet, SECTOR_BYTES
+import sectorcodec
+from sectorview import exposed_bitmap, sector_view, view_index
+import savingsystem
+from terrain import BIOME_PARAMETERS, BiomeParameters, RegenerationWorld, TerrainGeneratorSimple
+from world import World
+from world_server import WorldServer
 
 
 __all__ = (
-    'InventoryTests', 'CraftingTests',
+    'InventoryTests', 'CraftingTests', 'RegionFileTests', 'JournalTests',
+    'SectorCodecTests', 'BlockStorageTests', 'ResidentSetTests',
+    'RegionLocksTests', 'HeightMapTests', 'SectorViewTests', 'BlockIDTests',
+    'TerrainTests', 'PregenTests', 'WorldServerTests', 'PlayerStoreTests',
+    'ClientWorldTests',
 )
 
 
@@ -176,5 +202,557 @@ class CraftingTests(unittest.TestCase):
     def test_add_5(self):
         self.test_add_2(characters='!@#$123456789')
 
+class RegionFileTests(unittest.TestCase):
+
+    def random_sector(self, palette_size):
+        palette = [chr(random.randint(0, 255)) + chr(random.randint(0, 255)) for i in xrange(palette_size)]
+        return ''.join(random.choice(palette) for i in xrange(512))
+
+    def test_encode_decode(self):
+        for palette_size in [1, 2, 3, 4, 15, 16, 17, 200, 256, 300]:
+            for level in [0, 6]:
+                fstr = self.random_sector(palette_size)
+                payload = regionfile.encode_sector(fstr, compression_level=level)
+                self.assertEqual(regionfile.decode_sector(payload), fstr)
+
+    def test_empty_sector(self):
+        self.assertEqual(regionfile.encode_sector(regionfile.null1024), '')
+        self.assertEqual(regionfile.decode_sector(''), regionfile.null1024)
+
+    def test_diff(self):
+        baseline = self.random_sector(20)
+        fstr = baseline[:100] + self.random_sector(3)[100:140] + baseline[140:]
+        for level in [0, 6]:
+            payload = regionfile.encode_sector(fstr, compression_level=level, baseline=baseline)
+            self.assertTrue(regionfile.is_diff(payload))
+            self.assertEqual(regionfile.decode_sector(payload, baseline), fstr)
+            self.assertRaises(ValueError, regionfile.decode_sector, payload)
+        self.assertEqual(len(regionfile.encode_sector(baseline, compression_level=0, baseline=baseline)), 3)
+
+    def test_header_flags(self):
+        path = os.path.join(tempfile.mkdtemp(), '0.0.0.pyr')
+        manager = regionfile.RegionFileManager(2, 2)
+        try:
+            fstr = self.random_sector(3)
+            manager.write_region_sectors(path, {0: fstr, 1: regionfile.null1024, 2: fstr}, partial=set([2]))
+            self.assertEqual(manager.sector_flags(path, 0), (True, False))
+            self.assertEqual(manager.sector_flags(path, 1), (True, True))
+            self.assertEqual(manager.sector_flags(path, 2), (False, False))
+            self.assertEqual(manager.sector_flags(path, 3), (False, False))
+            # A partly generated sector never replaces a present one
+            manager.write_region_sectors(path, {0: regionfile.null1024}, partial=set([0]))
+            manager.write_region_sectors(path, {1: fstr})
+            self.assertEqual(manager.read_region(path)[:3], [fstr, fstr, fstr])
+            self.assertEqual(manager.header(path).versions[:4], [1, 2, 1, 0])
+            # Its blocks go where the stored sector has air, which stays present
+            other = self.random_sector(3)
+            manager.write_region_sectors(path, {3: regionfile.null1024[:200] + fstr[200:]})
+            manager.write_region_sectors(path, {3: other}, partial=set([3]))
+            self.assertEqual(manager.read_region(path)[3], other[:200] + fstr[200:])
+            self.assertEqual(manager.sector_flags(path, 3), (True, False))
+        finally:
+            manager.close()
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_interrupted_write(self):
+        path = os.path.join(tempfile.mkdtemp(), '0.0.0.pyr')
+        manager = regionfile.RegionFileManager(2, 2)
+        try:
+            old, new = self.random_sector(3), self.random_sector(3)
+            manager.write_region_sectors(path, {0: old, 1: old})
+            with open(path, 'rb') as f:
+                old_header = f.read(regionfile.HEADER_SIZE)
+            manager.write_region_sectors(path, {0: new})
+            manager.close()
+            # A crash before the new header reached the disk leaves the old sectors
+            with open(path, 'rb+') as f:
+                f.write(old_header)
+            self.assertEqual(manager.read_region(path)[:2], [old, old])
+        finally:
+            manager.close()
+            shutil.rmtree(os.path.dirname(path))
+
+class JournalTests(unittest.TestCase):
+
+    def test_replay_and_rotate(self):
+        directory = tempfile.mkdtemp()
+        try:
+            journal = BlockJournal(directory)
+            journal.add((1, -2, 3), G.BLOCKS_DIR[(1, 0)].id)
+            journal.remove((4, 5, -6))
+            old_segments = journal.rotate()
+            journal.add((7, 8, 9), G.BLOCKS_DIR[(2, 0)].id)
+            self.assertEqual(list(journal.replay()), [
+                (JOURNAL_ADD, (1, -2, 3), (1, 0)),
+                (JOURNAL_REMOVE, (4, 5, -6), (0, 0)),
+                (JOURNAL_ADD, (7, 8, 9), (2, 0)),
+            ])
+            journal.discard(old_segments)
+            self.assertEqual(list(BlockJournal(directory).replay()), [(JOURNAL_ADD, (7, 8, 9), (2, 0))])
+        finally:
+            shutil.rmtree(directory)
+
+class SectorCodecTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        secpos = (random.randint(-50, 50), random.randint(0, 8), random.randint(-50, 50))
+        cx, cy, cz = secpos[0] * 8, secpos[1] * 8, secpos[2] * 8
+        world = {}
+        for x, y, z in sectorcodec.SECTOR_OFFSETS:
+            if random.random() < 0.5:
+                world[(cx + x, cy + y, cz + z)] = random.choice(G.BLOCKS_DIR.values())
+        fstr = sectorcodec.encode_sector(world, secpos)
+        self.assertEqual(len(fstr), 1024)
+        decoded = dict((position, full_id) for _, position, full_id in sectorcodec.iter_sector_blocks(fstr, secpos))
+        expected = dict((position, (block.id.main, block.id.sub)) for position, block in world.iteritems()
+                        if block.id.main or block.id.sub)
+        self.assertEqual(decoded, expected)
+
+class BlockStorageTests(unittest.TestCase):
+
+    def test_matches_dict(self):
+        storage = BlockStorage()
+        world = {}
+        choices = [block for block in G.BLOCKS_DIR.values() if block.id.main]
+        for _ in xrange(2000):
+            position = (random.randint(-20, 20), random.randint(0, 20), random.randint(-20, 20))
+            if position in world and random.random() < 0.3:
+                del world[position]
+                del storage[position]
+            else:
+                world[position] = storage[position] = random.choice(choices)
+        self.assertEqual(len(storage), len(world))
+        self.assertEqual(sorted(storage.keys()), sorted(world.keys()))
+        for position, block in world.iteritems():
+            self.assertIn(position, storage)
+            self.assertEqual(storage[position].id, block.id)
+        for secpos in storage.sectors:
+            self.assertEqual(storage.encode_sector(secpos), sectorcodec.encode_sector(world, secpos))
+
+    def test_metadata(self):
+        storage = BlockStorage()
+        crop, stone = G.BLOCKS_DIR[(59, 0)], G.BLOCKS_DIR[(1, 0)]
+        storage[(9, -3, 2)] = crop
+        storage[(9, -3, 3)] = stone
+        storage.set_metadata((9, -3, 2), 5)
+        storage.set_metadata((9, -3, 3), 5)
+        self.assertIs(storage[(9, -3, 2)], crop)
+        self.assertEqual(storage.get_metadata((9, -3, 2)), 5)
+        self.assertIs(storage[(9, -3, 3)], stone)
+        self.assertEqual(storage.get_metadata((9, -3, 3)), 0)
+        self.assertEqual(storage.sectors[(1, -1, 0)], [(9, -3, 2), (9, -3, 3)])
+        storage.entities[(9, -3, 2)] = object()
+        del storage[(9, -3, 2)]
+        self.assertNotIn((9, -3, 2), storage)
+        self.assertEqual(storage.entities, {})
+        self.assertEqual(len(storage), 1)
+
+    def test_decode_sector(self):
+        crop, stone = G.BLOCKS_DIR[(59, 0)], G.BLOCKS_DIR[(1, 0)]
+        self.assertEqual(block_and_metadata((59, 6)), (crop, 6))
+        self.assertEqual(block_and_metadata((1, 0)), (stone, 0))
+        self.assertRaises(KeyError, block_and_metadata, (1, 200))
+        world = {(0, 1, 2): stone, (3, 4, 5): crop}
+        fstr = sectorcodec.encode_sector(world, (0, 0, 0))
+        # Unregistered blocks are left out
+        fstr = fstr[:-2] + chr(1) + chr(200)
+        storage = BlockStorage()
+        storage[(7, 7, 6)] = stone
+        storage.decode_sector((0, 0, 0), fstr)
+        self.assertEqual(sorted(storage.keys()), [(0, 1, 2), (3, 4, 5), (7, 7, 6)])
+
+class ResidentSetTests(unittest.TestCase):
+
+    def test_victims(self):
+        storage = BlockStorage()
+        resident = ResidentSet(0)
+        for region in ((0, 0, 0), (1, 0, 0), (2, 0, 0), (3, 0, 0)):
+            storage[(region[0] * 32, 0, 0)] = G.BLOCKS_DIR[(1, 0)]
+            resident.touch(region)
+        resident.touch((0, 0, 0))
+        self.assertFalse(resident.over_budget(storage))
+        resident.budget = 3 * SECTOR_BYTES
+        self.assertTrue(resident.over_budget(storage))
+        # Least recently used first, down to 90% of the budget
+        self.assertEqual(resident.victims(storage, set()), [(1, 0, 0), (2, 0, 0)])
+        self.assertEqual(resident.victims(storage, {(1, 0, 0)}), [(2, 0, 0), (3, 0, 0)])
+
+class RegionLocksTests(unittest.TestCase):
+
+    def test_block_regions(self):
+        self.assertEqual(block_regions((31, 0, -1), (32, 0, -1)), [(0, 0, -1), (1, 0, -1)])
+
+    def test_ordering(self):
+        locks = RegionLocks()
+        with locks.hold([(1, 0, 0), (0, 0, 0)]):
+            # Regions already held, or sorted after them, can be added
+            with locks.hold([(0, 0, 0), (2, 0, 0)]):
+                pass
+            self.assertRaises(RuntimeError, locks.hold([(-1, 0, 0)]).__enter__)
+        with locks.hold([(-1, 0, 0)]):
+            pass
+        self.assertEqual(locks.stats()['acquisitions'], 4)
+        self.assertEqual(locks.stats()['contended'], 0)
+        # Nothing is kept for the regions no thread uses anymore
+        self.assertEqual(locks.locks, {})
+
+class HeightMapTests(unittest.TestCase):
+
+    def test_heights(self):
+        stone, glass = G.BLOCKS_DIR[(1, 0)], G.BLOCKS_DIR[(20, 0)]
+        directory = tempfile.mkdtemp()
+        try:
+            storage = BlockStorage()
+            heights = HeightMap(storage, directory)
+            for sector in ((0, 0, -1), (0, 1, -1), (0, 2, -1)):
+                storage.sectors[sector] = []
+            for position, block in (((1, 2, -1), stone), ((1, 9, -1), stone), ((1, 12, -1), glass)):
+                storage[position] = block
+                heights.block_added(position, block)
+            self.assertEqual((heights.get(1, -1), heights.get(1, -1, opaque=True)), (12, 9))
+            self.assertEqual(heights.get(2, -1), None)
+            # Removing the top finds the next block below, across sectors
+            for position in ((1, 12, -1), (1, 9, -1)):
+                del storage[position]
+                heights.block_removed(position)
+            self.assertEqual((heights.get(1, -1), heights.get(1, -1, opaque=True)), (2, 2))
+            # Loaded without block_added
+            storage[(1, 20, -1)] = stone
+            heights.add_sectors([(0, 2, -1)])
+            self.assertEqual(heights.get(1, -1), 20)
+            # Unsaved chunks stay in memory, saved ones are read back when needed
+            self.assertEqual(heights.drop_columns([(0, -1)]), 0)
+            chunks = heights.snapshot()
+            heights.save_chunks(chunks)
+            self.assertEqual(heights.drop_columns([(0, -1)]), 0)
+            heights.saved(chunks)
+            self.assertEqual(heights.drop_columns([(0, -1)]), 1)
+            self.assertEqual(heights.chunks, {})
+            self.assertEqual(heights.get(1, -1), 20)
+            self.assertEqual(HeightMap(BlockStorage(), directory).get(1, -1), 20)
+        finally:
+            shutil.rmtree(directory)
+
+
+class SectorViewTests(unittest.TestCase):
+
+    def test_view(self):
+        stone, glass = G.BLOCKS_DIR[(1, 0)], G.BLOCKS_DIR[(20, 0)]
+        storage = BlockStorage()
+        # A stone in the corner of sector (1, 0, -1), glass above it and
+        # stone behind it, in the neighbouring sectors
+        for position, block in (((8, 7, -8), stone), ((8, 8, -8), glass), ((7, 7, -8), stone)):
+            storage[position] = block
+        view = sector_view(storage, (1, 0, -1))
+        self.assertEqual(view, sector_view(dict(storage.items()), (1, 0, -1)))
+        self.assertEqual(view[view_index(1, 8, 1)], stone.id.main << 8)
+        self.assertEqual(view[view_index(1, 9, 1)], glass.id.main << 8)
+        self.assertEqual(view[view_index(0, 8, 1)], stone.id.main << 8)
+        # Only blocks of the sector itself are in its bitmap
+        bitmap = exposed_bitmap(view)
+        self.assertEqual([i for i in xrange(512) if bitmap[i >> 3] >> (i & 7) & 1], [7 << 3])
+
+
+class BlockIDTests(unittest.TestCase):
+
+    def test_interned(self):
+        wool = BlockID(35, 3)
+        for other in ((35, 3), "35.3", "35,3", wool):
+            self.assertIs(BlockID(other), wool)
+        self.assertIsNot(BlockID(35), wool)
+        self.assertEqual(hash(wool), hash((35, 3)))
+        self.assertEqual(wool, (35, 3))
+        self.assertEqual(wool, 35)
+        self.assertTrue(BlockID(1) < 255)
+        self.assertIs(G.BLOCKS_DIR[(1, 0)].id, BlockID(1))
+        self.assertRaises(AttributeError, setattr, wool, 'sub', 4)
+        self.assertIs(pickle.loads(pickle.dumps(wool)), wool)
+
+
+class TerrainTests(unittest.TestCase):
+
+    def setUp(self):
+        self.seed, G.SEED = G.SEED, 'columns'
+
+    def tearDown(self):
+        G.SEED = self.seed
+
+    def test_heights(self):
+        generator = TerrainGeneratorSimple(None, 'heights')
+        for x, z, size in ((0, 0, 8), (-1234, 5678, 8), (-40, -72, 32)):
+            self.assertEqual(generator.get_heights(x, z, size),
+                             [generator.get_height(x + dx, z + dz) for dx in xrange(size) for dz in xrange(size)])
+
+    def test_column_cache(self):
+        world = RegenerationWorld(G.SEED)
+        world.generate_region((0, 1, 0))
+        # One miss per sector column, the three other sectors of the column hit
+        stats = world.terraingen.columns.stats()
+        self.assertEqual((stats['misses'], stats['hits']), (16, 48))
+        self.assertEqual((stats['height_misses'], stats['height_hits']), (16, 48))
+        # Other BiomeParameters for the same column get their own heights
+        generator, column = world.terraingen, world.terraingen.columns.column(0, 0)
+        parameters = BiomeParameters(G.BLOCKS_DIR[(1, 0)], False, 0, height_base=40, height_range=8)
+        heights = generator.columns.heights(column, 0, 0, parameters)
+        self.assertEqual(heights, generator.get_heights(0, 0, parameters=parameters))
+        self.assertNotEqual(heights, generator.columns.heights(column, 0, 0, BIOME_PARAMETERS[column.biome]))
+
+    def test_generate_sectors(self):
+        expected = RegenerationWorld(G.SEED).generate_region((0, 1, 0))
+        sectors = region_sectors((0, 1, 0))
+        generated = generate_sectors(sectors, RegenerationWorld(G.SEED))
+        # The requested sectors first, then the ones vegetation grew into
+        self.assertEqual([(secpos, fstr) for secpos, fstr, requested in generated if requested],
+                         zip(sectors, expected))
+        self.assertFalse(set(sectors) & set(secpos for secpos, fstr, requested in generated if not requested))
+
+    def test_sector_buffers(self):
+        expected = RegenerationWorld(G.SEED).generate_region((0, 1, 0))
+        world = RegenerationWorld(G.SEED)
+        generator = world.terraingen
+        attributes = dict((name, getattr(generator, name)) for name in
+                          ('height_base', 'height_range', 'water_level', 'zoom_level', 'world_type_grass'))
+        sectors = region_sectors((0, 1, 0))
+        # All the buffers first, as threads would make them, then in the world in order
+        buffers = [generator.generate_sector_buffer(sector) for sector in sectors]
+        self.assertEqual(attributes, dict((name, getattr(generator, name)) for name in attributes))
+        for sector, (ids, deferred, spill) in zip(sectors, buffers):
+            world.sectors[sector] = []
+            generator.commit_sector(sector, ids, deferred, spill)
+        self.assertEqual([world.encode_sector(sector) for sector in sectors], expected)
+
+
+class PregenTests(unittest.TestCase):
+
+    def test_pregen_regions(self):
+        regions = pregen_regions((2, 2), 4)
+        # Sectors -2 to 6 span regions -1 to 1, from y 0 to 63
+        self.assertEqual(sorted(regions), [(x, y, z) for x in (-1, 0, 1) for y in (0, 1) for z in (-1, 0, 1)])
+        self.assertEqual(regions[:2], [(0, 0, 0), (0, 1, 0)])
+
+
+class WorldServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = G.game_dir, G.worlds_dir, G.SAVE_FILENAME, G.SEED
+        G.game_dir, G.SAVE_FILENAME = tempfile.mkdtemp(), 'world'
+        G.worlds_dir = os.path.join(G.game_dir, 'worlds')
+        os.makedirs(os.path.join(G.game_dir, 'world'))
+        with open(os.path.join(G.game_dir, 'world', 'seed'), 'wb') as f:
+            f.write('merge')
+        self.world = WorldServer(OfflineServer())
+
+    def tearDown(self):
+        savingsystem.close_player_stores()
+        shutil.rmtree(G.game_dir)
+        G.game_dir, G.worlds_dir, G.SAVE_FILENAME, G.SEED = self.saved
+
+    def test_merge_generated(self):
+        world = self.world
+        stone, dirt, furnace = G.BLOCKS_DIR[(1, 0)], G.BLOCKS_DIR[(3, 0)], G.BLOCKS_DIR[(61, 0)]
+        world[(0, 40, 0)] = stone
+        generated = BlockStorage()
+        generated[(0, 40, 0)] = dirt
+        generated[(1, 40, 0)] = dirt
+        generated[(2, 41, 0)] = furnace
+        world.merge_generated([((0, 5, 0), generated.encode_sector((0, 5, 0)), True)])
+        # The blocks already there stay, like with init_block
+        self.assertIs(world[(0, 40, 0)], stone)
+        self.assertIs(world[(1, 40, 0)], dirt)
+        self.assertTrue(isinstance(world.entities[(2, 41, 0)], furnace.entity_type))
+        self.assertEqual(world.dirty_sectors, set([(0, 5, 0)]))
+        self.assertEqual(world.highest_block(2, 0), 41)
+
+    def test_exposed_cache(self):
+        world = self.world
+        stone = G.BLOCKS_DIR[(1, 0)]
+        # A slab across the x, y and z borders of sectors (0, 0, 0) to (1, 1, 1)
+        for x in xrange(4, 12):
+            for y in xrange(5, 10):
+                for z in xrange(4, 12):
+                    world.add_block((x, y, z), stone, sync=False, check_spread=False)
+        sectors = [(x, y, z) for x in (0, 1) for y in (0, 1) for z in (0, 1)]
+        for secpos in sectors:
+            world.get_exposed_sector(secpos)
+        # On the borders, so the neighbours' bits change in other sectors
+        for position in ((7, 9, 7), (8, 9, 8), (8, 8, 8), (7, 7, 7), (8, 7, 7)):
+            world.remove_block(position, sync=False, check_spread=False)
+        for position in ((12, 7, 8), (7, 9, 7), (8, 10, 8)):
+            world.add_block(position, stone, sync=False, check_spread=False)
+        for secpos in sectors:
+            self.assertEqual(world.get_exposed_sector(secpos), str(exposed_bitmap(sector_view(world, secpos))))
+        # Loading a region changes its blocks without add_block, its bitmaps go
+        world.savingsystem.save_blocks(world, G.SAVE_FILENAME)
+        world._load_saved((0, 0, 0))
+        self.assertEqual(world.exposed_cache, {})
+
+    def test_save_writer(self):
+        world = self.world
+        stone, dirt = G.BLOCKS_DIR[(1, 0)], G.BLOCKS_DIR[(3, 0)]
+        path = os.path.join(G.game_dir, 'world', savingsystem.region_to_filename((0, 0, 0)))
+        stored = lambda: str(regionfile.region_files.read_region(path, savingsystem.RegeneratedRegion((0, 0, 0)))[0])
+        writer = savingsystem.SaveWriter()
+        held = threading.Event()
+
+        class Held(object):
+            def run(self):
+                held.wait()
+
+        class Failing(savingsystem.SaveJob):
+            def write(self):
+                raise IOError("No space left on device")
+
+        # Two snapshots of the same sector queued behind a job that waits
+        world.open_sector((0, 0, 0))
+        world.dirty_sectors.clear()
+        writer.submit(Held())
+        world.add_block((0, 0, 0), stone, sync=False, check_spread=False)
+        first = writer.submit(savingsystem.SaveJob(world, 'world', *savingsystem.snapshot_blocks(world)))
+        world.add_block((0, 0, 0), dirt, sync=False, check_spread=False)
+        second = writer.submit(savingsystem.SaveJob(world, 'world', *savingsystem.snapshot_blocks(world)))
+        self.assertFalse(first.done.is_set())
+        held.set()
+        self.assertEqual(second.wait()[0], 1)
+        self.assertTrue(first.done.is_set())
+        self.assertEqual(stored(), savingsystem.save_sector_to_string(world, (0, 0, 0)))
+        # A failed job leaves its sectors and heights to be saved next time
+        top = (1, world.highest_block(1, 0), 0)
+        world.remove_block(top, sync=False, check_spread=False)
+        failing = writer.submit(Failing(world, 'world', *savingsystem.snapshot_blocks(world)))
+        self.assertRaises(IOError, failing.wait)
+        self.assertEqual(world.dirty_sectors, set([(0, top[1] / G.SECTOR_SIZE, 0)]))
+        self.assertTrue(world.heightmap.dirty)
+        writer.stop()
+        # save_blocks returns once its job is on disk
+        self.assertEqual(savingsystem.save_blocks(world, 'world')[0], 1)
+        self.assertEqual(world.dirty_sectors, set())
+        self.assertFalse(world.heightmap.dirty)
+        self.assertEqual(stored(), savingsystem.save_sector_to_string(world, (0, 0, 0)))
+
+    def test_save_dirty_sectors(self):
+        world = self.world
+        regions = ((0, 0, 0), (1, 0, 0))
+        paths = [os.path.join(G.game_dir, 'world', savingsystem.region_to_filename(region)) for region in regions]
+        stored = lambda region, path: [fstr and str(fstr) for fstr in regionfile.region_files.read_region(
+            path, savingsystem.RegeneratedRegion(region))]
+        for region in regions:
+            world.open_sector(region_sectors(region)[0])
+        savingsystem.save_blocks(world, 'world')
+        before = [stored(region, path) for region, path in zip(regions, paths)]
+        sizes = [os.path.getsize(path) for path in paths]
+        other = open(paths[1], 'rb').read()
+        # One block in sector (1, 0, 0) of region (0, 0, 0)
+        world.add_block((9, 2, 1), G.BLOCKS_DIR[(3, 0)], sync=False, check_spread=False)
+        self.assertEqual(savingsystem.save_blocks(world, 'world'),
+                         (1, os.path.getsize(paths[0]) - sizes[0] + regionfile.HEADER_SIZE))
+        self.assertEqual(world.dirty_sectors, set())
+        after = stored(regions[0], paths[0])
+        index = savingsystem.sector_to_offset((1, 0, 0)) / 1024
+        self.assertEqual([i for i in xrange(len(after)) if after[i] != before[0][i]], [index])
+        self.assertEqual(after[index], savingsystem.save_sector_to_string(world, (1, 0, 0)))
+        self.assertEqual(open(paths[1], 'rb').read(), other)
+        # Nothing left to write
+        size = os.path.getsize(paths[0])
+        self.assertEqual(savingsystem.save_blocks(world, 'world'), (0, 0))
+        self.assertEqual(os.path.getsize(paths[0]), size)
+
+    def test_replay_journal(self):
+        world = self.world
+        stone, bed = G.BLOCKS_DIR[(1, 0)], G.BLOCKS_DIR[(26, 0)]
+        world.open_sector((0, 0, 0))
+        savingsystem.save_blocks(world, 'world')
+        bed_at = (2, world.highest_block(2, 2) + 1, 2)
+        dug = (5, world.highest_block(5, 5), 5)
+        placed = (6, world.highest_block(6, 6) + 1, 6)
+        world.add_block(bed_at, bed, sync=False, check_spread=False, metadata=3)
+        world.remove_block(dug, sync=False, check_spread=False)
+        world.add_block(placed, stone, sync=False, check_spread=False)
+        world.remove_block(placed, sync=False, check_spread=False)
+        # The server stops before the next save
+        world.journal.commit()
+        world.journal.file.close()
+        sectors = set((x / G.SECTOR_SIZE, y / G.SECTOR_SIZE, z / G.SECTOR_SIZE) for x, y, z in (bed_at, dug, placed))
+        world = WorldServer(OfflineServer())
+        # Generating the regions above dirties the sectors it spills into
+        for secpos in sectors:
+            world.open_sector(secpos)
+        world.dirty_sectors.clear()
+        self.assertEqual(world.replay_journal(), 4)
+        self.assertIs(world[bed_at], bed)
+        self.assertEqual(world.get_metadata(bed_at), 3)
+        self.assertNotIn(dug, world)
+        self.assertNotIn(placed, world)
+        self.assertEqual(world.dirty_sectors, sectors)
+
+    def test_generate_without_pool(self):
+        # What open_sector gets when a worker dies or the pool is stopped
+        self.assertIsNone(GenerationService('seed', 0).generate([(0, 0, 0)]))
+
+
+class PlayerStoreTests(unittest.TestCase):
+
+    class Player(object):
+        def __init__(self, username, position=None):
+            self.username = username
+            self.position = position
+            self.momentum = (0.0, -1.5, 0.0)
+            self.inventory = struct.pack("HBB", 300, 200, 255) * 40
+
+    def setUp(self):
+        self.saved = G.worlds_dir
+        G.worlds_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        savingsystem.close_player_stores()
+        shutil.rmtree(G.worlds_dir)
+        G.worlds_dir = self.saved
+
+    def test_round_trip(self):
+        store = savingsystem.player_store('world')
+        self.assertIs(savingsystem.player_store('world'), store)
+        # A name that would break a statement built from strings
+        players = [self.Player("o'brien", (1.0, 2.0, 3.0)), self.Player('steve', (-4.5, 70.0, 8.25)),
+                   self.Player('connecting')]
+        self.assertEqual(store.save_players(players), 2)
+        players[1].position = (0.0, 71.0, 0.0)
+        self.assertEqual(store.save_players(players[1:]), 1)
+        savingsystem.close_player_stores()
+        store = savingsystem.player_store('world')
+        for saved, position in zip(players, ([1.0, 2.0, 3.0], [0.0, 71.0, 0.0])):
+            loaded = self.Player(saved.username)
+            store.load_player(loaded)
+            self.assertEqual(loaded.position, position)
+            self.assertEqual(loaded.momentum, [0.0, -1.5, 0.0])
+            self.assertEqual(loaded.inventory, saved.inventory)
+        # Never saved, so it starts over
+        loaded = self.Player('connecting', (5.0, 5.0, 5.0))
+        store.load_player(loaded)
+        self.assertIsNone(loaded.position)
+        self.assertEqual(loaded.inventory, struct.pack("HBB", 0, 0, 0) * 40)
+
+
+class ClientWorldTests(unittest.TestCase):
+
+    class World(World):
+        def _show_block(self, position, block):
+            pass  # No GL context to draw in
+
+    def test_furnace(self):
+        world = self.World()
+        world._add_block((0, 0, 0), G.BLOCKS_DIR[(61, 0)])
+        world._add_block((1, 0, 0), G.BLOCKS_DIR[(59, 0)])
+        # What the inventory's furnace panel uses when the player opens it
+        furnace = world.entities[(0, 0, 0)]
+        self.assertTrue(isinstance(furnace, FurnaceEntity))
+        self.assertEqual(furnace.slot_count, 2)
+        callback = lambda: None
+        furnace.set_outcome_callback(callback)
+        furnace.set_fuel_callback(callback)
+        self.assertEqual(furnace.get_items(), [None, None])
+        self.assertIs(furnace.outcome_callback, callback)
+        # The server grows crops, the client only keeps their position
+        self.assertIs(type(world.entities[(1, 0, 0)]), TileEntity)
+
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -14,7 +14,10 @@ cdef class World(dict):
         savingsystem
         dict shown
         dict _shown
+        dict metadata
+        dict entities
         sectors
+        heightmap
         urgent_queue, lazy_queue
         sector_queue
         generation_queue
@@ -29,7 +32,13 @@ cdef class World(dict):
     cpdef object add_block(self, tuple position, object block,
                            bint sync=?, bint force=?)
 
-    cpdef object _add_block(self, tuple position, object block)
+    cpdef object _add_block(self, tuple position, object block, int metadata=?)
+
+    cpdef int get_metadata(self, tuple position)
+
+    cpdef object set_metadata(self, tuple position, int metadata)
+
+    cpdef object highest_block(self, int x, int z, bint opaque=?)
 
     cpdef object remove_block(self, object player, tuple position,
                               bint sync=?, bint sound=?)
@@ -71,7 +80,7 @@ cdef class World(dict):
                    count=int, batch=object)
     cpdef object _show_block(self, tuple position, object block)
 
-    @cython.locals(position=tuple)
+    @cython.locals(position=tuple, x=int, y=int, z=int, i=int)
     cpdef object _show_sector(self, tuple sector)
 
     @cython.locals(position=tuple)
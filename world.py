@@ -16,6 +16,8 @@ from utils import FACES, FACES_WITH_DIAGONALS, normalize_float, normalize, secto
 import globals as G
 from client import PacketReceiver
 from entity import TileEntity
+from heightmap import HeightMap
+from sectorview import exposed_bitmap, sector_view
 
 
 __all__ = (
@@ -37,7 +39,10 @@ class World(dict):
 
         self.shown = {}
         self._shown = {}
-        self.sectors = defaultdict(list)
+        self.metadata = {}  # Position -> metadata of sub_id_as_metadata blocks, if not 0
+        self.entities = {}  # Position -> TileEntity
+        self.sectors = defaultdict(OrderedDict)  # Ordered sets of the positions in each sector
+        self.heightmap = HeightMap(self)  # Of the sectors received so far
         self.before_set = set()
         self.urgent_queue = deque()
         self.lazy_queue = deque()
@@ -48,6 +53,28 @@ class World(dict):
         # biome generator for colorizer, set by packet receiver
         self.biome_generator = None
 
+    def __delitem__(self, position):
+        super(World, self).__delitem__(position)
+        self.metadata.pop(position, None)
+        self.entities.pop(position, None)
+
+    def get_metadata(self, position):
+        return self.metadata.get(position, 0)
+
+    def set_metadata(self, position, metadata):
+        if self[position].sub_id_as_metadata:
+            if metadata:
+                self.metadata[position] = metadata
+            else:
+                self.metadata.pop(position, None)
+
+    def highest_block(self, x, z, opaque=False):
+        """
+        Returns the y of the highest block of the (x, z) column, or of the
+        highest opaque block; None if there is none.
+        """
+        return self.heightmap.get(x, z, opaque)
+
     # Add the block clientside, then tell the server about the new block
     def add_block(self, position, block, sync=True, force=True):
         self._add_block(position, block)  # For Prediction
@@ -55,23 +82,22 @@ class World(dict):
             self.packetreceiver.add_block(position, block)
 
     # Clientside, add the block
-    def _add_block(self, position, block):
+    def _add_block(self, position, block, metadata=0):
         if position in self:
             self._remove_block(position, sync=True)
+        self[position] = block
+        if metadata:
+            self.set_metadata(position, metadata)
+        self.heightmap.block_added(position, block)
         if hasattr(block, 'entity_type'):
             # in world_server we have to create its entity to handle some tasks(growing, etc.)
-            # but in client's world, we only create a TileEntity that contains the position
-            # and the world to allow the block update itself and server will handle the task
-            # and tell us
-            self[position] = type(block)()
-            self[position].entity = TileEntity(self, position)
-        elif block.sub_id_as_metadata:
-            self[position] = type(block)()
-            self[position].set_metadata(block.get_metadata())
-        else:
-            self[position] = block
+            # but in client's world, server-only entities are a TileEntity that contains the
+            # position and the world to allow the block update itself and server will handle
+            # the task and tell us. Others, like the furnace's slots, are needed client-side too
+            entity_type = TileEntity if block.entity_type.server_only else block.entity_type
+            self.entities[position] = entity_type(self, position)
 
-        self.sectors[sectorize(position)].append(position)
+        self.sectors[sectorize(position)][position] = None
         if self.is_exposed(position):
             self.show_block(position)
         self.inform_neighbors_of_block_change(position)
@@ -86,10 +112,11 @@ class World(dict):
     # Clientside, delete the block
     def _remove_block(self, position, sync=True):
         del self[position]
+        self.heightmap.block_removed(position)
         sector_position = sectorize(position)
         try:
-            self.sectors[sector_position].remove(position)
-        except ValueError:
+            del self.sectors[sector_position][position]
+        except KeyError:
             warnings.warn('Block %s was unexpectedly not found in sector %s;'
                           'your save is probably corrupted'
                           % (position, sector_position))
@@ -178,7 +205,7 @@ class World(dict):
         # only show exposed faces
         index = 0
         vertex_data = list(block.get_vertices(*position))
-        texture_data = list(block.texture_data)
+        texture_data = list(block.texture_data_for(self.get_metadata(position)))
         color_data = None
         if hasattr(block, 'get_color') and self.biome_generator is not None:
             temp = self.biome_generator.get_temperature(position[0], position[-1])
@@ -215,13 +242,16 @@ class World(dict):
         if sector in self.sectors:
             self._show_sector(sector)
         else:
-            self.sectors[sector] = [] #Initialize it so we don't keep requesting it
+            self.sectors[sector] = OrderedDict() #Initialize it so we don't keep requesting it
             self.packetreceiver.request_sector(sector)
 
     #Clientside, show a sector we've downloaded
     def _show_sector(self, sector):
+        exposed = exposed_bitmap(sector_view(self, sector))
         for position in self.sectors[sector]:
-            if position not in self.shown and self.is_exposed(position):
+            x, y, z = position
+            i = ((x & 7) << 6) | ((y & 7) << 3) | (z & 7)
+            if position not in self.shown and exposed[i >> 3] >> (i & 7) & 1:
                 self.show_block(position)
 
     def _hide_sector(self, sector):
@@ -4,10 +4,14 @@ import cython
 #cython: wraparound=False
 #cython: cdivision=True
 
+cimport blockstorage
+
+
 @cython.locals(spreading_mutations=dict)
-cdef class WorldServer(dict):
+cdef class WorldServer(blockstorage.BlockStorage):
     cdef public:
-        sectors
+        set dirty_sectors
+        set complete_regions
         savingsystem
         dict exposed_cache
 
@@ -16,28 +20,49 @@ cdef class WorldServer(dict):
         sector_queue
         generation_queue
         spreading_mutable_blocks
+        spreading_lock
 
-        server_lock
+        locks
+        int evictions
         server
+        db
+
+        journal
+        unjournaled
+        resident
+        heightmap
 
         terraingen
+        generation
+        entity_values
 
     cpdef object add_block(self, tuple position, object block,
-                           bint sync=?, bint force=?, bint check_spread=?)
+                           bint sync=?, bint force=?, bint check_spread=?,
+                           int metadata=?)
+
+    @cython.locals(x=int, y=int, z=int)
+    cpdef object editing(self, tuple position)
 
     cpdef object init_block(self, tuple position, object block)
 
     cpdef object remove_block(self, tuple position,
                               bint sync=?, bint check_spread=?)
 
+    cpdef object highest_block(self, int x, int z, bint opaque=?)
+
     @cython.locals(x=int, y=int, z=int, fx=int, fy=int, fz=int,
     					other_position=tuple)
     cpdef bint is_exposed(self, tuple position)
 
-    @cython.locals(x=int, y=int, z=int, cx=int, cy=int, cz=int)
-    cpdef object get_exposed_sector_cached(self, tuple sector)
+    @cython.locals(cx=int, cy=int, cz=int)
+    cpdef str get_exposed_sector(self, tuple sector)
+
+    @cython.locals(x=int, y=int, z=int, dx=int, dy=int, dz=int, i=int,
+                   other=tuple)
+    cpdef object update_exposed(self, tuple position)
 
-    cpdef object get_exposed_sector(self, tuple sector)
+    @cython.locals(rx=int, ry=int, rz=int, x=int, y=int, z=int)
+    cpdef object forget_exposed(self, tuple region)
 
     @cython.locals(other_position=tuple)
     cpdef object check_neighbors(self, tuple position)
@@ -52,8 +77,30 @@ cdef class WorldServer(dict):
 
     cpdef object open_sector(self, tuple sector)
 
-    cpdef object hide_sector(self, tuple sector)
+    cpdef list missing_sectors(self, tuple region)
+
+    cpdef bint add_generated_region(self, tuple region, list sectors)
+
+    @cython.locals(merged=list)
+    cpdef object merge_generated(self, list sectors)
+
+    @cython.locals(bx=int, by=int, bz=int, column=int, base=int, y=int, value=int, top=bint)
+    cpdef object merge_columns(self, tuple secpos, ids, int start, int stop)
+
+    @cython.locals(x=int, y=int, z=int, dx=int, dy=int, dz=int)
+    cpdef object _sector_merged(self, tuple secpos)
+
+    @cython.locals(evictions=int)
+    cpdef object read_sector(self, tuple sector)
+
+    @cython.locals(radius=int, x=int, y=int, z=int, rx=int, ry=int, rz=int)
+    cpdef set player_regions(self)
+
+    cpdef object evict_regions(self, list regions)
+
+    cpdef int evict_cold_regions(self)
 
     cpdef object content_update(self)
 
-    cpdef object generate_vegetation(self, tuple position, vegetation_class)
\ No newline at end of file
+    @cython.locals(x=int, y=int, z=int, side=int, below=int, above=int)
+    cpdef object generate_vegetation(self, tuple position, vegetation_class, rand=?)
\ No newline at end of file
@@ -1,24 +1,44 @@
 # Python packages
 from binascii import hexlify
-from collections import deque, defaultdict, OrderedDict
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 import os
+import random
 import threading
 import time
-import warnings
 
 # Third-party packages
 
 # Modules from this project
 import datetime
 from blocks import *
+from blockstorage import BlockStorage
+from debug import log_info
+from generation import GenerationService
+from heightmap import HeightMap
+from journal import BlockJournal, JOURNAL_ADD
+from regionlocks import block_regions, region_neighborhood, RegionLocks
+from residency import ResidentSet, region_sectors
 from savingsystem import sector_to_blockpos
+from sectorview import exposed_bitmap, sector_view
 from utils import FACES, FACES_WITH_DIAGONALS, normalize_float, normalize, sectorize, TextureGroup
 import globals as G
-from nature import TREES, TREE_BLOCKS
+from nature import grow_vegetation
 import terrain
 
 
-class WorldServer(dict):
+EXPOSURE_NEIGHBORS = ((0, 0, 0),) + FACES
+
+# How far from a changed block add_block and remove_block read the world
+# (exposure of the neighbours, and their neighbours for spreading)
+EDIT_REACH = 2
+
+# How far vegetation can grow from its position: sideways, below and above
+# (the leaves of the tallest trees, and their neighbours)
+VEGETATION_REACH = 6, 1, 18
+
+
+class WorldServer(BlockStorage):
     spreading_mutations = {
         dirt_block: grass_block,
     }
@@ -29,19 +49,27 @@ class WorldServer(dict):
         if not os.path.lexists(os.path.join(G.game_dir, "world", "players")):
             os.makedirs(os.path.join(G.game_dir, "world", "players"))
 
-        self.sectors = defaultdict(list)
-        self.exposed_cache = dict()
+        self.dirty_sectors = set()  # Sectors changed since the last save
+        self.complete_regions = set()  # Regions whose sectors are all loaded or generated
+        self.exposed_cache = dict()  # Sector -> exposure bitmap, kept up to date by add_block and remove_block
 
         self.urgent_queue = deque()
         self.lazy_queue = deque()
         self.sector_queue = OrderedDict()
         self.generation_queue = deque()
-        self.spreading_mutable_blocks = deque()
+        self.spreading_mutable_blocks = OrderedDict()  # Ordered set, oldest first
+        self.spreading_lock = threading.Lock()  # Guards spreading_mutable_blocks
 
-        self.server_lock = threading.Lock()
+        self.locks = RegionLocks()  # See editing() and open_sector()
+        self.evictions = 0  # Incremented before regions are evicted, see read_sector()
         self.server = server
 
-        self.db = savingsystem.connect_db(G.SAVE_FILENAME)
+        self.journal = BlockJournal(os.path.join(G.game_dir, G.SAVE_FILENAME, "journal"))
+        self.unjournaled = threading.local()  # Generation and replays aren't journaled
+
+        self.db = savingsystem.player_store(G.SAVE_FILENAME)
+        self.heightmap = HeightMap(self, os.path.join(G.game_dir, G.SAVE_FILENAME, "heightmap"))
+        self.resident = ResidentSet(G.RESIDENT_MEMORY_BUDGET * 1024 * 1024)
 
         if os.path.exists(os.path.join(G.game_dir, G.SAVE_FILENAME, "seed")):
             with open(os.path.join(G.game_dir, G.SAVE_FILENAME, "seed"), "rb") as f:
@@ -52,38 +80,43 @@ class WorldServer(dict):
                 f.write(self.generate_seed())
 
         self.terraingen = terrain.TerrainGeneratorSimple(self, G.SEED)
-
-    def __del__(self):
-        self.db.close()
-        super(WorldServer, self).__del__()
+        self.generation = GenerationService(G.SEED, G.GENERATION_PROCESSES)  # Started by the server
+        self.entity_values = None  # Block values with an entity_type, see merge_generated()
 
     def __delitem__(self, position):
         super(WorldServer, self).__delitem__(position)
-
         if position in self.spreading_mutable_blocks:
-            try:
-                self.spreading_mutable_blocks.remove(position)
-            except ValueError:
-                warnings.warn('Block %s was unexpectedly not found in the '
-                              'spreading mutations; your save is probably '
-                              'corrupted' % repr(position))
+            with self.spreading_lock:
+                self.spreading_mutable_blocks.pop(position, None)
+
+    def editing(self, position):
+        """
+        Locks the regions add_block and remove_block use for position:
+            with world.editing(position):
+                world.add_block(position, block)
+        """
+        x, y, z = position
+        return self.locks.hold(block_regions((x - EDIT_REACH, y - EDIT_REACH, z - EDIT_REACH),
+                                             (x + EDIT_REACH, y + EDIT_REACH, z + EDIT_REACH)))
 
-    def add_block(self, position, block, sync=True, force=True, check_spread=True):
+    def add_block(self, position, block, sync=True, force=True, check_spread=True, metadata=0):
         if position in self:
             if not force:
                 return
             self.remove_block(position, sync=sync, check_spread=check_spread)
+        self[position] = block
+        if metadata:
+            self.set_metadata(position, metadata)
         if hasattr(block, 'entity_type'):
-            self[position] = type(block)()
-            self[position].entity = self[position].entity_type(self, position)
-        elif block.sub_id_as_metadata:
-            self[position] = type(block)()
-            self[position].set_metadata(block.get_metadata())
-        else:
-            self[position] = block
-        self.sectors[sectorize(position)].append(position)
+            self.entities[position] = block.entity_type(self, position)
+        self.heightmap.block_added(position, block)
+        self.dirty_sectors.add(sectorize(position))
+        if self.exposed_cache:
+            self.update_exposed(position)
+        if not getattr(self.unjournaled, 'depth', 0):
+            self.journal.add(position, BlockID(block.id.main, metadata) if metadata else block.id)
         if sync:
-            self.server.show_block(position, block)
+            self.server.show_block(position, block, metadata)
         if check_spread:
             if self.is_exposed(position):
                 self.check_spreading_mutable(position, block)
@@ -94,18 +127,24 @@ class WorldServer(dict):
 
     def remove_block(self, position, sync=True, check_spread=True):
         del self[position]
-        sector_position = sectorize(position)
-        try:
-            self.sectors[sector_position].remove(position)
-        except ValueError:
-            warnings.warn('Block %s was unexpectedly not found in sector %s;'
-                          'your save is probably corrupted'
-                          % (position, sector_position))
+        self.heightmap.block_removed(position)
+        self.dirty_sectors.add(sectorize(position))
+        if self.exposed_cache:
+            self.update_exposed(position)
+        if not getattr(self.unjournaled, 'depth', 0):
+            self.journal.remove(position)
         if sync:
             self.server.hide_block(position)
         if check_spread:
             self.check_neighbors(position)
 
+    def highest_block(self, x, z, opaque=False):
+        """
+        Returns the y of the highest block of the (x, z) column, or of the
+        highest opaque block; None if there is none.
+        """
+        return self.heightmap.get(x, z, opaque)
+
     def is_exposed(self, position):
         x, y, z = position
         for fx,fy,fz in FACES:
@@ -114,24 +153,49 @@ class WorldServer(dict):
                 return True
         return False
 
-    def get_exposed_sector_cached(self, sector):
+    def get_exposed_sector(self, sector):
         """
-        Cached. Returns a 512 length string of 0's and 1's if blocks are exposed
+        Returns the 64 byte bitmap of the exposed blocks of a sector: block i
+        (in SECTOR_OFFSETS order) is bit i & 7 of byte i >> 3.
+        Built on first use, then updated as blocks change.
         """
-        if sector in self.exposed_cache:
-            return self.exposed_cache[sector]
-        cx,cy,cz = sector_to_blockpos(sector)
-        #Most ridiculous list comprehension ever, but this is 25% faster than using appends
-        self.exposed_cache[sector] = "".join([(x,y,z) in self and self.is_exposed((x,y,z)) and "1" or "0"
-            for x in xrange(cx, cx+8) for y in xrange(cy, cy+8) for z in xrange(cz, cz+8)])
-        return self.exposed_cache[sector]
-
-    def get_exposed_sector(self, sector):
-        """ Returns a 512 length string of 0's and 1's if blocks are exposed """
-        cx,cy,cz = sector_to_blockpos(sector)
-        #Most ridiculous list comprehension ever, but this is 25% faster than using appends
-        return "".join([(x,y,z) in self and self.is_exposed((x,y,z)) and "1" or "0"
-                        for x in xrange(cx, cx+8) for y in xrange(cy, cy+8) for z in xrange(cz, cz+8)])
+        bitmap = self.exposed_cache.get(sector)
+        if bitmap is None:
+            cx, cy, cz = sector_to_blockpos(sector)
+            # Nothing next to the sector changes while it is built
+            with self.locks.hold(block_regions((cx - 1, cy - 1, cz - 1), (cx + 8, cy + 8, cz + 8))):
+                bitmap = self.exposed_cache.get(sector)
+                if bitmap is None:
+                    if self.sector_arrays.get(sector) is None:
+                        bitmap = bytearray(64)
+                    else:
+                        bitmap = exposed_bitmap(sector_view(self, sector))
+                    self.exposed_cache[sector] = bitmap
+        return str(bitmap)
+
+    def update_exposed(self, position):
+        # A block changed, refresh its bit and its neighbours', in the
+        # bitmaps built so far (neighbours can be in other sectors)
+        x, y, z = position
+        cache = self.exposed_cache
+        for dx, dy, dz in EXPOSURE_NEIGHBORS:
+            other = (x + dx, y + dy, z + dz)
+            bitmap = cache.get((other[0] >> 3, other[1] >> 3, other[2] >> 3))
+            if bitmap is not None:
+                i = ((other[0] & 7) << 6) | ((other[1] & 7) << 3) | (other[2] & 7)
+                if other in self and self.is_exposed(other):
+                    bitmap[i >> 3] |= 1 << (i & 7)
+                else:
+                    bitmap[i >> 3] &= ~(1 << (i & 7)) & 255
+
+    def forget_exposed(self, region):
+        # Drops the bitmaps a region's blocks may have changed, when they
+        # are loaded without add_block
+        rx, ry, rz = region
+        for x in xrange(rx * 4 - 1, rx * 4 + 5):
+            for y in xrange(ry * 4 - 1, ry * 4 + 5):
+                for z in xrange(rz * 4 - 1, rz * 4 + 5):
+                    self.exposed_cache.pop((x, y, z), None)
 
     def neighbors_iterator(self, position, relative_neighbors_positions=FACES):
         x, y, z = position
@@ -149,7 +213,8 @@ class WorldServer(dict):
     def check_spreading_mutable(self, position, block):
         x, y, z = position
         above_position = x, y + 1, z
-        if above_position in self\
+        # Nothing is above the top block of a column, no need to look
+        if (self.highest_block(x, z) > y and above_position in self)\
            or position in self.spreading_mutable_blocks\
         or not self.is_exposed(position):
             return
@@ -157,7 +222,8 @@ class WorldServer(dict):
             position,
             is_in={self.spreading_mutations[block]},
             diagonals=True):
-            self.spreading_mutable_blocks.appendleft(position)
+            with self.spreading_lock:
+                self.spreading_mutable_blocks[position] = None
 
     def has_neighbors(self, position, is_in=None, diagonals=False,
                       faces=None):
@@ -189,31 +255,236 @@ class WorldServer(dict):
             seeds.write('%s\n\n' % seed)
         return seed
 
+    @contextmanager
+    def not_journaled(self):
+        # Edits made by this thread in the block aren't journaled
+        self.unjournaled.depth = getattr(self.unjournaled, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self.unjournaled.depth -= 1
+
+    def replay_journal(self):
+        # Reapplies the edits that didn't make it into the region files
+        # before the server stopped, returns how many there were
+        count = 0
+        with self.not_journaled():
+            for operation, position, full_id in self.journal.replay():
+                self.open_sector(sectorize(position))
+                if operation == JOURNAL_ADD:
+                    try:
+                        block, metadata = block_and_metadata(full_id)
+                    except KeyError:
+                        continue
+                    with self.editing(position):
+                        self.add_block(position, block, sync=False, check_spread=False, metadata=metadata)
+                elif position in self:
+                    with self.editing(position):
+                        self.remove_block(position, sync=False, check_spread=False)
+                count += 1
+        return count
+
     def open_sector(self, sector):
-        #The sector is not in memory, load or create it
-        if self.savingsystem.sector_exists(sector):
-            #If its on disk, load it
-            self.savingsystem.load_region(self, sector=sector)
+        #Makes sure the sector is in memory, loading or creating its region
+        region = self.savingsystem.sector_to_region(sector)
+        self.resident.touch(region)
+        if region in self.complete_regions:
+            return  # Already loaded or generated
+        #Generation spills into the regions around (trees on the border),
+        #which stay locked until it is done
+        with self.locks.hold(region_neighborhood(region)):
+            with self.not_journaled():  # It can be loaded or generated again
+                self._open_sector(sector)
+
+    def _open_sector(self, sector):
+        region = self.savingsystem.sector_to_region(sector)
+        if region in self.complete_regions:
+            return  # Loaded or generated by another thread meanwhile
+        self._load_saved(region)
+
+        #For ease of saving/loading, generate a whole region (4x4x4 sectors) at once,
+        #skipping the sectors that were already generated and saved
+        missing = self.missing_sectors(region)
+        generated = None
+        if missing and self.generation.pool is not None:
+            #The workers generate while this thread waits without the GIL
+            generated = self.generation.generate(missing)
+        if generated is not None:
+            self.merge_generated(generated)
         else:
-            #The sector doesn't exist yet, generate it!
-            bx, by, bz = self.savingsystem.sector_to_blockpos(sector)
-            rx, ry, rz = bx/32*32, by/32*32, bz/32*32
-
-            #For ease of saving/loading, queue up generation of a whole region (4x4x4 sectors) at once
-            yiter, ziter = xrange(ry/8,ry/8+4), xrange(rz/8,rz/8+4)
-            for secx in xrange(rx/8,rx/8+4):
-                for secy in yiter:
-                    for secz in ziter:
-                        self.terraingen.generate_sector((secx,secy,secz))
-            #Generate the requested sector immediately, so the following show_block's work
-            #self.terraingen.generate_sector(sector)
-
-    def hide_sector(self, sector):
-        #TODO: remove from memory; save
-        #for position in self.sectors.get(sector, ()):
-        #    if position in self.shown:
-        #        self.hide_block(position)
-        pass
+            for secpos in missing:
+                self.terraingen.generate_sector(secpos)
+                #Saved even if it is all air, so its presence is recorded
+                self.dirty_sectors.add(secpos)
+        self.complete_regions.add(region)
+
+    def _load_saved(self, region):
+        #If its on disk, load it, along with the rest of its region
+        if self.savingsystem.region_exists(region_sectors(region)[0]):
+            self.savingsystem.load_region(self, region=region)
+            self.forget_exposed(region)
+            self.heightmap.add_sectors(region_sectors(region))
+
+    def missing_sectors(self, region):
+        """
+        The sectors of a region that were never generated and saved, in
+        generation order.
+        """
+        sector_exists = self.savingsystem.sector_exists
+        return [secpos for secpos in region_sectors(region) if not sector_exists(secpos)]
+
+    def add_generated_region(self, region, sectors):
+        """
+        Adds the generate_sectors of a region's missing_sectors, made ahead
+        of time (see pregen.py). Returns False if the region was opened
+        meanwhile, leaving it as it is.
+        """
+        with self.locks.hold(region_neighborhood(region)):
+            with self.not_journaled():
+                if region in self.complete_regions:
+                    return False
+                self._load_saved(region)
+                self.merge_generated(sectors)
+                self.complete_regions.add(region)
+        self.resident.touch(region)
+        return True
+
+    def merge_generated(self, sectors):
+        """
+        Adds the sectors of generation.generate_sectors to the world, each in
+        one go, keeping the blocks already there like init_block does. The
+        regions around the sectors must be locked.
+        """
+        merged = []
+        for secpos, fstr, requested in sectors:
+            self.decode_sector(secpos, fstr, overwrite=False)
+            self._sector_merged(secpos)
+            merged.append(secpos)
+        self.heightmap.add_sectors(merged)
+
+    def merge_columns(self, secpos, ids, start, stop):
+        super(WorldServer, self).merge_columns(secpos, ids, start, stop)
+        self._sector_merged(secpos)
+        merged = self.sector_arrays[secpos]
+        if merged is None:
+            return
+        # The top block and top opaque block of each column are enough for the heightmap
+        blocks_by_value = G.BLOCKS_BY_VALUE
+        bx, by, bz = secpos[0] * 8, secpos[1] * 8, secpos[2] * 8
+        for column in xrange(start, stop):
+            base = (column & 0x38) << 3 | (column & 7)
+            top = False
+            for y in xrange(7, -1, -1):
+                value = merged[base | y << 3]
+                if value:
+                    block = blocks_by_value[value]
+                    if not top or not block.transparent:
+                        self.heightmap.block_added((bx + (column >> 3), by + y, bz + (column & 7)), block)
+                    if not block.transparent:
+                        break
+                    top = True
+
+    def _sector_merged(self, secpos):
+        # Does for the blocks a sector got in bulk what add_block does for one
+        if self.entity_values is None:
+            entity_values = set()
+            for value, block in enumerate(G.BLOCKS_BY_VALUE):
+                if block is not None and hasattr(block, 'entity_type'):
+                    entity_values.add(value)
+            self.entity_values = entity_values
+        #Saved even if it is all air, so its presence is recorded
+        self.dirty_sectors.add(secpos)
+        ids = self.sector_arrays.get(secpos)
+        if ids is not None and self.entity_values.intersection(ids):
+            for position in self.sectors[secpos]:
+                if position not in self.entities and hasattr(self[position], 'entity_type'):
+                    self.entities[position] = self[position].entity_type(self, position)
+        x, y, z = secpos
+        for dx, dy, dz in EXPOSURE_NEIGHBORS:
+            self.exposed_cache.pop((x + dx, y + dy, z + dz), None)
+
+    def read_sector(self, sector):
+        """
+        Returns the on-disk string and the exposure bitmap of a sector,
+        loading or generating it first, or None when it is all air.
+        The sector is read without locking its region, so edits elsewhere
+        don't wait for it; it is read again if regions were evicted meanwhile.
+        """
+        while 1:
+            evictions = self.evictions
+            self.open_sector(sector)
+            ids = self.sector_arrays.get(sector)
+            if ids is None or ids.count(0) == len(ids):
+                snapshot = None
+            else:
+                snapshot = self.encode_sector(sector), self.get_exposed_sector(sector)
+            if self.evictions == evictions:
+                return snapshot
+
+    def player_regions(self):
+        # The regions players can see, which are kept in memory
+        radius = G.DELOAD_SECTORS_RADIUS
+        regions = set()
+        for player in self.server.players.values():
+            if getattr(player, 'position', None) is None:
+                continue
+            x, y, z = sectorize(player.position)
+            for rx in xrange((x - radius) // 4, (x + radius) // 4 + 1):
+                for ry in xrange((y - radius) // 4, (y + radius) // 4 + 1):
+                    for rz in xrange((z - radius) // 4, (z + radius) // 4 + 1):
+                        regions.add((rx, ry, rz))
+        return regions
+
+    def evict_regions(self, regions):
+        # Drops saved regions from memory, they're loaded again when needed.
+        # Their region locks must be held.
+        self.evictions += 1
+        sectors = [secpos for region in regions for secpos in region_sectors(region)]
+        self.drop_sectors(sectors)
+        for secpos in sectors:
+            self.exposed_cache.pop(secpos, None)
+        evicted = set(regions)
+        with self.spreading_lock:
+            for position in [position for position in self.spreading_mutable_blocks
+                             if self.savingsystem.sector_to_region(sectorize(position)) in evicted]:
+                del self.spreading_mutable_blocks[position]
+        for region in evicted:
+            self.complete_regions.discard(region)
+            self.resident.forget(region)
+        # The heightmap of a region column goes once none of its regions is left
+        columns = set((rx, rz) for rx, ry, rz in evicted)
+        columns.difference_update((rx, rz) for rx, ry, rz in list(self.complete_regions))
+        self.heightmap.drop_columns(columns)
+
+    def evict_cold_regions(self):
+        """
+        When the world's sectors take more memory than G.RESIDENT_MEMORY_BUDGET,
+        saves the world and evicts the least recently used regions no player
+        can see. Returns how many regions were evicted.
+        """
+        if not self.resident.over_budget(self):
+            return 0
+        selected = time.time()
+        victims = self.resident.victims(self, self.player_regions())
+        if not victims:
+            return 0
+        self.savingsystem.save_blocks(self, G.SAVE_FILENAME)
+        with self.locks.hold(victims):
+            pinned = self.player_regions()
+            dirty_regions = set(self.savingsystem.sector_to_region(secpos) for secpos in list(self.dirty_sectors))
+            # Skip the regions used or changed while saving
+            victims = [region for region in victims
+                       if region not in pinned and region not in dirty_regions
+                       and not self.resident.used_since(region, selected)]
+            self.evict_regions(victims)
+        return len(victims)
+
+    def evict_cold_regions_loop(self, stop):
+        # Run in its own thread, until the stop event is set
+        while not stop.wait(G.EVICTION_INTERVAL):
+            evicted = self.evict_cold_regions()
+            if evicted:
+                log_info('Evicted %d regions from memory.' % evicted)
 
     #content_update is run in its own thread
     def content_update(self):
@@ -223,24 +494,20 @@ class WorldServer(dict):
             time.sleep(G.SPREADING_MUTATION_DELAY)
             if self.server._stop.isSet():
                 break  # Close the thread
-            if self.spreading_mutable_blocks:
-                with self.server_lock:
-                    position = self.spreading_mutable_blocks.pop()
+            with self.spreading_lock:
+                if not self.spreading_mutable_blocks:
+                    continue
+                position, _ = self.spreading_mutable_blocks.popitem(last=False)
+            with self.editing(position):
+                block = self.get(position)
+                if block in self.spreading_mutations:  # It may have changed meanwhile
                     self.add_block(position,
-                        self.spreading_mutations[self[position]], check_spread=False)
-
-    def generate_vegetation(self, position, vegetation_class):
-        if position in self:
-            return
-
-        # Avoids a tree from touching another.
-        if vegetation_class in TREES and self.has_neighbors(position, is_in=TREE_BLOCKS, diagonals=True):
-            return
+                        self.spreading_mutations[block], check_spread=False)
 
+    def generate_vegetation(self, position, vegetation_class, rand=random):
+        # Locks every region the vegetation can reach, in case it grows
+        # across a region border
         x, y, z = position
-
-        # Vegetation can't grow on anything.
-        if self[(x, y - 1, z)] not in vegetation_class.grows_on:
-            return
-
-        vegetation_class.add_to_world(self, position)
+        side, below, above = VEGETATION_REACH
+        with self.locks.hold(block_regions((x - side, y - below, z - side), (x + side, y + above, z + side))):
+            grow_vegetation(self, position, vegetation_class, rand)